@@ -2,8 +2,8 @@ function obs = tb_load_obs(obsFile, behaviors, kinds)
 % Load a Tinbergen observation set file
 % Usage:
 %   obs = tb_load_obs(obsFile)
-%     Read all the data from a Tinbergen observation set file (.tbobs) and
-%     return a struct with fields:
+%     Read all the data from a Tinbergen observation set file (.tbobs),
+%     plain or gzip-compressed, and return a struct with fields:
 %       observer: The name of the observer who coded the observations
 %       source: The source of observations (video file name)
 %       behav: a struct array with the following fields
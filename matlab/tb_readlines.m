@@ -5,13 +5,25 @@ function lineTable = tb_readlines(filename)
 % Opens the specified file containing Tinbergen data. Each line contains
 % data as the string '<type>: <value>', or is a comment starting with #.
 % Returns a struct with fields 'type' and 'value' giving the data from each
-% line.
+% line. Files stored gzip-compressed (as observation files are in projects
+% with obs-compression: gzip) are recognized by their first bytes and
+% decompressed.
 
 % Copyright 2014 Geoffrey Adams. See the accompanying LICENSE file for
 % licensing information.
 
 % Read all data
-contents = fileread(filename);
+fid = fopen(filename, 'r');
+if fid < 0
+    error('tb_readlines:open', 'Cannot open file %s', filename);
+end
+magic = fread(fid, 2, '*uint8');
+fclose(fid);
+if isequal(magic(:)', uint8([31 139]))
+    contents = gunzip_text(filename);
+else
+    contents = fileread(filename);
+end
 lines = textscan(contents, '%s', ...
     'Delimiter', sprintf('\n'), 'MultipleDelimsAsOne', true);
 lines = lines{1};
@@ -24,3 +36,14 @@ lineTail = cellfun(@(s)s(2:end), lineTail, 'UniformOutput', false);
 lineTail = strtrim(lineTail);
 
 lineTable = struct('entry', {lineHead}, 'value', {lineTail});
+
+function contents = gunzip_text(filename)
+% Read the text of a gzip-compressed file. gunzip only takes names ending in
+% .gz, so a copy is decompressed in a temporary directory.
+tempDir = tempname;
+mkdir(tempDir);
+cleanup = onCleanup(@()rmdir(tempDir, 's'));
+gzFile = fullfile(tempDir, 'contents.gz');
+copyfile(filename, gzFile);
+unzipped = gunzip(gzFile, tempDir);
+contents = fileread(unzipped{1});
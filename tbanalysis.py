@@ -0,0 +1,1057 @@
+"""
+Numerical analysis of Tinbergen observation sets, using numpy.
+
+Observation sets are lists of dict objects, as returned by
+Project.load_obs_from_file. The functions here encode them as arrays and
+compute their results with array operations. The project-wide functions
+send each observation file to a pool of worker processes and add up the
+results.
+"""
+
+import os
+import collections
+import multiprocessing
+import numpy as np
+import tbdatamodel
+
+def obs_times(obslist):
+    """
+    Get the times of a list of observations as a float64 array. Missing or
+    non-numeric times are nan.
+    """
+    times = np.empty(len(obslist))
+    for ind,obs in enumerate(obslist):
+        try:
+            times[ind] = float(obs.get('time'))
+        except (TypeError, ValueError):
+            times[ind] = np.nan
+    return times
+
+def times_to_frames(times, rate):
+    """
+    The nearest frame number to each of an array of times, as an int64 array,
+    like tbdatamodel.time_to_frame. rate is a frame rate as accepted by
+    tbdatamodel.frame_rate. Frame numbers are -1 where the time is nan.
+    """
+    rate = tbdatamodel.frame_rate(rate)
+    times = np.asarray(times, dtype=np.float64)
+    frames = np.full(times.shape, -1, dtype=np.int64)
+    known = ~np.isnan(times)
+    frames[known] = np.floor(times[known] * rate.numerator / rate.denominator
+                             + 0.5)
+    return frames
+
+def frames_to_times(frames, rate):
+    """
+    The start time of each of an array of frame numbers, as a float64 array
+    with the same values as tbdatamodel.frame_to_time.
+    """
+    rate = tbdatamodel.frame_rate(rate)
+    # Exact integer products, so the division is the only rounding
+    scaled = np.asarray(frames, dtype=np.int64) * rate.denominator
+    return np.true_divide(scaled, rate.numerator)
+
+def obs_frames(obslist, rate):
+    """
+    Get the frame numbers of a list of observations as an int64 array, from
+    the stored 'frame' key where there is one and otherwise from the time.
+    Frame numbers are -1 where neither is usable.
+    """
+    frames = times_to_frames(obs_times(obslist), rate)
+    for ind,obs in enumerate(obslist):
+        if 'frame' in obs:
+            try:
+                frames[ind] = int(obs['frame'])
+            except (TypeError, ValueError):
+                pass
+    return frames
+
+# The observations of one behavior, in order of time. value is None for
+# moment behaviors; for state behaviors it holds indices into categories.
+BehaviorSeries = collections.namedtuple('BehaviorSeries',
+                                        ['name', 'kind', 'time', 'value',
+                                         'categories'])
+
+def _value_strings(values):
+    """
+    A str array of observation values, with list values (from a value
+    containing commas) joined back together as they are written to file.
+    """
+    values = np.asarray(values, dtype=object)
+    try:
+        # The usual case, all strings, converts in one go
+        return values.astype(str)
+    except ValueError:
+        # Some values are lists, which numpy won't convert
+        pass
+    # Observations repeat a small vocabulary of values, so each distinct
+    # value is converted once, and the rows are filled in by indexing
+    distinct, inverse = np.unique(values, return_inverse=True)
+    converted = np.array([','.join(value) if isinstance(value, (tuple, list))
+                          else str(value) for value in distinct], dtype=str)
+    return converted[inverse]
+
+def strings_to_float(strings):
+    """
+    Convert an array of strings to float64, with nan wherever a string is not
+    a number. Each distinct string is only converted once.
+    """
+    strings = np.asarray(strings, dtype=object)
+    if len(strings) == 0:
+        return np.empty(0)
+    distinct, inverse = np.unique(_value_strings(strings),
+                                  return_inverse=True)
+    converted = np.empty(len(distinct))
+    for ind,string in enumerate(distinct):
+        try:
+            converted[ind] = float(string)
+        except ValueError:
+            converted[ind] = np.nan
+    return converted[inverse]
+
+def strings_to_bool(strings):
+    """
+    Convert an array of strings to bool: True where the string is 'True' (in
+    any case), as tb_obs_convert does for binary behaviors.
+    """
+    strings = np.asarray(strings, dtype=object)
+    if len(strings) == 0:
+        return np.empty(0, dtype=bool)
+    return np.char.lower(_value_strings(strings)) == 'true'
+
+def strings_to_codes(strings, categories):
+    """
+    Convert an array of strings to integer codes, the index of each string in
+    categories, or -1 for strings not in categories.
+    """
+    strings = np.asarray(strings, dtype=object)
+    if len(strings) == 0:
+        return np.empty(0, dtype=np.intp)
+    distinct, inverse = np.unique(_value_strings(strings),
+                                  return_inverse=True)
+    lookup = dict((category, ind) for ind,category in enumerate(categories))
+    distinct_codes = np.array([lookup.get(string, -1) for string in distinct],
+                              dtype=np.intp)
+    return distinct_codes[inverse]
+
+def obs_convert(obslist, ethogram, converters=None, convert_binary=True):
+    """
+    Convert an observation set into typed arrays, one BehaviorSeries per
+    behavior, like tb_obs_convert (together with tb_load_obs) in Matlab.
+    Returns an OrderedDict mapping behavior names to BehaviorSeries, with an
+    entry for every behavior in the ethogram (empty if it was never observed)
+    and for any other behavior names found in obslist.
+    
+    In each series, time is a float64 array, sorted. value depends on the
+    behavior's kind:
+        moment:   None
+        binary:   bool array (if convert_binary; otherwise strings)
+        variable: float64 array, nan where the value is not a number
+        state:    integer array of indices into categories, the sorted
+                  values of the behavior in the ethogram; -1 for a value not
+                  in the ethogram
+    converters optionally maps behavior names to functions, each taking an
+    object array of value strings and returning an array of the same length,
+    which are used instead of the conversions above.
+    """
+    if converters is None:
+        converters = dict()
+    times = obs_times(obslist)
+    names = np.array([obs.get('name', '') for obs in obslist], dtype=object)
+    # Filled in one by one so that tuple values stay single elements
+    values = np.empty(len(obslist), dtype=object)
+    for ind,obs in enumerate(obslist):
+        values[ind] = obs.get('value', '')
+    order = np.argsort(times, kind='mergesort')
+    times, names, values = times[order], names[order], values[order]
+    
+    behaviors = sorted(ethogram.behaviors)
+    observed_kinds = dict()
+    for obs in obslist:
+        name = obs.get('name')
+        if name and name not in ethogram.behaviors:
+            observed_kinds.setdefault(name, obs.get('kind', ''))
+    behaviors.extend(sorted(observed_kinds))
+    
+    converted = collections.OrderedDict()
+    for name in behaviors:
+        mask = names == name
+        behavior_times = times[mask]
+        strings = values[mask]
+        if name in ethogram.behaviors:
+            kind = ethogram.behaviors[name]['kind']
+        else:
+            kind = observed_kinds[name]
+        categories = None
+        if name in converters:
+            value = np.asarray(converters[name](strings))
+            if value.shape != strings.shape:
+                raise ValueError('Converter function failed to preserve data '
+                                 'size for behavior {0}'.format(name))
+        elif kind == 'moment':
+            value = None
+        elif kind == 'binary' and convert_binary:
+            value = strings_to_bool(strings)
+        elif kind == 'variable':
+            value = strings_to_float(strings)
+        elif kind == 'state' and name in ethogram.behaviors:
+            categories = sorted(ethogram.behaviors[name]['values'])
+            value = strings_to_codes(strings, categories)
+        else:
+            value = strings
+        converted[name] = BehaviorSeries(name, kind, behavior_times, value,
+                                         categories)
+    return converted
+
+def pair_counts(first, second, n_first, n_second=None):
+    """
+    Count the pairs (first[i], second[i]) of integer codes. Returns an array
+    of shape (n_first, n_second) where element [a, b] is the number of times
+    the pair (a, b) occurs.
+    """
+    if n_second is None:
+        n_second = n_first
+    first = np.asarray(first, dtype=np.intp)
+    second = np.asarray(second, dtype=np.intp)
+    flat = np.bincount(first * n_second + second,
+                       minlength=n_first * n_second)
+    return flat.reshape(n_first, n_second)
+
+class SequenceCoding(object):
+    """
+    Integer codes for the events of an ethogram, for sequence analysis. Every
+    observation is an event with a label: the behavior name for moment and
+    variable behaviors, or "name=value" for state and binary behaviors. Labels
+    are numbered in order of behavior name, and then value, so that the
+    values of each state or binary behavior have consecutive codes.
+    """
+    def __init__(self, ethogram):
+        # name -> sorted list of values, for state and binary behaviors
+        self.values = dict()
+        self.labels = []
+        # name -> code of the behavior's first label
+        self.first_code = dict()
+        self.kinds = dict()
+        for name in sorted(ethogram.behaviors):
+            behavior = ethogram.behaviors[name]
+            self.kinds[name] = behavior['kind']
+            self.first_code[name] = len(self.labels)
+            if 'values' in behavior:
+                values = sorted(behavior['values'])
+                self.values[name] = values
+                self.labels.extend(name + '=' + value for value in values)
+            else:
+                self.labels.append(name)
+        self.label_index = dict((label, ind)
+                                for ind,label in enumerate(self.labels))
+    
+    def event_label(self, obs):
+        """
+        Get the event label for an observation.
+        """
+        name = obs.get('name')
+        if name in self.values:
+            return '{0}={1}'.format(name, obs.get('value'))
+        return name
+    
+    def encode(self, obslist):
+        """
+        Put an observation set in order of time and encode it. Returns two
+        arrays: the times, and the event codes. Observations without a valid
+        time, or whose label is not in the ethogram, are left out. Rows with
+        the same time keep their order in obslist.
+        """
+        times = obs_times(obslist)
+        events = np.array([self.label_index.get(self.event_label(obs), -1)
+                           for obs in obslist], dtype=np.intp)
+        keep = (events >= 0) & ~np.isnan(times)
+        times, events = times[keep], events[keep]
+        order = np.argsort(times, kind='mergesort')
+        return times[order], events[order]
+    
+    def behavior_codes(self, events, name):
+        """
+        From an array of event codes, get the sequence of values for one state
+        or binary behavior, as indices into values[name].
+        """
+        first = self.first_code[name]
+        n_values = len(self.values[name])
+        mask = (events >= first) & (events < first + n_values)
+        return events[mask] - first
+
+def transition_counts(obslist, coding, collapse_repeats=True):
+    """
+    For each state and binary behavior, count the transitions between its
+    values. Returns a dict mapping behavior names to arrays where element
+    [i, j] is the number of times values[i] was followed by values[j]. With
+    collapse_repeats, coding the value a behavior already has is not counted
+    as a transition.
+    """
+    times, events = coding.encode(obslist)
+    return _transition_counts(events, coding, collapse_repeats)
+
+def _transition_counts(events, coding, collapse_repeats):
+    counts = dict()
+    for name,values in coding.values.items():
+        seq = coding.behavior_codes(events, name)
+        if collapse_repeats and len(seq):
+            seq = seq[np.r_[True, seq[1:] != seq[:-1]]]
+        counts[name] = pair_counts(seq[:-1], seq[1:], len(values))
+    return counts
+
+def lag_counts(obslist, coding, lags=(1,)):
+    """
+    Lag-sequential counts across all behaviors. For each lag k, returns an
+    array where element [a, b] is the number of times event b was coded k
+    events after event a. Rows and columns are indexed by coding.labels.
+    Returns a dict mapping each lag to its array.
+    """
+    times, events = coding.encode(obslist)
+    return _lag_counts(events, coding, lags)
+
+def _lag_counts(events, coding, lags):
+    n_labels = len(coding.labels)
+    counts = dict()
+    for lag in lags:
+        if lag < 1:
+            raise ValueError('Lags must be positive')
+        counts[lag] = pair_counts(events[:-lag], events[lag:], n_labels)
+    return counts
+
+def transition_probabilities(counts):
+    """
+    Convert a transition count array to conditional probabilities, P(column
+    | row). Rows with no transitions are nan.
+    """
+    counts = np.asarray(counts, dtype=float)
+    totals = counts.sum(axis=1)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts / totals
+
+def expected_counts(counts):
+    """
+    The counts expected in a transition array if the row and column events
+    were independent, given the array's row and column totals.
+    """
+    counts = np.asarray(counts, dtype=float)
+    total = counts.sum()
+    if total == 0:
+        return np.zeros_like(counts)
+    return np.outer(counts.sum(axis=1), counts.sum(axis=0)) / total
+
+def transition_zscores(counts):
+    """
+    Adjusted residuals (Allison & Liker z-scores) of a transition array
+    against the counts expected under independence. Cells whose expected
+    variance is zero are nan.
+    """
+    counts = np.asarray(counts, dtype=float)
+    total = counts.sum()
+    expected = expected_counts(counts)
+    if total == 0:
+        return np.full(counts.shape, np.nan)
+    row_p = counts.sum(axis=1) / total
+    col_p = counts.sum(axis=0) / total
+    variance = expected * np.outer(1 - row_p, 1 - col_p)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (counts - expected) / np.sqrt(variance)
+    z[variance <= 0] = np.nan
+    return z
+
+_shared = None
+
+def _init_shared(shared):
+    global _shared
+    _shared = shared
+
+def _run_task(args):
+    task, path = args
+    return task(path, _shared)
+
+def select_obsfiles(project, observers=None):
+    """
+    List the (videofile, observer) pairs of a project's observation files,
+    optionally only those of the observer codes in observers.
+    """
+    pairs = project.list_obsfiles()
+    if observers is not None:
+        pairs = [pair for pair in pairs if pair[1] in observers]
+    return pairs
+
+def map_obsfiles(project, task, shared, processes=None, pairs=None,
+                 cache=None, params=None):
+    """
+    Call task(path, shared) for the path of every observation file in a
+    project (or those in pairs, a list of (videofile, observer) pairs), using
+    a pool of worker processes. task must be a module-level function, and
+    shared must be picklable; it is sent to each worker once. Returns a list
+    of (videofile, observer, result) tuples.
+    
+    With a tbcache.ArtifactCache as cache, results are looked up first, and
+    only the files without a stored result are sent to the workers. A result
+    must then depend on nothing but the file's contents, the project's
+    ethogram file and params(path), which gives the rest of the task's
+    parameters (as plain values; see tbcache.canonical).
+    """
+    if pairs is None:
+        pairs = project.list_obsfiles()
+    paths = [project.get_obsfile(videofile, observer)
+             for videofile,observer in pairs]
+    results = [None] * len(paths)
+    todo = range(len(paths))
+    if cache is not None:
+        name = task.__module__ + '.' + task.__name__
+        keys = [cache.key(name, [path, project.ethogram_file],
+                          params(path) if params is not None else None)
+                for path in paths]
+        missing = object()
+        for ind,key in enumerate(keys):
+            results[ind] = cache.get(key, missing)
+        todo = [ind for ind in todo if results[ind] is missing]
+    todo_paths = [paths[ind] for ind in todo]
+    if processes == 1 or len(todo_paths) < 2:
+        computed = [task(path, shared) for path in todo_paths]
+    else:
+        n_workers = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(n_workers, _init_shared, (shared,))
+        try:
+            chunksize = max(1, len(todo_paths) // (4 * n_workers))
+            computed = pool.map(_run_task,
+                                [(task, path) for path in todo_paths],
+                                chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    for ind,result in zip(todo, computed):
+        results[ind] = result
+        if cache is not None:
+            cache.put(keys[ind], result)
+    if cache is not None:
+        cache.evict()
+        cache.save_digests()
+    return [pair + (result,) for pair,result in zip(pairs, results)]
+
+def store_arrays(store):
+    """
+    The columns of a tbdatamodel.SharedObsStore as read-only numpy arrays,
+    without copying. Returns a dict of arrays by column name.
+    """
+    return dict((column, np.frombuffer(store.buffer(column), typecode))
+                for column,typecode in store.columns)
+
+_store = None
+
+def _init_store(name, directory, shared):
+    global _store, _shared
+    _store = tbdatamodel.SharedObsStore.attach(name, directory)
+    _shared = shared
+
+def _run_store_task(args):
+    task, index = args
+    return task(_store, index, _shared)
+
+def map_store(store, task, shared, processes=None):
+    """
+    Like map_obsfiles, but for observations already loaded into a
+    tbdatamodel.SharedObsStore: calls task(store, index, shared) for the
+    index of every file in the store, in a pool of worker processes which
+    each attach to the store rather than read the files. Returns a list of
+    (videofile, observer, result) tuples.
+    """
+    indices = range(len(store.files))
+    if processes == 1 or len(indices) < 2:
+        results = [task(store, index, shared) for index in indices]
+    else:
+        n_workers = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(n_workers, _init_store,
+                                    (store.name, os.path.dirname(store.path),
+                                     shared))
+        try:
+            chunksize = max(1, len(indices) // (4 * n_workers))
+            results = pool.map(_run_store_task,
+                               [(task, index) for index in indices],
+                               chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    return [pair + (result,) for pair,result in zip(store.files, results)]
+
+class SequenceSummary(object):
+    """
+    Transition and lag-sequential counts added up over many observation sets.
+    transitions maps each state and binary behavior to its count array (see
+    transition_counts), and lags maps each lag to a count array over
+    coding.labels (see lag_counts). files is the list of (videofile,
+    observer) pairs included.
+    """
+    def __init__(self, coding, transitions, lags, files):
+        self.coding = coding
+        self.transitions = transitions
+        self.lags = lags
+        self.files = files
+    
+    def transition_probabilities(self, name):
+        return transition_probabilities(self.transitions[name])
+    
+    def transition_zscores(self, name):
+        return transition_zscores(self.transitions[name])
+    
+    def lag_probabilities(self, lag=1):
+        return transition_probabilities(self.lags[lag])
+    
+    def lag_zscores(self, lag=1):
+        return transition_zscores(self.lags[lag])
+
+def _sequence_task(path, shared):
+    coding, lags, collapse_repeats = shared
+    times, events = coding.encode(tbdatamodel.read_obsfile(path))
+    return (_transition_counts(events, coding, collapse_repeats),
+            _lag_counts(events, coding, lags))
+
+def project_sequences(project, lags=(1,), collapse_repeats=True,
+                      processes=None, observers=None, cache=None):
+    """
+    Compute transition counts for every state and binary behavior, and
+    lag-sequential counts across behaviors, for every observation file in
+    a project, and add them up into a SequenceSummary. Each file is a
+    separate sequence; no transitions are counted between files. observers
+    optionally limits the files to a list of observer codes. The counts of
+    each file are kept in cache, if given (see map_obsfiles).
+    """
+    coding = SequenceCoding(project.ethogram)
+    lags = tuple(lags)
+    pairs = select_obsfiles(project, observers)
+    results = map_obsfiles(project, _sequence_task,
+                           (coding, lags, collapse_repeats), processes, pairs,
+                           cache, lambda path: (lags, collapse_repeats))
+    transitions = dict((name, np.zeros((len(values), len(values)), int))
+                       for name,values in coding.values.items())
+    n_labels = len(coding.labels)
+    lag_totals = dict((lag, np.zeros((n_labels, n_labels), int))
+                      for lag in lags)
+    for videofile,observer,(file_transitions,file_lags) in results:
+        for name,counts in file_transitions.items():
+            transitions[name] += counts
+        for lag,counts in file_lags.items():
+            lag_totals[lag] += counts
+    return SequenceSummary(coding, transitions, lag_totals, pairs)
+
+def state_intervals(times, events, coding, name, start, end, initial=None):
+    """
+    Turn the coded changes of one state or binary behavior (times and events,
+    as from SequenceCoding.encode) into intervals covering [start, end).
+    Returns two arrays: edges, of length n+1, and values, of length n, where
+    the behavior has values[i] (an index into coding.values[name]) from
+    edges[i] to edges[i+1]. Before its first change, the behavior has the
+    value initial, or -1 (unknown) if initial is None.
+    """
+    first = coding.first_code[name]
+    mask = (events >= first) & (events < first + len(coding.values[name]))
+    change_times = times[mask]
+    change_values = events[mask] - first
+    # The value at start is that of the last change at or before start
+    n_before = np.searchsorted(change_times, start, side='right')
+    if n_before > 0:
+        start_value = change_values[n_before - 1]
+    elif initial is None:
+        start_value = -1
+    else:
+        start_value = coding.values[name].index(initial)
+    n_within = np.searchsorted(change_times, end, side='left')
+    edges = np.concatenate(([start], change_times[n_before:n_within], [end]))
+    values = np.concatenate(([start_value],
+                             change_values[n_before:n_within])).astype(np.intp)
+    return edges, values
+
+def values_at(edges, values, at_times):
+    """
+    Look up the values of a behavior, given as intervals by state_intervals,
+    at each of an array of times. Times outside the intervals give -1.
+    """
+    at_times = np.asarray(at_times, dtype=float)
+    ind = np.searchsorted(edges, at_times, side='right') - 1
+    inside = (ind >= 0) & (ind < len(values))
+    found = np.full(at_times.shape, -1, dtype=np.intp)
+    found[inside] = values[ind[inside]]
+    return found
+
+def default_initial_values(coding):
+    """
+    Initial values used when none are given: binary behaviors start out
+    'False' (as with the InitialBinary option of tb_obs2table), and state
+    behaviors start out unknown.
+    """
+    return dict((name, 'False') for name in coding.values
+                if coding.kinds[name] == 'binary')
+
+class CooccurrenceSummary(object):
+    """
+    Time budgets, overlaps and event counts for the state and binary behaviors
+    of one or more observation sets, all in seconds and event counts so that
+    summaries from different sets can be added together.
+        durations[name][i]:
+            total time that behavior name had values[i]
+        overlaps[a, b][i, j]:
+            total time during which behavior a had value i and behavior b had
+            value j (for each pair of different behaviors)
+        event_counts[m, name][i]:
+            number of events of moment behavior m that occurred while
+            behavior name had value i
+    Values are indexed as in coding.values. Time during which a behavior's
+    value is unknown is not counted.
+    """
+    def __init__(self, coding):
+        self.coding = coding
+        names = sorted(coding.values)
+        moments = sorted(name for name,kind in coding.kinds.items()
+                         if kind == 'moment')
+        self.durations = dict((name, np.zeros(len(coding.values[name])))
+                              for name in names)
+        self.overlaps = dict(((a, b), np.zeros((len(coding.values[a]),
+                                                len(coding.values[b]))))
+                             for a in names for b in names if a != b)
+        self.event_counts = dict(((m, name), np.zeros(len(coding.values[name]),
+                                                      int))
+                                 for m in moments for name in names)
+    
+    def add(self, other):
+        """
+        Add the totals of another summary (with the same coding) to this one.
+        """
+        for table in ('durations', 'overlaps', 'event_counts'):
+            mine, theirs = getattr(self, table), getattr(other, table)
+            for key in mine:
+                mine[key] += theirs[key]
+        return self
+    
+    def time_budget(self, name):
+        """
+        Fraction of the known time that behavior name spent in each value.
+        """
+        durations = self.durations[name]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return durations / durations.sum()
+    
+    def conditional_overlap(self, a, b):
+        """
+        Element [i, j] is the fraction of the time that behavior a had value i
+        during which behavior b had value j.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.overlaps[a, b] / self.durations[a][:, np.newaxis]
+    
+    def event_rates(self, moment, name):
+        """
+        Rate (events per second) of the moment behavior while behavior name
+        had each of its values.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.event_counts[moment, name] / self.durations[name]
+
+def cooccurrence(obslist, coding, start=0.0, end=None, initial=None):
+    """
+    Compute a CooccurrenceSummary for one observation set, over the time from
+    start to end (by default, the time of the last observation). Works
+    directly on the intervals between changes, never on a grid of frames.
+    initial maps behavior names to their values before their first
+    observation; by default, see default_initial_values.
+    """
+    times, events = coding.encode(obslist)
+    return _cooccurrence(times, events, coding, start, end, initial)
+
+def _cooccurrence(times, events, coding, start, end, initial):
+    if initial is None:
+        initial = default_initial_values(coding)
+    if end is None:
+        end = times[-1] if len(times) else start
+    summary = CooccurrenceSummary(coding)
+    names = sorted(coding.values)
+    intervals = dict((name, state_intervals(times, events, coding, name,
+                                            start, end, initial.get(name)))
+                     for name in names)
+    # Split [start, end) at every change of any behavior; each piece then
+    # has a single value for every behavior
+    cuts = np.unique(np.concatenate([intervals[name][0] for name in names]
+                                    or [[start, end]]))
+    piece_starts = cuts[:-1]
+    piece_lengths = np.diff(cuts)
+    piece_values = dict((name, values_at(edges, values, piece_starts))
+                        for name,(edges,values) in intervals.items())
+    for name in names:
+        edges, values = intervals[name]
+        known = values >= 0
+        summary.durations[name] += np.bincount(
+            values[known], weights=np.diff(edges)[known],
+            minlength=len(coding.values[name]))
+    for a,b in summary.overlaps:
+        va, vb = piece_values[a], piece_values[b]
+        known = (va >= 0) & (vb >= 0)
+        n_b = len(coding.values[b])
+        flat = np.bincount(va[known] * n_b + vb[known],
+                           weights=piece_lengths[known],
+                           minlength=len(coding.values[a]) * n_b)
+        summary.overlaps[a, b] += flat.reshape(-1, n_b)
+    for moment,name in summary.event_counts:
+        code = coding.first_code[moment]
+        event_times = times[(events == code) & (times >= start) & (times < end)]
+        edges, values = intervals[name]
+        found = values_at(edges, values, event_times)
+        summary.event_counts[moment, name] += np.bincount(
+            found[found >= 0], minlength=len(coding.values[name]))
+    return summary
+
+def _cooccurrence_task(path, shared):
+    coding, end_times, initial = shared
+    times, events = coding.encode(tbdatamodel.read_obsfile(path))
+    return _cooccurrence(times, events, coding, 0.0, end_times.get(path),
+                         initial)
+
+def project_cooccurrence(project, processes=None, observers=None,
+                         durations=None, initial=None, cache=None):
+    """
+    Compute a CooccurrenceSummary for every observation file in a project, in
+    a pool of worker processes, and add them together. durations optionally
+    maps video files to their durations in seconds, so that the final bout of
+    each behavior is closed at the end of the video rather than at the last
+    observation. The summary of each file is kept in cache, if given (see
+    map_obsfiles).
+    """
+    coding = SequenceCoding(project.ethogram)
+    pairs = select_obsfiles(project, observers)
+    end_times = dict()
+    for videofile,observer in pairs:
+        if durations is not None and videofile in durations:
+            end_times[project.get_obsfile(videofile, observer)] = \
+                durations[videofile]
+    results = map_obsfiles(project, _cooccurrence_task,
+                           (coding, end_times, initial), processes, pairs,
+                           cache, lambda path: (end_times.get(path), initial))
+    total = CooccurrenceSummary(coding)
+    for videofile,observer,summary in results:
+        total.add(summary)
+    return total
+
+def window_starts(start, end, window, step=None):
+    """
+    The start times of the windows of length window, every step seconds (by
+    default, window: windows that do not overlap), that begin in [start,
+    end). The last windows may run past end.
+    """
+    if step is None:
+        step = window
+    if window <= 0 or step <= 0:
+        raise ValueError('Window and step must be positive')
+    n_windows = max(0, int(np.ceil((end - start) / float(step))))
+    return start + step * np.arange(n_windows)
+
+def occupancy(edges, values, n_values, at_times):
+    """
+    The total time a behavior, given as intervals by state_intervals, spent
+    in each of its values from edges[0] up to each of an array of times.
+    Returns an array of shape (len(at_times), n_values). Times outside the
+    intervals are taken as edges[0] or edges[-1].
+    """
+    # Cumulative time in each value at every edge; between edges, the time
+    # of the current value grows linearly
+    known = values >= 0
+    per_interval = np.zeros((len(values), n_values))
+    per_interval[np.nonzero(known)[0], values[known]] = np.diff(edges)[known]
+    cumulative = np.vstack((np.zeros(n_values),
+                            np.cumsum(per_interval, axis=0)))
+    at_times = np.clip(np.asarray(at_times, dtype=float), edges[0], edges[-1])
+    ind = np.minimum(np.searchsorted(edges, at_times, side='right') - 1,
+                     len(values) - 1)
+    spent = cumulative[ind]
+    rows = np.nonzero(known[ind])[0]
+    spent[rows, values[ind[rows]]] += at_times[rows] - edges[ind[rows]]
+    return spent
+
+class RollingSummary(object):
+    """
+    Per-window measures of one observation set, for windows of time
+    starting at starts (see window_starts), each lengths[i] seconds long
+    (the full window, or less where it is cut off at the end):
+        counts[m][i]:
+            number of events of moment behavior m in window i
+        durations[name][i, j]:
+            time that state or binary behavior name had values[j] in window
+            i, indexed as in coding.values
+    Windows include their start time but not their end time. Time during
+    which a behavior's value is unknown is not counted.
+    """
+    def __init__(self, coding, starts, lengths, counts, durations):
+        self.coding = coding
+        self.starts = starts
+        self.lengths = lengths
+        self.counts = counts
+        self.durations = durations
+    
+    def event_rates(self, moment, per=60.0):
+        """
+        Rate of a moment behavior in each window, in events per per seconds
+        (by default, per minute).
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.counts[moment] * per / self.lengths
+    
+    def fractions(self, name):
+        """
+        Fraction of each window that behavior name spent in each value, as an
+        array of shape (number of windows, number of values).
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.durations[name] / self.lengths[:, np.newaxis]
+
+def rolling_windows(obslist, coding, window, step=None, start=0.0, end=None,
+                    initial=None):
+    """
+    Compute a RollingSummary for one observation set, over windows of window
+    seconds every step seconds from start to end (by default, the time of
+    the last observation). Like cooccurrence, works on the intervals between
+    changes: each window's measures are differences of cumulative totals at
+    its ends, so the cost depends on the numbers of changes and windows, not
+    on the length of the video.
+    """
+    times, events = coding.encode(obslist)
+    return _rolling_windows(times, events, coding, window, step, start, end,
+                            initial)
+
+def _rolling_windows(times, events, coding, window, step, start, end,
+                     initial):
+    if initial is None:
+        initial = default_initial_values(coding)
+    if end is None:
+        end = times[-1] if len(times) else start
+    starts = window_starts(start, end, window, step)
+    stops = np.minimum(starts + window, end)
+    counts = dict()
+    for name,kind in coding.kinds.items():
+        if kind == 'moment':
+            event_times = times[events == coding.first_code[name]]
+            counts[name] = (np.searchsorted(event_times, stops, side='left') -
+                            np.searchsorted(event_times, starts, side='left'))
+    durations = dict()
+    for name,values in coding.values.items():
+        edges, codes = state_intervals(times, events, coding, name, start,
+                                       end, initial.get(name))
+        durations[name] = (occupancy(edges, codes, len(values), stops) -
+                           occupancy(edges, codes, len(values), starts))
+    return RollingSummary(coding, starts, stops - starts, counts, durations)
+
+def _rolling_task(path, shared):
+    coding, window, step, end_times, initial = shared
+    times, events = coding.encode(tbdatamodel.read_obsfile(path))
+    return _rolling_windows(times, events, coding, window, step, 0.0,
+                            end_times.get(path), initial)
+
+def project_rolling_windows(project, window, step=None, processes=None,
+                            observers=None, durations=None, initial=None,
+                            cache=None):
+    """
+    Compute a RollingSummary for every observation file in a project, in a
+    pool of worker processes. Returns a dict mapping (videofile, observer)
+    pairs to summaries. durations optionally maps video files to their
+    durations in seconds, so that windows run to the end of each video
+    rather than to its last observation. The summary of each file is kept in
+    cache, if given (see map_obsfiles).
+    """
+    coding = SequenceCoding(project.ethogram)
+    pairs = select_obsfiles(project, observers)
+    end_times = dict()
+    for videofile,observer in pairs:
+        if durations is not None and videofile in durations:
+            end_times[project.get_obsfile(videofile, observer)] = \
+                durations[videofile]
+    results = map_obsfiles(project, _rolling_task,
+                           (coding, window, step, end_times, initial),
+                           processes, pairs, cache,
+                           lambda path: (window, step, end_times.get(path),
+                                         initial))
+    return dict(((videofile, observer), summary)
+                for videofile,observer,summary in results)
+
+# One occurrence of the trigger of a peri-event analysis; see PeriEventSet
+PeriEventTrigger = collections.namedtuple('PeriEventTrigger',
+                                          ['videofile', 'observer', 'time',
+                                           'label'])
+
+def trigger_codes(coding, name, value=None):
+    """
+    The event codes that trigger a peri-event analysis: those of behavior
+    name, or with a value, only that value of a state or binary behavior.
+    """
+    if name not in coding.kinds:
+        raise KeyError('No behavior {0} in the ethogram'.format(name))
+    if value is not None:
+        if name not in coding.values:
+            raise ValueError('Only state and binary behaviors have values')
+        return [coding.label_index['{0}={1}'.format(name, value)]]
+    first = coding.first_code[name]
+    return range(first, first + len(coding.values.get(name, [name])))
+
+class PeriEventSet(object):
+    """
+    The behavior around each occurrence of a trigger, on a common grid of
+    times relative to the trigger. offsets are the start times of the grid's
+    bins, each resolution seconds long, and triggers is a list of
+    PeriEventTrigger tuples, one per row of the arrays:
+        states[name][k, i]:
+            value of state or binary behavior name (an index into
+            coding.values[name]) at offsets[i] from trigger k, or -1 if
+            unknown or outside the observed time
+        rasters[m][k, i]:
+            number of events of moment behavior m in bin i around trigger k
+    """
+    def __init__(self, coding, offsets, resolution, triggers, states,
+                 rasters):
+        self.coding = coding
+        self.offsets = offsets
+        self.resolution = resolution
+        self.triggers = triggers
+        self.states = states
+        self.rasters = rasters
+    
+    @classmethod
+    def concatenate(cls, sets):
+        """
+        Stack several PeriEventSets, made with the same coding and grid, into
+        one.
+        """
+        first = sets[0]
+        triggers = []
+        for peri in sets:
+            triggers.extend(peri.triggers)
+        return cls(first.coding, first.offsets, first.resolution, triggers,
+                   dict((name, np.concatenate([peri.states[name]
+                                               for peri in sets]))
+                        for name in first.states),
+                   dict((name, np.concatenate([peri.rasters[name]
+                                               for peri in sets]))
+                        for name in first.rasters))
+    
+    def __len__(self):
+        return len(self.triggers)
+    
+    def state_probabilities(self, name):
+        """
+        Fraction of the triggers with known values in which behavior name had
+        each value, at each offset, as an array of shape (number of values,
+        number of offsets).
+        """
+        states = self.states[name]
+        counts = np.array([(states == ind).sum(axis=0)
+                           for ind in range(len(self.coding.values[name]))],
+                          dtype=float).reshape(-1, len(self.offsets))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return counts / counts.sum(axis=0)
+    
+    def event_rates(self, moment):
+        """
+        Mean rate (events per second) of a moment behavior in each bin.
+        """
+        with np.errstate(invalid='ignore'):
+            return self.rasters[moment].mean(axis=0) / self.resolution
+
+def peri_offsets(before, after, resolution):
+    """
+    The start times of the bins, resolution seconds long, covering from
+    before seconds before a trigger to after seconds after it.
+    """
+    if resolution <= 0:
+        raise ValueError('Resolution must be positive')
+    n_before = int(np.ceil(before / float(resolution) - 1e-9))
+    n_after = int(np.ceil(after / float(resolution) - 1e-9))
+    return resolution * np.arange(-n_before, n_after)
+
+def peri_events(obslist, coding, trigger, value=None, before=5.0, after=5.0,
+                resolution=0.1, start=0.0, end=None, initial=None,
+                videofile=None, observer=None):
+    """
+    Compute a PeriEventSet for one observation set: for every observation of
+    behavior trigger (with value, if given), the values of every state and
+    binary behavior, and the counts of every moment behavior, from before
+    seconds before it to after seconds after it. Behaviors are known from
+    start to end (by default, the time of the last observation), with the
+    values in initial before their first observation (see
+    default_initial_values). videofile and observer are recorded with each
+    trigger.
+    """
+    times, events = coding.encode(obslist)
+    offsets = peri_offsets(before, after, resolution)
+    return _peri_events(times, events, coding, trigger_codes(coding, trigger,
+                                                             value),
+                        offsets, resolution, start, end, initial, videofile,
+                        observer)
+
+def _peri_events(times, events, coding, codes, offsets, resolution, start,
+                 end, initial, videofile, observer):
+    if initial is None:
+        initial = default_initial_values(coding)
+    if end is None:
+        end = times[-1] if len(times) else start
+    is_trigger = np.in1d(events, codes)
+    trigger_times = times[is_trigger]
+    triggers = [PeriEventTrigger(videofile, observer, float(time),
+                                 coding.labels[code])
+                for time,code in zip(trigger_times, events[is_trigger])]
+    # Every trigger's grid at once, one row per trigger
+    grid = trigger_times[:, np.newaxis] + offsets
+    states = dict()
+    for name in coding.values:
+        edges, values = state_intervals(times, events, coding, name, start,
+                                        end, initial.get(name))
+        states[name] = values_at(edges, values, grid.ravel()).reshape(
+            grid.shape)
+    rasters = dict()
+    for name,kind in coding.kinds.items():
+        if kind == 'moment':
+            event_times = times[events == coding.first_code[name]]
+            rasters[name] = (
+                np.searchsorted(event_times, grid + resolution, side='left') -
+                np.searchsorted(event_times, grid, side='left'))
+    return PeriEventSet(coding, offsets, resolution, triggers, states,
+                        rasters)
+
+def _peri_event_task(path, shared):
+    coding, codes, offsets, resolution, end_times, initial = shared
+    times, events = coding.encode(tbdatamodel.read_obsfile(path))
+    return _peri_events(times, events, coding, codes, offsets, resolution,
+                        0.0, end_times.get(path), initial, None, None)
+
+def project_peri_events(project, trigger, value=None, before=5.0, after=5.0,
+                        resolution=0.1, processes=None, observers=None,
+                        durations=None, initial=None, cache=None):
+    """
+    Compute a PeriEventSet for every occurrence of a trigger (see
+    peri_events) in every observation file in a project, in a pool of worker
+    processes, and stack them into one. durations optionally maps video
+    files to their durations in seconds, so that behaviors are known up to
+    the end of each video rather than its last observation. The set of each
+    file is kept in cache, if given (see map_obsfiles).
+    """
+    coding = SequenceCoding(project.ethogram)
+    codes = trigger_codes(coding, trigger, value)
+    offsets = peri_offsets(before, after, resolution)
+    pairs = select_obsfiles(project, observers)
+    end_times = dict()
+    for videofile,observer in pairs:
+        if durations is not None and videofile in durations:
+            end_times[project.get_obsfile(videofile, observer)] = \
+                durations[videofile]
+    results = map_obsfiles(project, _peri_event_task,
+                           (coding, codes, offsets, resolution, end_times,
+                            initial),
+                           processes, pairs, cache,
+                           lambda path: (codes, before, after, resolution,
+                                         end_times.get(path), initial))
+    sets = []
+    for videofile,observer,peri in results:
+        peri.triggers = [trigger._replace(videofile=videofile,
+                                          observer=observer)
+                         for trigger in peri.triggers]
+        sets.append(peri)
+    if not sets:
+        return _peri_events(np.empty(0), np.empty(0, dtype=np.intp), coding,
+                            codes, offsets, resolution, 0.0, None, initial,
+                            None, None)
+    return PeriEventSet.concatenate(sets)
@@ -0,0 +1,156 @@
+"""
+Benchmarks for Tinbergen's data handling, run on synthetic projects.
+
+Usage:
+    python tbbench.py startup [--videos N] [--codes N] [--repeat N]
+    python tbbench.py compression [--files N] [--rows N] [--bandwidth MB/s]
+                                  [--repeat N]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import tbdatamodel
+
+def make_project(root, n_videos, n_codes, videos_per_dir=50):
+    """
+    Create a synthetic project under root, with n_videos empty movie files
+    spread over subdirectories and an ethogram of n_codes codes. Returns the
+    path of the project file.
+    """
+    video_root = os.path.join(root, 'videos')
+    for ind in xrange(n_videos):
+        subdir = os.path.join(video_root, 'site{0:03d}'.format(
+            ind // (videos_per_dir * 10)), 'day{0:03d}'.format(
+            ind // videos_per_dir))
+        if not os.path.exists(subdir):
+            os.makedirs(subdir)
+        open(os.path.join(subdir, 'video{0:05d}.mp4'.format(ind)), 'w').close()
+    os.makedirs(os.path.join(root, 'obs'))
+    with open(os.path.join(root, 'bench.tbethogram'), 'w') as f:
+        f.write('name: Benchmark ethogram\n')
+        n_states = max(1, n_codes // 10)
+        for ind in xrange(n_states):
+            values = ','.join('v{0}'.format(v) for v in xrange(10))
+            f.write('behavior: kind=state name=State-{0} values={1}\n'
+                    .format(ind, values))
+        for ind in xrange(n_codes):
+            f.write('code: symbol=s{0:04d} name=State-{1} value=v{2}\n'
+                    .format(ind, ind // 10 % n_states, ind % 10))
+    project_file = os.path.join(root, 'bench.tbproj')
+    with open(project_file, 'w') as f:
+        f.write('video-root: videos\nproject-root: obs\n'
+                'ethogram-file: bench.tbethogram\n'
+                'observer: name="Bench Marker" code=bm\n')
+    return project_file
+
+def time_call(func, repeat):
+    """
+    Call func repeat times, returning the best time in seconds.
+    """
+    best = float('inf')
+    for ind in xrange(repeat):
+        start = time.time()
+        func()
+        best = min(best, time.time() - start)
+    return best
+
+def bench_startup(args):
+    root = tempfile.mkdtemp(prefix='tbbench')
+    try:
+        project_file = make_project(root, args.videos, args.codes)
+        cache_file = os.path.join(root, 'obs', '.tinbergen', 'startup.pickle')
+        def cold():
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+            tbdatamodel.Project(project_file, use_cache=True)
+        def warm():
+            tbdatamodel.Project(project_file, use_cache=True)
+        uncached = time_call(lambda: tbdatamodel.Project(project_file),
+                             args.repeat)
+        cold_time = time_call(cold, args.repeat)
+        warm_time = time_call(warm, args.repeat)
+        print('startup: {0} videos, {1} codes (best of {2})'.format(
+            args.videos, args.codes, args.repeat))
+        print('  no cache:        {0:8.1f} ms'.format(uncached * 1000))
+        print('  cold (writes):   {0:8.1f} ms'.format(cold_time * 1000))
+        print('  warm (cached):   {0:8.1f} ms'.format(warm_time * 1000))
+    finally:
+        shutil.rmtree(root)
+
+def make_obslist(ethogram, n_rows, seed=0):
+    """
+    Make a list of n_rows observations of random codes from an ethogram, at
+    increasing times.
+    """
+    rng = random.Random(seed)
+    symbols = sorted(ethogram.codes)
+    obslist = []
+    time_now = 0.0
+    for ind in xrange(n_rows):
+        time_now += rng.expovariate(1.0)
+        obs = ethogram.parse_entry(rng.choice(symbols))
+        obs['time'] = round(time_now, 3)
+        obslist.append(obs)
+    return obslist
+
+def bench_compression(args):
+    # Bytes read from a slow share dominate loading, so the time over a disk
+    # of the given bandwidth is modeled as the time to load from the page
+    # cache plus the time to move the file's bytes
+    root = tempfile.mkdtemp(prefix='tbbench')
+    try:
+        project_file = make_project(root, args.files, 100)
+        project = tbdatamodel.Project(project_file)
+        obslists = [make_obslist(project.ethogram, args.rows, seed)
+                    for seed in xrange(args.files)]
+        pairs = [(videofile, 'bm') for videofile in project.video_files]
+        bandwidth = args.bandwidth * 1e6
+        print('compression: {0} files of {1} rows (best of {2}, {3} MB/s '
+              'disk)'.format(args.files, args.rows, args.repeat,
+                             args.bandwidth))
+        for compression in tbdatamodel.obs_compressions:
+            project.obs_compression = compression
+            def save():
+                for (videofile,observer),obslist in zip(pairs, obslists):
+                    project.save_obslist(videofile, observer, obslist)
+            def load():
+                for videofile,observer in pairs:
+                    project.load_obs_from_file(videofile, observer)
+            save_time = time_call(save, args.repeat)
+            load_time = time_call(load, args.repeat)
+            n_bytes = sum(os.path.getsize(project.get_obsfile(*pair))
+                          for pair in pairs)
+            print('  {0:5} {1:10d} bytes  save {2:8.1f} ms  load {3:8.1f} ms'
+                  '  load over disk {4:8.1f} ms'.format(
+                      compression, n_bytes, save_time * 1000,
+                      load_time * 1000,
+                      (load_time + n_bytes / bandwidth) * 1000))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    commands = parser.add_subparsers()
+    startup = commands.add_parser('startup',
+                                  help='project loading with and without '
+                                       'the startup cache')
+    startup.add_argument('--videos', type=int, default=20000)
+    startup.add_argument('--codes', type=int, default=1000)
+    startup.add_argument('--repeat', type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+    compression = commands.add_parser('compression',
+                                      help='saving and loading observations '
+                                           'with and without compression')
+    compression.add_argument('--files', type=int, default=50)
+    compression.add_argument('--rows', type=int, default=5000)
+    compression.add_argument('--bandwidth', type=float, default=2.0,
+                             help='simulated disk bandwidth, in MB/s')
+    compression.add_argument('--repeat', type=int, default=3)
+    compression.set_defaults(func=bench_compression)
+    args = parser.parse_args()
+    args.func(args)
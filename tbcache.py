@@ -0,0 +1,272 @@
+"""
+A cache of derived analysis results (transition counts, time budgets and the
+like), so that an analysis of files that have not changed since the last run
+does not have to be computed again.
+
+Each result is stored under a key made from the contents of the files it was
+computed from (eg, an observation file and the ethogram file) and the
+parameters of the computation, so it is found again whatever the files'
+names or modification times, and never found once their contents change.
+The cache lives in <project-root>/.tinbergen/artifacts, holds at most
+max_bytes of results, and forgets the least recently used ones first.
+
+Example:
+    cache = ArtifactCache.for_project(project)
+    key = cache.key('transitions', [obsfile, project.ethogram_file], lags)
+    counts = cache.get(key)
+    if counts is None:
+        counts = compute_transitions(obsfile, lags)
+        cache.put(key, counts)
+        cache.evict()
+    print(cache.stats())
+
+Results are pickled; writes go to a temporary file that is then renamed, so
+several processes may share a cache, and a reader never sees half a result.
+"""
+
+import os
+import errno
+import hashlib
+import cPickle as pickle
+
+cache_version = 1
+default_max_bytes = 256 << 20
+
+def file_digest(path, block_size=1 << 20):
+    """
+    The SHA-1 hex digest of a file's contents.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            digest.update(block)
+            block = f.read(block_size)
+    return digest.hexdigest()
+
+def canonical(params):
+    """
+    A string describing params (made of dicts, lists, tuples, sets, strings
+    and numbers) that is the same for equal params, whatever the order of
+    their dicts and sets.
+    """
+    return repr(_canonical(params))
+
+def _canonical(obj):
+    if isinstance(obj, dict):
+        return ('dict', tuple(sorted((_canonical(key), _canonical(value))
+                                     for key,value in obj.items())))
+    if isinstance(obj, (set, frozenset)):
+        return ('set', tuple(sorted(_canonical(item) for item in obj)))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_canonical(item) for item in obj)
+    if isinstance(obj, float):
+        return repr(obj)
+    return obj
+
+class ArtifactCache(object):
+    """
+    A size-bounded store of pickled results in cache_dir, by key. get and
+    put count hits, misses and writes, and evict counts the results it
+    removes; see stats.
+    
+    The digests of input files are remembered by path, size and modification
+    time (in cache_dir/digests.pickle, once save_digests is called), so that
+    a rerun over unchanged files does not have to read them again to find
+    their keys.
+    """
+    def __init__(self, cache_dir, max_bytes=default_max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.__digests = None
+        self.__digests_changed = False
+    
+    @classmethod
+    def for_project(cls, project, max_bytes=default_max_bytes):
+        """
+        The cache of a project, in <project-root>/.tinbergen/artifacts.
+        """
+        return cls(project.join_cache_path('artifacts'), max_bytes)
+    
+    def key(self, name, paths, params=None):
+        """
+        The key of the result called name, computed from the files in paths
+        with params (see canonical).
+        """
+        digest = hashlib.sha1()
+        digest.update('{0}\0{1}\0'.format(cache_version, name))
+        for path in paths:
+            digest.update(self.digest(path) + '\0')
+        digest.update(canonical(params))
+        return digest.hexdigest()
+    
+    def digest(self, path):
+        """
+        The digest of a file's contents (see file_digest), remembered for as
+        long as its size and modification time stay the same.
+        """
+        if self.__digests is None:
+            self.__digests = self.__load_digests()
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime)
+        known = self.__digests.get(path)
+        if known is not None and known[0] == signature:
+            return known[1]
+        digest = file_digest(path)
+        self.__digests[path] = (signature, digest)
+        self.__digests_changed = True
+        return digest
+    
+    def save_digests(self):
+        """
+        Save the digests found by key and digest for the next run.
+        """
+        if not self.__digests_changed:
+            return
+        try:
+            self.__write(os.path.join(self.cache_dir, 'digests.pickle'),
+                         self.__digests)
+        except EnvironmentError:
+            # Only an optimization; the files are just read again next time
+            return
+        self.__digests_changed = False
+    
+    def path(self, key):
+        """
+        The file that holds (or would hold) the result with a key.
+        """
+        return os.path.join(self.cache_dir, key[:2], key + '.pickle')
+    
+    def get(self, key, default=None):
+        """
+        Get the result stored under key, or default if there is none.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except IOError:
+            self.misses += 1
+            return default
+        except (EOFError, pickle.UnpicklingError, ValueError):
+            # Damaged (which a rename should rule out) or from an
+            # incompatible version; drop it
+            self.__remove(path)
+            self.misses += 1
+            return default
+        # The modification time marks when a result was last used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+    
+    def put(self, key, value):
+        """
+        Store a result under key. The cache may then be larger than
+        max_bytes until evict is called.
+        """
+        self.__write(self.path(key), value)
+        self.writes += 1
+    
+    def get_or_compute(self, name, paths, params, compute):
+        """
+        Get the result called name for the files in paths and params, calling
+        compute() to make it (and storing it) if it is not in the cache.
+        """
+        key = self.key(name, paths, params)
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+            self.evict()
+        return value
+    
+    def evict(self):
+        """
+        Remove the least recently used results until the cache holds at most
+        max_bytes. Returns the number of results removed.
+        """
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            if dirpath == self.cache_dir:
+                # Only the digests are kept at the top level
+                continue
+            for filename in filenames:
+                if not filename.endswith('.pickle'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.__remove(path)
+            total -= size
+            removed += 1
+        self.evictions += removed
+        return removed
+    
+    def clear(self):
+        """
+        Remove every stored result.
+        """
+        max_bytes = self.max_bytes
+        self.max_bytes = -1
+        try:
+            self.evict()
+        finally:
+            self.max_bytes = max_bytes
+    
+    def stats(self):
+        """
+        The counts of hits, misses, writes and evictions so far, as a dict.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'writes': self.writes, 'evictions': self.evictions}
+    
+    def __load_digests(self):
+        try:
+            with open(os.path.join(self.cache_dir, 'digests.pickle'),
+                      'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError):
+            return dict()
+    
+    def __write(self, path, value):
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                # Another process may have made it first
+                if e.errno != errno.EEXIST:
+                    raise
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, path)
+        except:
+            self.__remove(temp_path)
+            raise
+    
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,106 @@
+"""
+Conversion of a project's observation files, and their numbered backups,
+between plain and compressed storage. Which way new files are saved is set by
+the obs-compression line of the project file (see example.tbproj); files are
+read either way, so a project can be converted before or after changing it.
+
+Usage from the command line:
+    python tbcompress.py project.tbproj gzip|none [--no-backups]
+Prints the number of files converted and their total size before and after.
+"""
+
+import os
+import sys
+import shutil
+import collections
+import tbdatamodel
+
+ConversionSummary = collections.namedtuple('ConversionSummary',
+                                           ['converted', 'unchanged',
+                                            'bytes_before', 'bytes_after'])
+
+def find_obsfiles(project, backups=True):
+    """
+    Find every observation file under a project's project_root (with
+    backups, their numbered backups too), whether or not its video is still
+    in the project. Returns a sorted list of paths.
+    """
+    paths = []
+    top = project.join_project_path()
+    for dirpath, dirnames, filenames in os.walk(top):
+        # Leave out hidden directories, such as the project's cache
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for filename in filenames:
+            name = filename
+            stem, sep, suffix = filename.rpartition('.')
+            if suffix.isdigit():
+                if not backups:
+                    continue
+                name = stem
+            if tbdatamodel.split_obsfile_name(name) is not None:
+                paths.append(os.path.join(dirpath, filename))
+    paths.sort()
+    return paths
+
+def convert_obsfile(path, compression):
+    """
+    Rewrite an observation file as compression says (one of
+    tbdatamodel.obs_compressions), keeping its modification time, so that
+    revision histories keep their dates. Returns the sizes of the file
+    before and after, or None if it was already stored that way.
+    """
+    if tbdatamodel.is_compressed(path) == (compression != 'none'):
+        return None
+    data = tbdatamodel.read_obs_data(path)
+    stat = os.stat(path)
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with tbdatamodel.create_obsfile(temp_path, compression) as f:
+            f.write(data)
+        shutil.copymode(path, temp_path)
+        os.utime(temp_path, (stat.st_atime, stat.st_mtime))
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return stat.st_size, os.path.getsize(path)
+
+def convert_project(project, compression, backups=True):
+    """
+    Convert every observation file in a project (see find_obsfiles) as
+    compression says. Returns a ConversionSummary: the numbers of files
+    converted and left as they were, and the total size of the converted
+    files before and after.
+    """
+    converted = unchanged = bytes_before = bytes_after = 0
+    for path in find_obsfiles(project, backups):
+        sizes = convert_obsfile(path, compression)
+        if sizes is None:
+            unchanged += 1
+        else:
+            converted += 1
+            bytes_before += sizes[0]
+            bytes_after += sizes[1]
+    return ConversionSummary(converted, unchanged, bytes_before, bytes_after)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Compress or decompress stored observations.')
+    parser.add_argument('project_file')
+    parser.add_argument('compression', choices=tbdatamodel.obs_compressions)
+    parser.add_argument('--no-backups', dest='backups', action='store_false',
+                        help='leave numbered backups as they are')
+    args = parser.parse_args()
+    project = tbdatamodel.Project(args.project_file, scan_videos=False)
+    summary = convert_project(project, args.compression, args.backups)
+    sys.stderr.write('{0} file(s) converted ({1} already {2}): {3} bytes '
+                     'before, {4} after\n'.format(
+                         summary.converted, summary.unchanged,
+                         args.compression, summary.bytes_before,
+                         summary.bytes_after))
+    if project.obs_compression != args.compression:
+        sys.stderr.write('Note: the project file still says obs-compression: '
+                         '{0}, so new saves will not match\n'.format(
+                             project.obs_compression))
@@ -25,9 +25,24 @@ observations.
 
 import re
 import os
+import io
 import glob
+import gzip
+import errno
+import atexit
+import shutil
+import tempfile
+import mmap
+import array
+import struct
+import bisect
+import heapq
+import fractions
+import cPickle as pickle
 import collections
+import itertools
 import operator
+import warnings
 
 observation_kinds = ('moment', 'state', 'binary', 'variable')
 binary_values = ('True', 'False')
@@ -35,6 +50,10 @@ movie_suffixes = ('mp4', 'mov', 'mts', 'm4v', 'avi', 'mpg')
 file_suffixes = {'ethogram': 'tbethogram',
                  'project': 'tbproject',
                  'observation': 'tbobs'}
+write_buffer_size = 1 << 16
+# Ways observation files can be stored; see create_obsfile
+obs_compressions = ('none', 'gzip')
+gzip_magic = '\x1f\x8b'
 
 def append_obs_suffix(filename):
     """
@@ -42,6 +61,440 @@ def append_obs_suffix(filename):
     """
     return filename + '.' + file_suffixes['observation']
 
+def is_video_file(filename):
+    """
+    Check whether a file name (without its directory) looks like a movie file,
+    based on its suffix. Hidden files are never movie files.
+    """
+    # Is there a better way to get file suffixes? This will yield false
+    # positives for files named, eg, "mp4". Not ever going to happen, so not
+    # worth special-casing, but irritating.
+    # PS, if you're reading this because it did happen, sorry!
+    suffix = filename.split('.')[-1]
+    return filename[0]!='.' and suffix.lower() in movie_suffixes
+
+def split_obsfile_name(obspath):
+    """
+    Split the path of an observation file, "path/to/video.ext.<osr>.tbobs",
+    into the video path and observer code, ("path/to/video.ext", "<osr>").
+    Returns None if the path does not name an observation file.
+    """
+    dirname, filename = os.path.split(obspath)
+    if filename.startswith('.'):
+        return None
+    stem, sep, suffix = filename.rpartition('.')
+    if suffix != file_suffixes['observation']:
+        return None
+    videoname, sep, observer = stem.rpartition('.')
+    if not videoname or not observer:
+        return None
+    return os.path.join(dirname, videoname), observer
+
+def list_backups(obsfile):
+    """
+    Get the numbered backups of an observation file (made by
+    Project.save_obslist), as a list of (N, path) pairs sorted by N. Files
+    whose suffix is not a number are ignored.
+    """
+    dirname, filename = os.path.split(obsfile)
+    backups = []
+    if not os.path.isdir(dirname or '.'):
+        return backups
+    for name in os.listdir(dirname or '.'):
+        stem, sep, suffix = name.rpartition('.')
+        if stem == filename and suffix.isdigit():
+            backups.append((int(suffix), os.path.join(dirname, name)))
+    backups.sort()
+    return backups
+
+def frame_rate(rate):
+    """
+    Get a frame rate as an exact fractions.Fraction of frames per second. rate
+    may be a Fraction, a gst.Fraction (or anything with num and denom), a
+    number, or a string like "30000/1001" or "29.97". Inexact rates within
+    .001 of an NTSC rate (N*1000/1001, eg 29.97 or 23.976) are taken to be
+    that rate.
+    """
+    if isinstance(rate, fractions.Fraction):
+        return rate
+    if hasattr(rate, 'num') and hasattr(rate, 'denom'):
+        return fractions.Fraction(rate.num, rate.denom)
+    if isinstance(rate, (int, long)):
+        return fractions.Fraction(rate)
+    if isinstance(rate, str) and '/' in rate:
+        return fractions.Fraction(rate.strip())
+    rate = fractions.Fraction(str(rate).strip())
+    if rate.denominator == 1:
+        return rate
+    ntsc = fractions.Fraction(int(round(rate * 1001 / 1000)) * 1000, 1001)
+    if abs(ntsc - rate) < fractions.Fraction(1, 1000):
+        return ntsc
+    return rate.limit_denominator(1001)
+
+def time_to_frame(time, rate):
+    """
+    The number of the video frame (counting from 0) nearest to a time in
+    seconds, at a frame rate given as for frame_rate. time may be a number or
+    a decimal string, as stored in observation files. Raises ValueError if
+    time is not a finite number (eg, nan).
+    """
+    rate = frame_rate(rate)
+    if isinstance(time, str):
+        time = time.strip()
+    try:
+        exact = fractions.Fraction(time)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('No frame for time {0!r}'.format(time))
+    return int((exact * rate + fractions.Fraction(1, 2)) // 1)
+
+def frame_to_time(frame, rate):
+    """
+    The start time in seconds of a video frame, as the float nearest to the
+    exact time frame / rate.
+    """
+    rate = frame_rate(rate)
+    return float(fractions.Fraction(int(frame) * rate.denominator,
+                                    rate.numerator))
+
+def walk_with_mtimes(top):
+    """
+    Walk a directory tree top-down, like os.walk, yielding a tuple
+    (dirpath, mtime, filenames) for each directory. mtime is the directory's
+    modification time, taken before it is listed, so a change made while
+    walking will always show up as a newer modification time later.
+    """
+    try:
+        mtime = os.stat(top).st_mtime
+        names = os.listdir(top)
+    except OSError:
+        return
+    dirnames, filenames = [], []
+    for name in names:
+        if os.path.isdir(os.path.join(top, name)):
+            dirnames.append(name)
+        else:
+            filenames.append(name)
+    yield top, mtime, filenames
+    for name in dirnames:
+        path = os.path.join(top, name)
+        if not os.path.islink(path):
+            for entry in walk_with_mtimes(path):
+                yield entry
+
+def is_compressed(path):
+    """
+    Tell whether an observation file is stored compressed.
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(gzip_magic)) == gzip_magic
+
+def read_obs_data(path):
+    """
+    Get the whole text of an observation file, decompressed if need be.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(gzip_magic)) == gzip_magic:
+            f.seek(0)
+            return gzip.GzipFile(fileobj=f, mode='rb').read()
+        f.seek(0)
+        return f.read()
+
+def open_obsfile(path):
+    """
+    Open an observation file (or a backup of one) for reading its lines.
+    Compressed files keep the names of plain ones, and are recognized by
+    their contents instead, so this works for either.
+    """
+    f = open(path, 'rb')
+    if f.read(len(gzip_magic)) != gzip_magic:
+        f.seek(0)
+        return f
+    # Decompressing in one go is much quicker than reading a GzipFile line
+    # by line
+    try:
+        f.seek(0)
+        return io.BytesIO(gzip.GzipFile(fileobj=f, mode='rb').read())
+    finally:
+        f.close()
+
+class _GzipObsFile(gzip.GzipFile):
+    """
+    A GzipFile writing to a new file of its own, which it closes when it is
+    closed. The header holds neither a file name nor a timestamp.
+    """
+    def __init__(self, path):
+        self.__raw = open(path, 'wb')
+        gzip.GzipFile.__init__(self, filename='', fileobj=self.__raw,
+                               mode='wb', compresslevel=6, mtime=0)
+    
+    def close(self):
+        try:
+            gzip.GzipFile.close(self)
+        finally:
+            self.__raw.close()
+
+def create_obsfile(path, compression='none'):
+    """
+    Open a new observation file for writing, stored as compression says (one
+    of obs_compressions). Compressed files are written in gzip format, with
+    no file name or timestamp, so that the same observations always give the
+    same bytes, whatever the path they are written to.
+    """
+    if compression == 'gzip':
+        return _GzipObsFile(path)
+    elif compression == 'none':
+        return open(path, 'w', write_buffer_size)
+    raise ValueError('Unknown observation file compression: ' +
+                     repr(compression))
+
+def read_obsfile(path):
+    """
+    Read the observations from a .tbobs file, as a list of dict objects. See
+    Project.load_obs_from_file.
+    """
+    obslist = []
+    with open_obsfile(path) as f:
+        for line in f:
+            head,sep,tail = line.partition(':')
+            head = head.strip()
+            tail = tail.strip()
+            if head=='obs':
+                obs_dict = parse_keyvals(tail)
+                obslist.append(obs_dict)
+    return obslist
+
+# A saved version of an observation file; see Project.list_revisions
+Revision = collections.namedtuple('Revision',
+                                  ['number', 'path', 'mtime', 'current'])
+# The differences between two observation sets; see diff_obslists
+ObsDiff = collections.namedtuple('ObsDiff', ['added', 'removed', 'edited'])
+
+def sorted_obs_rows(obslist):
+    """
+    Sort a list of observations for comparison, as a list of (time, entry,
+    obs) tuples in order of time and entry. Observations without a numeric
+    time go last.
+    """
+    rows = []
+    for obs in obslist:
+        try:
+            time = float(obs.get('time'))
+        except (TypeError, ValueError):
+            time = float('inf')
+        rows.append((time, obs.get('entry', ''), obs))
+    rows.sort(key=operator.itemgetter(0, 1))
+    return rows
+
+def diff_obslists(old, new):
+    """
+    Compare two lists of observations. Returns an ObsDiff of three lists:
+    added and removed, the observations only in new or only in old, and
+    edited, (old_obs, new_obs) pairs of observations at the same time which
+    differ. Observations at the same time are first paired by entry, and
+    any left over are paired in order as edits.
+    """
+    return diff_sorted_rows(sorted_obs_rows(old), sorted_obs_rows(new))
+
+def diff_sorted_rows(old_rows, new_rows):
+    """
+    diff_obslists for rows already sorted by sorted_obs_rows, in a single
+    merge pass over both.
+    """
+    added = []
+    removed = []
+    edited = []
+    i = j = 0
+    while i < len(old_rows) or j < len(new_rows):
+        if j == len(new_rows) or (i < len(old_rows) and
+                                  old_rows[i][0] < new_rows[j][0]):
+            removed.append(old_rows[i][2])
+            i += 1
+            continue
+        if i == len(old_rows) or new_rows[j][0] < old_rows[i][0]:
+            added.append(new_rows[j][2])
+            j += 1
+            continue
+        # Gather every row at this time in both lists
+        time = old_rows[i][0]
+        i_end = i
+        while i_end < len(old_rows) and old_rows[i_end][0] == time:
+            i_end += 1
+        j_end = j
+        while j_end < len(new_rows) and new_rows[j_end][0] == time:
+            j_end += 1
+        old_left = []
+        new_left = []
+        # Both groups are sorted by entry, so pair them with another merge
+        while i < i_end and j < j_end:
+            if old_rows[i][1] < new_rows[j][1]:
+                old_left.append(old_rows[i][2])
+                i += 1
+            elif new_rows[j][1] < old_rows[i][1]:
+                new_left.append(new_rows[j][2])
+                j += 1
+            else:
+                if old_rows[i][2] != new_rows[j][2]:
+                    edited.append((old_rows[i][2], new_rows[j][2]))
+                i += 1
+                j += 1
+        old_left.extend(row[2] for row in old_rows[i:i_end])
+        new_left.extend(row[2] for row in new_rows[j:j_end])
+        i, j = i_end, j_end
+        n_paired = min(len(old_left), len(new_left))
+        edited.extend(zip(old_left[:n_paired], new_left[:n_paired]))
+        removed.extend(old_left[n_paired:])
+        added.extend(new_left[n_paired:])
+    return ObsDiff(added, removed, edited)
+
+# One observation applied during a replay; see replay_observations
+ReplayEvent = collections.namedtuple('ReplayEvent',
+                                     ['time', 'source', 'name', 'value',
+                                      'state'])
+# The observations at one time in a lockstep replay; see replay_lockstep
+LockstepEvent = collections.namedtuple('LockstepEvent',
+                                       ['time', 'changes', 'states'])
+
+def obs_time(obs):
+    """
+    The time of an observation as a float, or nan if it has no valid time.
+    """
+    try:
+        return float(obs.get('time'))
+    except (TypeError, ValueError):
+        return float('nan')
+
+def obs_entry(obs):
+    """
+    The entry of an observation as a string, or '' if it has none. An entry
+    containing a comma is read back from file as a tuple (see parse_keyvals),
+    whose parts are joined together again.
+    """
+    entry = obs.get('entry', '')
+    if isinstance(entry, (tuple, list)):
+        return ','.join(entry)
+    return str(entry)
+
+def iter_time_order(obslist, source=0):
+    """
+    Iterate over an observation set in order of time, as (time, source, row,
+    obs) tuples, where row is the observation's index in obslist. Rows with
+    the same time keep their order, and rows with no valid time are left out.
+    A set that is already in order (as saved sets usually are) is read one
+    row at a time, so a LazyObsFile is only parsed as far as the iteration
+    goes; otherwise the rows are sorted by time first.
+    """
+    times = getattr(obslist, 'times', None)
+    if times is None:
+        time_of = lambda row: obs_time(obslist[row])
+    else:
+        time_of = times.__getitem__
+    in_order = True
+    last = float('-inf')
+    for row in xrange(len(obslist)):
+        time = time_of(row)
+        if time < last:
+            in_order = False
+            break
+        if time == time:
+            last = time
+    if in_order:
+        rows = xrange(len(obslist))
+    else:
+        rows = sorted((row for row in xrange(len(obslist))
+                       if time_of(row) == time_of(row)), key=time_of)
+    for row in rows:
+        time = time_of(row)
+        if time == time:
+            yield time, source, row, obslist[row]
+
+def initial_state(ethogram, initial=None):
+    """
+    The state of every state, binary and variable behavior of an ethogram
+    before any observations, as a dict of values. initial optionally maps
+    behavior names to their starting values; otherwise binary behaviors start
+    out 'False', and the others start out unknown (None).
+    """
+    if initial is None:
+        initial = dict()
+    state = dict()
+    for name,behavior in ethogram.behaviors.items():
+        if behavior['kind'] == 'moment':
+            continue
+        if name in initial:
+            state[name] = initial[name]
+        elif behavior['kind'] == 'binary':
+            state[name] = 'False'
+        else:
+            state[name] = None
+    return state
+
+def replay_observations(ethogram, obslists, initial=None):
+    """
+    Walk through one or more observation sets together in order of time,
+    keeping the current value of every behavior. obslists is a list of
+    observation sets (lists of dicts, or LazyObsFile objects), which are
+    merged lazily, so that only one row of each is held at a time; rows at
+    the same time come in order of set and then row. Yields a ReplayEvent
+    for each observation of a behavior in the ethogram:
+        time:   the time of the observation
+        source: the index in obslists of its set
+        name:   the behavior observed
+        value:  the value observed (None for a moment without one)
+        state:  the value of every state, binary and variable behavior just
+                after this observation, as a read-only mapping
+    state is the same mapping on every event, and changes as the replay goes
+    on; copy it with dict(event.state) to keep it. Moment behaviors have no
+    state, so their events leave it as it was. See initial_state for the
+    values before the first observation.
+    """
+    state = initial_state(ethogram, initial)
+    view = DictViewer(state)
+    kinds = dict((name, behavior['kind'])
+                 for name,behavior in ethogram.behaviors.items())
+    rows = heapq.merge(*[iter_time_order(obslist, source)
+                         for source,obslist in enumerate(obslists)])
+    for time, source, row, obs in rows:
+        name = obs.get('name')
+        if name not in kinds:
+            continue
+        value = obs.get('value')
+        if kinds[name] != 'moment':
+            state[name] = value
+        yield ReplayEvent(time, source, name, value, view)
+
+def replay_lockstep(ethogram, obslists, initial=None):
+    """
+    Walk through several observation sets side by side in order of time (eg,
+    the sets of different observers for one video), keeping a separate
+    state for each. Yields a LockstepEvent for each time at which any set has
+    an observation:
+        time:    the time
+        changes: the observations at that time, as a list of (source, name,
+                 value) tuples, source being an index into obslists
+        states:  a tuple holding the state of each set after those
+                 observations, as in replay_observations
+    The states are updated in place as the replay goes on, as in
+    replay_observations.
+    """
+    states = [initial_state(ethogram, initial) for obslist in obslists]
+    views = tuple(DictViewer(state) for state in states)
+    kinds = dict((name, behavior['kind'])
+                 for name,behavior in ethogram.behaviors.items())
+    rows = heapq.merge(*[iter_time_order(obslist, source)
+                         for source,obslist in enumerate(obslists)])
+    for time, group in itertools.groupby(rows, operator.itemgetter(0)):
+        changes = []
+        for _, source, row, obs in group:
+            name = obs.get('name')
+            if name not in kinds:
+                continue
+            value = obs.get('value')
+            if kinds[name] != 'moment':
+                states[source][name] = value
+            changes.append((source, name, value))
+        if changes:
+            yield LockstepEvent(time, changes, views)
+
 def dictlist_lookup(dictlist, key, value):
     """
     From a list of dicts, retrieve those elements for which <key> is <value>.
@@ -68,15 +521,46 @@ class Project(object):
     Once created, saving any subsequent observations will move the original
     observation file to video.ext.<osr>.tbobs.N, where N begins at 1 and
     increments every time.
+    
+    With "obs-compression: gzip" in the project file, observation files are
+    saved compressed (see create_obsfile), under the same names. Compressed
+    and plain files can be read either way, and may be mixed in a project.
+    
+    With use_cache=True, the parsed ethogram and the video list are saved in
+    <project-root>/.tinbergen/startup.pickle, and later reused as long as the
+    ethogram file and every directory under <video-root> are unchanged
+    (judged by modification time, and size for the ethogram).
+    
+    catalog holds the same videos as video_files, arranged by directory. Its
+    counts of videos with observations are only kept once the observer index
+    has been built (see build_observer_index).
+    
+    With scan_videos=False, video_files is left empty (unless it comes from
+    the cache) so that the caller can run update_video_list later, for
+    example in another thread. videos_scanned tells whether the video list
+    has been filled in.
     """
-    def __init__(self, project_filename):
+    startup_cache_version = 1
+    
+    def __init__(self, project_filename, use_cache=False, scan_videos=True):
         project_file_dir = os.path.dirname(project_filename)
         self.__project_root = ''
         self.__video_root = ''
         self.cur_file = ''
         self.__ethogram_file = ''
+        self.obs_compression = 'none'
         self.observers = []
         self.video_files = []
+        self.__catalog = None
+        self.__observer_index = None
+        # Functions called as f(videofile, observer, obslist) after each
+        # save_obslist
+        self.save_listeners = []
+        # Modification time of each directory under video_root, as of the
+        # last update_video_list
+        self.__video_dir_mtimes = dict()
+        self.__use_cache = use_cache
+        self.videos_scanned = False
         with open(project_filename) as project_file:
             for line in project_file:
                 head,sep,tail = line.partition(':')
@@ -98,9 +582,65 @@ class Project(object):
                     self.__ethogram_file = new_path
                 elif head=='observer':
                     self.observers.append(parse_keyvals(tail))
+                elif head=='obs-compression':
+                    if tail in obs_compressions:
+                        self.obs_compression = tail
+                    else:
+                        warnings.warn('Unknown obs-compression {0!r} in {1}; '
+                                      'saving uncompressed'.format(
+                                          tail, project_filename),
+                                      RuntimeWarning)
+        if use_cache and self.__load_startup_cache():
+            return
         with open(self.__ethogram_file) as f:
             self.ethogram = Ethogram.new_from_file(f)
-        self.update_video_list()
+        if scan_videos:
+            self.update_video_list()
+    
+    def __startup_signature(self):
+        stat = os.stat(self.__ethogram_file)
+        return (self.startup_cache_version, self.__video_root,
+                self.__ethogram_file, stat.st_mtime, stat.st_size)
+    
+    def __load_startup_cache(self):
+        # Restore the ethogram and video list from the startup cache, if it
+        # is still valid. Returns True if it was used.
+        try:
+            with open(self.join_cache_path('startup.pickle'), 'rb') as f:
+                cached = pickle.load(f)
+            if cached['signature'] != self.__startup_signature():
+                return False
+            for dirpath,mtime in cached['video_dir_mtimes'].items():
+                if os.stat(dirpath).st_mtime != mtime:
+                    return False
+        except (IOError, OSError, EOFError, KeyError, TypeError,
+                pickle.UnpicklingError, AttributeError, ImportError):
+            return False
+        self.ethogram = cached['ethogram']
+        self.video_files = cached['video_files']
+        self.__video_dir_mtimes = cached['video_dir_mtimes']
+        self.videos_scanned = True
+        return True
+    
+    def __save_startup_cache(self):
+        cached = {'signature': self.__startup_signature(),
+                  'ethogram': self.ethogram,
+                  'video_files': self.video_files,
+                  'video_dir_mtimes': self.__video_dir_mtimes}
+        cache_file = self.join_cache_path('startup.pickle')
+        temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        try:
+            cache_dir = os.path.dirname(cache_file)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with open(temp_file, 'wb') as f:
+                pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_file, cache_file)
+        except (IOError, OSError):
+            # The cache is only an optimization (and project-root may not be
+            # writable)
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
     
     def get_observer_name(self, code):
         """
@@ -116,35 +656,149 @@ class Project(object):
         matches = [el for el in self.observers if el.get('name')==name]
         return matches[0]['code']
     
-    def update_video_list(self):
+    @property
+    def catalog(self):
+        """
+        The videos of video_files arranged by directory, as a VideoCatalog.
+        Built on first use, and kept up to date from then on.
+        """
+        if self.__catalog is None:
+            self.__catalog = VideoCatalog(self.video_files,
+                                          self.__observed_videos())
+        return self.__catalog
+    
+    def update_video_list(self, batch_callback=None, batch_size=500):
         """
         Check the file system again for files descending from video_root.
+        
+        If batch_callback is given, it is called with a list of each further
+        batch_size videos as they are found, so that they can be shown before
+        the whole tree has been walked. video_files itself is only replaced
+        once the walk is complete.
         """
         full_list = []
-        walker = os.walk(self.__video_root)
-        for directory_entry in walker:
-            subdir = self.rel_video_path(directory_entry[0])
-            for dir_file in directory_entry[-1]:
-                # Is there a better way to get file suffixes? This will yield
-                # false positives for files named, eg, "mp4". Not ever going to
-                # happen, so not worth special-casing, but irritating.
-                # PS, if you're reading this because it did happen, sorry!
-                suffix = dir_file.split('.')[-1]
-                if dir_file[0]!='.' and suffix.lower() in movie_suffixes:
+        dir_mtimes = dict()
+        batch = []
+        for dirpath,mtime,filenames in walk_with_mtimes(self.__video_root):
+            dir_mtimes[dirpath] = mtime
+            subdir = self.rel_video_path(dirpath)
+            for dir_file in filenames:
+                if is_video_file(dir_file):
                     full_list.append(os.path.join(subdir, dir_file))
+                    if batch_callback is not None:
+                        batch.append(full_list[-1])
+                        if len(batch) >= batch_size:
+                            batch_callback(batch)
+                            batch = []
+        if batch:
+            batch_callback(batch)
         self.video_files = full_list
+        self.__catalog = None
+        self.__video_dir_mtimes = dir_mtimes
+        self.videos_scanned = True
+        if self.__use_cache:
+            self.__save_startup_cache()
+    
+    def add_video_file(self, videofile):
+        """
+        Add a single video (relative to video_root) to video_files, without
+        checking the rest of the file system.
+        """
+        if videofile not in self.video_files:
+            self.video_files.append(videofile)
+        if self.__catalog is not None:
+            self.__catalog.add_video(videofile)
+    
+    def remove_video_file(self, videofile):
+        """
+        Remove a single video (relative to video_root) from video_files.
+        """
+        if videofile in self.video_files:
+            self.video_files.remove(videofile)
+        if self.__catalog is not None:
+            self.__catalog.remove_video(videofile)
+    
+    def find_observers(self):
+        """
+        Find every observation file under project_root in one pass, without
+        changing the project. Returns a dict mapping video files to sets of
+        observer codes, as build_observer_index takes it.
+        """
+        index = dict()
+        for dirpath, dirnames, filenames in os.walk(self.__project_root):
+            subdir = self.rel_project_path(dirpath)
+            for filename in filenames:
+                split = split_obsfile_name(os.path.join(subdir, filename))
+                if split is not None:
+                    index.setdefault(split[0], set()).add(split[1])
+        return index
+    
+    def build_observer_index(self, index=None):
+        """
+        Find every observation file under project_root in one pass, and from
+        then on answer get_video_observers from memory. The index must then be
+        kept current with add_video_observer and remove_video_observer (see
+        tbwatch.ProjectWatcher), apart from files saved by save_obslist, which
+        are added automatically. index may be the result of an earlier
+        find_observers (eg, from another thread), to use instead of looking
+        again.
+        """
+        if index is None:
+            index = self.find_observers()
+        self.__observer_index = index
+        if self.__catalog is not None:
+            self.__catalog.clear_observed()
+            for videofile in self.__observed_videos():
+                self.__catalog.set_observed(videofile)
+    
+    def __observed_videos(self):
+        # Videos with observations, according to the observer index
+        if self.__observer_index is None:
+            return []
+        return [videofile for videofile,observers
+                in self.__observer_index.items() if observers]
+    
+    def add_video_observer(self, videofile, observer):
+        """
+        Record in the observer index that observer has stored observations
+        for videofile. Does nothing if there is no observer index.
+        """
+        if self.__observer_index is not None:
+            self.__observer_index.setdefault(videofile, set()).add(observer)
+            if self.__catalog is not None:
+                self.__catalog.set_observed(videofile)
+    
+    def remove_video_observer(self, videofile, observer):
+        """
+        Record in the observer index that observer no longer has stored
+        observations for videofile. Does nothing if there is no observer index.
+        """
+        if self.__observer_index is not None:
+            observers = self.__observer_index.get(videofile, set())
+            observers.discard(observer)
+            if self.__catalog is not None:
+                self.__catalog.set_observed(videofile, bool(observers))
     
     def get_video_observers(self, videoname):
         """
         Get all observers who have stored observations for a particular video.
         Returns a list of observer codes.
         """
+        if self.__observer_index is not None:
+            return sorted(self.__observer_index.get(videoname, ()))
         coders = []
         matchpattern = self.join_project_path(videoname) + '.*.tbobs'
         for obsfile in glob.glob(matchpattern):
             coders.append(obsfile.split('.')[-2])
         return coders
     
+    @property
+    def ethogram_file(self):
+        """
+        The path of the project's ethogram file.
+        """
+        return self.__ethogram_file
+    
     def join_project_path(self, *pargs):
         """
         Returns inputs joined to project_root with os.path.join
@@ -169,6 +823,24 @@ class Project(object):
         """
         return os.path.relpath(path, self.__video_root)
     
+    def join_cache_path(self, *pargs):
+        """
+        Returns inputs joined to the directory where Tinbergen keeps derived
+        data for the project, <project-root>/.tinbergen
+        """
+        return os.path.join(self.__project_root, '.tinbergen', *pargs)
+    
+    def list_obsfiles(self):
+        """
+        Get every stored observation set in the project, as a list of
+        (videofile, observer) pairs.
+        """
+        pairs = []
+        for videofile in self.video_files:
+            for observer in self.get_video_observers(videofile):
+                pairs.append((videofile, observer))
+        return pairs
+    
     def get_obsfile(self, videofile, observer):
         """
         Attaches ".<obs>.tbobs" to a path, where <obs> is the observer code.
@@ -187,7 +859,7 @@ class Project(object):
             filename = self.cur_file
         filepath = self.join_project_path(append_obs_suffix(filename))
         if os.path.exists(filepath):
-            with open(filepath, 'r') as f:
+            with open_obsfile(filepath) as f:
                 obs = ObservationSet.new_from_file(self.ethogram, f)
         else:
             obs = ObservationSet(self.ethogram, self.observer, filename)
@@ -204,22 +876,27 @@ class Project(object):
             'kind': one of 'moment', 'binary', 'state', 'variable'
             'name': the name of the observed behavior
             'value': for binary, state, or variable behaviors
+            'frame': optionally, the number of the video frame at 'time' (see
+                     time_to_frame), which identifies the moment exactly
         Other keys are also permitted.
         """
         if videofile is None or observer is None:
             return []
         obsfile = self.get_obsfile(videofile, observer)
-        obslist = []
         if os.path.exists(obsfile):
-            with open(obsfile, 'r') as f:
-                for line in f:
-                    head,sep,tail = line.partition(':')
-                    head = head.strip()
-                    tail = tail.strip()
-                    if head=='obs':
-                        obs_dict = parse_keyvals(tail)
-                        obslist.append(obs_dict)
-        return obslist
+            return read_obsfile(obsfile)
+        return []
+    
+    def open_obs_lazy(self, videofile, observer):
+        """
+        Like load_obs_from_file, but returns a LazyObsFile which parses
+        observations only as they are accessed. Returns None if there are no
+        stored observations for this video and observer.
+        """
+        obsfile = self.get_obsfile(videofile, observer)
+        if not obsfile or not os.path.exists(obsfile):
+            return None
+        return LazyObsFile(obsfile)
     
     def save_obslist(self, videofile, observer, obslist):
         """
@@ -230,30 +907,132 @@ class Project(object):
         If a file already exists at this location, it will first be renamed by
         adding a .N suffix, where N is a number that starts at 1 and increments
         every time.
+        
+        Observations that cannot be written (eg, because a key is not a string)
+        are left out of the file, and a warning is issued. Returns a list of
+        the indices in obslist of any such observations.
+        
+        The new file is written in full before the old one is renamed, so a
+        save that fails part way leaves the previous observations in place.
+        Once the file is written, each function in save_listeners is called
+        with videofile, observer and obslist.
         """
         observer_name = self.get_observer_name(observer)
         obsfile = self.get_obsfile(videofile, observer)
         obsdir = os.path.dirname(obsfile)
         if not os.path.exists(obsdir):
             os.makedirs(obsdir)
+        temp_path = '{0}.{1}.tmp'.format(obsfile, os.getpid())
+        try:
+            with create_obsfile(temp_path, self.obs_compression) as f:
+                f.write('observer: {0}\n'.format(observer_name))
+                f.write('source: {0}\n'.format(videofile))
+                skipped = write_obslist(f, obslist)
+            if os.path.exists(obsfile):
+                cur_backups = list_backups(obsfile)
+                backup_N = cur_backups[-1][0] + 1 if cur_backups else 1
+                backup_path = obsfile + '.' + str(backup_N)
+                os.rename(obsfile, backup_path)
+            os.rename(temp_path, obsfile)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.add_video_observer(videofile, observer)
+        if skipped:
+            warnings.warn('{0} malformed observation(s) not saved to {1}'
+                          .format(len(skipped), obsfile), RuntimeWarning)
+        for listener in self.save_listeners:
+            listener(videofile, observer, obslist)
+        return skipped
+    
+    def list_revisions(self, videofile, observer):
+        """
+        List the saved revisions of the observations for a video file and
+        observer, oldest first, as Revision tuples (number, path, mtime,
+        current). The numbered backups come first, and the current file last;
+        its number is the one it will have as a backup after the next save.
+        mtime is the time the revision was saved.
+        """
+        obsfile = self.get_obsfile(videofile, observer)
+        revisions = []
+        for number,path in list_backups(obsfile):
+            revisions.append(Revision(number, path, os.stat(path).st_mtime,
+                                      False))
         if os.path.exists(obsfile):
-            cur_backups = glob.glob(obsfile + '.*')
-            # This is terrible but will work for now
-            if len(cur_backups) == 0:
-                backup_N = 1
-            else:
-                backup_N = 1+max(int(s.rsplit('.',1)[-1]) for s in cur_backups)
-            backup_path = obsfile + '.' + str(backup_N)
-            os.rename(obsfile, backup_path)
-        with open(obsfile, 'w') as f:
-            f.write('observer: {0}\n'.format(observer_name))
-            f.write('source: {0}\n'.format(videofile))
-            for obs in obslist:
-                try:
-                    obsstr = as_keyvalstr(obs)
-                    f.write('obs: {0}\n'.format(obsstr))
-                except TypeError:
-                    pass
+            number = revisions[-1].number + 1 if revisions else 1
+            revisions.append(Revision(number, obsfile,
+                                      os.stat(obsfile).st_mtime, True))
+        return revisions
+    
+    def load_revision(self, videofile, observer, number=None):
+        """
+        Load one revision of the observations for a video file and observer
+        (by default, the current one), in order of time and entry. See
+        list_revisions.
+        """
+        return [row[2] for row in self.__revision_rows(videofile, observer,
+                                                       number)]
+    
+    def diff_revisions(self, videofile, observer, old=None, new=None):
+        """
+        Compare two revisions of the observations for a video file and
+        observer, by number (see list_revisions). By default, compares the
+        current revision with the one before it. Returns an ObsDiff; see
+        diff_obslists.
+        """
+        if new is None:
+            new = self.__find_revision(videofile, observer, None).number
+        if old is None:
+            old = new - 1
+        return diff_sorted_rows(self.__revision_rows(videofile, observer, old),
+                                self.__revision_rows(videofile, observer, new))
+    
+    def __find_revision(self, videofile, observer, number):
+        revisions = self.list_revisions(videofile, observer)
+        if not revisions:
+            raise KeyError('No observations for {0} by {1}'.format(
+                videofile, observer))
+        if number is None:
+            return revisions[-1]
+        for revision in revisions:
+            if revision.number == number:
+                return revision
+        raise KeyError('No revision {0} for {1} by {2}'.format(
+            number, videofile, observer))
+    
+    def __revision_rows(self, videofile, observer, number):
+        # The parsed rows of each revision are kept in a file of their own in
+        # the cache directory, named after the revision's path and checked
+        # against its modification time and size, so each revision is only
+        # parsed once, and reading one never means loading the others
+        revision = self.__find_revision(videofile, observer, number)
+        stat = os.stat(revision.path)
+        signature = (stat.st_mtime, stat.st_size)
+        cache_file = self.join_cache_path('revisions', self.rel_project_path(
+            revision.path) + '.pickle')
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            if isinstance(cached, tuple) and cached[0] == signature:
+                return cached[1]
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError):
+            pass
+        rows = sorted_obs_rows(read_obsfile(revision.path))
+        # Only an optimization, so the rows are returned even if they can't be
+        # saved
+        temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        try:
+            cache_dir = os.path.dirname(cache_file)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with open(temp_file, 'wb') as f:
+                pickle.dump((signature, rows), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_file, cache_file)
+        except (IOError, OSError):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        return rows
     
     def save_observations(self, obs):
         """
@@ -265,15 +1044,11 @@ class Project(object):
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
         if os.path.exists(filepath):
-            cur_backups = glob.glob(filepath + '.*')
-            # This is hacky and susceptible to bugs, but it might work for now
-            if len(cur_backups) == 0:
-                backup_N = 1
-            else:
-                backup_N = max(int(s.split('.')[-1]) for s in cur_backups) + 1
+            cur_backups = list_backups(filepath)
+            backup_N = cur_backups[-1][0] + 1 if cur_backups else 1
             backup_path = filepath + '.' + str(backup_N)
             os.rename(filepath, backup_path)
-        with open(filepath, 'w') as f:
+        with create_obsfile(filepath, self.obs_compression) as f:
             obs.save(f)
     
     def next_file(self):
@@ -312,6 +1087,7 @@ class Ethogram(object):
         self.name = name
         self.__behaviors = dict()
         self.__codes = dict()
+        self.__symbols = SymbolTrie()
     
     @property
     def behaviors(self):
@@ -349,6 +1125,28 @@ class Ethogram(object):
         """
         return DictViewer(self.__codes)
     
+    @property
+    def symbols(self):
+        """
+        A SymbolTrie of all the symbols of the registered codes, for finding
+        symbols by prefix as an entry is typed.
+        """
+        return self.__symbols
+    
+    def complete_entry(self, partial, limit=None):
+        """
+        Given a partially typed entry, return the symbols it could be the
+        beginning of, in sorted order (at most limit of them). Once the entry
+        contains whitespace the symbol is complete, so the result is either
+        just that symbol or empty.
+        """
+        items = partial.split(None, 1)
+        if len(items) == 0:
+            return self.__symbols.complete('', limit)
+        if len(items) > 1 or partial[-1].isspace():
+            return [items[0]] if items[0] in self.__symbols else []
+        return self.__symbols.complete(items[0], limit)
+    
     def add_behavior(self, kind, name, values=None):
         """
         Add a new behavior to the ethogram. The behavior kind must be one of:
@@ -390,6 +1188,7 @@ class Ethogram(object):
         #self.__validate_obs(new_code)
         # We may want to validate the code in the future
         self.__codes[symbol] = DictViewer(new_code)
+        self.__symbols.add(symbol)
     
     def get_prototype(self, entry):
         """
@@ -441,7 +1240,7 @@ class Ethogram(object):
         obs_args = dict(zip(code.get('args',[]), entry_args))
         return join_dicts(obs_entry, obs_behavior, obs_code, obs_args)
     
-    def validate_obs(obs):
+    def validate_obs(self, obs):
         """
         Check an observation against the ethogram. If the observation is valid
         under the ethogram, returns an empty list. If the observation is not
@@ -510,6 +1309,263 @@ class Ethogram(object):
             if value not in valid_values:
                 raise ValueError('Observation value not valid for behavior')
 
+class CatalogDir(object):
+    """
+    A directory in a VideoCatalog. path is relative to video_root ('' for
+    video_root itself), subdirs maps names to CatalogDir objects, and videos
+    is the sorted list of videos directly inside. n_videos and n_observed
+    count the videos in the whole subtree, and those with observations.
+    """
+    __slots__ = ('name', 'path', 'subdirs', 'videos', 'n_videos',
+                 'n_observed')
+    
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.subdirs = dict()
+        self.videos = []
+        self.n_videos = 0
+        self.n_observed = 0
+    
+    def coverage(self):
+        """
+        The fraction of the videos in this subtree which have observations.
+        """
+        if self.n_videos == 0:
+            return 0.0
+        return float(self.n_observed) / self.n_videos
+
+class VideoCatalog(object):
+    """
+    The videos of a project (as paths relative to video_root, like
+    Project.video_files) arranged by directory, with video and observation
+    counts for every directory. Directories are created as videos are added,
+    and removed when they no longer hold any.
+    """
+    def __init__(self, videofiles=(), observed=()):
+        self.root = CatalogDir('')
+        self.__dirs = {'': self.root}
+        self.__observed = set(observed)
+        self.__videos = set()
+        self.add_videos(videofiles)
+    
+    @staticmethod
+    def dir_of(videofile):
+        """
+        The catalog directory path of a video file.
+        """
+        dirname = os.path.dirname(os.path.normpath(videofile))
+        return '' if dirname == '.' else dirname
+    
+    @staticmethod
+    def ancestors(path):
+        """
+        The paths of a catalog directory and every directory above it, from
+        the root ('') down to path.
+        """
+        paths = ['']
+        if path:
+            parts = path.split(os.sep)
+            paths.extend(os.sep.join(parts[:ind+1])
+                         for ind in xrange(len(parts)))
+        return paths
+    
+    def get_dir(self, path):
+        """
+        Get the CatalogDir at path, or None if there is no such directory.
+        """
+        return self.__dirs.get(path)
+    
+    def __contains__(self, videofile):
+        return videofile in self.__videos
+    
+    def __len__(self):
+        return len(self.__videos)
+    
+    def add_video(self, videofile):
+        """
+        Add a video file to the catalog, creating its directories as needed.
+        """
+        if videofile in self.__videos:
+            return
+        self.__videos.add(videofile)
+        observed = videofile in self.__observed
+        parent = None
+        for path in self.ancestors(self.dir_of(videofile)):
+            directory = self.__dirs.get(path)
+            if directory is None:
+                directory = CatalogDir(path)
+                self.__dirs[path] = directory
+                parent.subdirs[directory.name] = directory
+            directory.n_videos += 1
+            directory.n_observed += observed
+            parent = directory
+        bisect.insort(parent.videos, videofile)
+    
+    def add_videos(self, videofiles):
+        """
+        Add many video files at once. Equivalent to calling add_video for each,
+        but each directory is only visited once.
+        """
+        by_dirname = dict()
+        for videofile in videofiles:
+            if videofile not in self.__videos:
+                self.__videos.add(videofile)
+                by_dirname.setdefault(os.path.dirname(videofile),
+                                      []).append(videofile)
+        for dirname,videos in by_dirname.items():
+            n_observed = len(self.__observed.intersection(videos))
+            parent = None
+            for path in self.ancestors(self.dir_of(os.path.join(dirname, 'v'))):
+                directory = self.__dirs.get(path)
+                if directory is None:
+                    directory = CatalogDir(path)
+                    self.__dirs[path] = directory
+                    parent.subdirs[directory.name] = directory
+                directory.n_videos += len(videos)
+                directory.n_observed += n_observed
+                parent = directory
+            parent.videos.extend(videos)
+            parent.videos.sort()
+    
+    def remove_video(self, videofile):
+        """
+        Remove a video file from the catalog, along with any directories left
+        empty.
+        """
+        if videofile not in self.__videos:
+            return
+        self.__videos.remove(videofile)
+        observed = videofile in self.__observed
+        paths = self.ancestors(self.dir_of(videofile))
+        self.__dirs[paths[-1]].videos.remove(videofile)
+        for path in paths:
+            directory = self.__dirs[path]
+            directory.n_videos -= 1
+            directory.n_observed -= observed
+        for parent_path,path in reversed(zip(paths[:-1], paths[1:])):
+            directory = self.__dirs[path]
+            if directory.n_videos == 0:
+                del self.__dirs[path]
+                del self.__dirs[parent_path].subdirs[directory.name]
+    
+    def set_observed(self, videofile, observed=True):
+        """
+        Record whether a video has any observations, updating the counts of
+        its directories. Videos not yet in the catalog are remembered for when
+        they are added.
+        """
+        if observed == (videofile in self.__observed):
+            return
+        if observed:
+            self.__observed.add(videofile)
+        else:
+            self.__observed.remove(videofile)
+        if videofile in self.__videos:
+            change = 1 if observed else -1
+            for path in self.ancestors(self.dir_of(videofile)):
+                self.__dirs[path].n_observed += change
+    
+    def is_observed(self, videofile):
+        return videofile in self.__observed
+    
+    def clear_observed(self):
+        """
+        Forget which videos have observations.
+        """
+        self.__observed = set()
+        for directory in self.__dirs.values():
+            directory.n_observed = 0
+    
+    def neighbours(self, videofile):
+        """
+        The videos before and after a video in its directory, as a pair;
+        either may be None.
+        """
+        directory = self.__dirs.get(self.dir_of(videofile))
+        if directory is None or videofile not in self.__videos:
+            return None, None
+        ind = bisect.bisect_left(directory.videos, videofile)
+        before = directory.videos[ind-1] if ind > 0 else None
+        after = (directory.videos[ind+1] if ind + 1 < len(directory.videos)
+                 else None)
+        return before, after
+
+class SymbolTrie(object):
+    """
+    A prefix tree of symbols. Each node keeps the sorted list of all symbols
+    below it, so finding the completions of a prefix only costs a walk down
+    the tree of the prefix's length, however many symbols there are.
+    """
+    class Node(object):
+        __slots__ = ('children', 'symbols', 'is_symbol')
+        
+        def __init__(self):
+            self.children = dict()
+            self.symbols = []
+            self.is_symbol = False
+    
+    def __init__(self, symbols=()):
+        self.__root = SymbolTrie.Node()
+        self.__count = 0
+        for symbol in symbols:
+            self.add(symbol)
+    
+    def __getstate__(self):
+        # Nodes are rebuilt on unpickling rather than pickled
+        return list(self)
+    
+    def __setstate__(self, symbols):
+        self.__init__(symbols)
+    
+    def add(self, symbol):
+        """
+        Add a symbol to the tree.
+        """
+        if symbol in self:
+            return
+        node = self.__root
+        bisect.insort(node.symbols, symbol)
+        for char in symbol:
+            node = node.children.setdefault(char, SymbolTrie.Node())
+            bisect.insort(node.symbols, symbol)
+        node.is_symbol = True
+        self.__count += 1
+    
+    def __find(self, prefix):
+        node = self.__root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+    
+    def __contains__(self, symbol):
+        node = self.__find(symbol)
+        return node is not None and node.is_symbol
+    
+    def __len__(self):
+        return self.__count
+    
+    def __iter__(self):
+        return iter(self.__root.symbols)
+    
+    def is_prefix(self, prefix):
+        """
+        Check whether any symbol begins with prefix.
+        """
+        return self.__find(prefix) is not None
+    
+    def complete(self, prefix, limit=None):
+        """
+        Get the symbols beginning with prefix, in sorted order. If limit is
+        given, return at most that many.
+        """
+        node = self.__find(prefix)
+        if node is None:
+            return []
+        return node.symbols[:limit]
+
 class CodeError(ValueError):
     pass
 
@@ -566,6 +1622,391 @@ class ObservationSet(collections.Sequence):
                 new_obs_set.__observations.append(obs_dict)
         return new_obs_set
 
+class LazyObsFile(collections.Sequence):
+    """
+    Random access to the observations in a .tbobs file, parsing only the lines
+    that are asked for. The file is memory-mapped (or, if it is compressed,
+    decompressed into memory), and an index holding the byte offset and time
+    of every "obs:" line is built on first use. The index
+    is stored in a hidden sidecar file next to the observation file,
+    .<name>.tbobs.tbidx, and reused for as long as the observation file's size
+    and modification time stay the same.
+    
+    Indexing gives observations in file order, like load_obs_from_file:
+        obsfile = LazyObsFile(path)
+        first = obsfile[0]
+        window = obsfile.time_range(60.0, 120.0)
+    """
+    index_magic = 'TBIDX002'
+    index_header = struct.Struct('<8sidqi')
+    line_rex = re.compile(r'^[ \t]*obs[ \t]*:', re.M)
+    # Skips whole key=value tokens (with their escapes and quotes, as
+    # parse_keyvals reads them) up to the time key, so that 'time=' escaped
+    # within another value is never taken for it
+    time_rex = re.compile(r'\s*(?:(?:\\.|"(?:\\.|[^"])*"|[^\s\\"])+\s+)*?'
+                          r'time=((?:\\.|[^\s\\])+)')
+    
+    def __init__(self, path, use_sidecar=True):
+        self.path = path
+        self.__offsets = array.array('l')
+        self.__times = array.array('d')
+        self.__order = None
+        self.__sorted_times = None
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if f.read(len(gzip_magic)) == gzip_magic:
+                f.seek(0)
+                self.__map = gzip.GzipFile(fileobj=f, mode='rb').read()
+            elif stat.st_size > 0:
+                self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.__map = ''
+        sidecar = self.sidecar_path(path)
+        if not (use_sidecar and self.__read_index(sidecar, stat)):
+            self.__build_index()
+            if use_sidecar:
+                self.__write_index(sidecar, stat)
+    
+    @staticmethod
+    def sidecar_path(path):
+        """
+        Get the path of the index sidecar file for an observation file.
+        """
+        dirname, basename = os.path.split(path)
+        return os.path.join(dirname, '.' + basename + '.tbidx')
+    
+    @property
+    def times(self):
+        """
+        The times of all observations in file order, as an array of floats.
+        Observations with no valid time have a time of nan.
+        """
+        return self.__times
+    
+    @property
+    def header(self):
+        """
+        The lines at the top of the file before the first observation (eg,
+        'observer' and 'source'), as a dict.
+        """
+        end = self.__offsets[0] if len(self.__offsets) else len(self.__map)
+        header = dict()
+        for line in self.__map[:end].splitlines():
+            head,sep,tail = line.partition(':')
+            if sep:
+                header[head.strip()] = tail.strip()
+        return header
+    
+    def __len__(self):
+        return len(self.__offsets)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__parse_line(i)
+                    for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('observation index out of range')
+        return self.__parse_line(index)
+    
+    def time_range(self, start, end):
+        """
+        Get the observations with start <= time < end, in order of time.
+        """
+        if self.__order is None:
+            valid = [i for i,t in enumerate(self.__times) if t == t]
+            self.__order = sorted(valid, key=self.__times.__getitem__)
+            self.__sorted_times = [self.__times[i] for i in self.__order]
+        lo = bisect.bisect_left(self.__sorted_times, start)
+        hi = bisect.bisect_left(self.__sorted_times, end)
+        return [self.__parse_line(i) for i in self.__order[lo:hi]]
+    
+    def close(self):
+        """
+        Release the memory map.
+        """
+        if isinstance(self.__map, mmap.mmap):
+            self.__map.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def __line_text(self, index):
+        start = self.__offsets[index]
+        end = self.__map.find('\n', start)
+        if end < 0:
+            end = len(self.__map)
+        return self.__map[start:end]
+    
+    def __parse_line(self, index):
+        line = self.__line_text(index)
+        return parse_keyvals(line.partition(':')[2].strip())
+    
+    def __build_index(self):
+        for match in self.line_rex.finditer(self.__map):
+            self.__offsets.append(match.start())
+        for index in xrange(len(self.__offsets)):
+            keyvals = self.__line_text(index).partition(':')[2]
+            match = self.time_rex.match(keyvals)
+            if match is None:
+                time = parse_keyvals(keyvals).get('time')
+            else:
+                time = match.group(1)
+            try:
+                self.__times.append(float(time))
+            except (TypeError, ValueError):
+                self.__times.append(float('nan'))
+    
+    def __read_index(self, sidecar, stat):
+        try:
+            with open(sidecar, 'rb') as f:
+                header = f.read(self.index_header.size)
+                magic, itemsize, mtime, size, count = \
+                    self.index_header.unpack(header)
+                if (magic != self.index_magic or
+                        itemsize != self.__offsets.itemsize or
+                        mtime != stat.st_mtime or size != stat.st_size):
+                    return False
+                self.__offsets.fromfile(f, count)
+                self.__times.fromfile(f, count)
+        except (IOError, EOFError, struct.error):
+            self.__offsets = array.array('l')
+            self.__times = array.array('d')
+            return False
+        return True
+    
+    def __write_index(self, sidecar, stat):
+        temp_path = sidecar + '.{0}.tmp'.format(os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(self.index_header.pack(
+                    self.index_magic, self.__offsets.itemsize, stat.st_mtime,
+                    stat.st_size, len(self.__offsets)))
+                self.__offsets.tofile(f)
+                self.__times.tofile(f)
+            os.rename(temp_path, sidecar)
+        except (IOError, OSError):
+            # The index is only an optimization; if the directory isn't
+            # writable, we just build it again next time.
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+def shared_memory_dir():
+    """
+    The directory where SharedObsStore keeps its columns by default: /dev/shm
+    where there is one, so that they live in memory, or else the temporary
+    directory.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+# The SharedObsStore directories owned by this process and not yet closed,
+# removed at exit if they are still there
+_live_stores = set()
+
+def _remove_store(path):
+    _live_stores.discard(path)
+    shutil.rmtree(path, ignore_errors=True)
+
+@atexit.register
+def _remove_live_stores():
+    for path in list(_live_stores):
+        _remove_store(path)
+
+def cleanup_shared_stores(directory=None):
+    """
+    Remove the SharedObsStore directories left behind by processes that have
+    died without removing them. Returns the paths removed.
+    """
+    if directory is None:
+        directory = shared_memory_dir()
+    removed = []
+    for name in os.listdir(directory):
+        if not name.startswith(SharedObsStore.name_prefix):
+            continue
+        try:
+            pid = int(name[len(SharedObsStore.name_prefix):].split('-')[0])
+            os.kill(pid, 0)
+        except ValueError:
+            continue
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                path = os.path.join(directory, name)
+                _remove_store(path)
+                removed.append(path)
+    return removed
+
+class SharedObsStore(object):
+    """
+    The observations of many files loaded once into flat columns in shared
+    memory, so that a pool of worker processes can read them without each
+    parsing the files again or being sent copies. Each column is a file of
+    raw numbers (in /dev/shm where possible; see shared_memory_dir) that
+    every process maps read-only, so memory use stays the same however many
+    workers attach. The columns have one element per observation, with the
+    files one after another in the order of files:
+        times:     float64 ('d'), nan where the time is missing
+        behaviors: int32 ('i'), index into behavior_names, or -1 for an
+                   unparsed observation
+        values:    int32 ('i'), index into value_strings, or -1 for none
+    file_starts holds the first row of each file, and the number of rows at
+    the end. Values split at commas are joined with commas again.
+    
+    The process that creates a store owns it, and removes it when it is
+    closed, or at exit at the latest; others attach to it by name:
+        with SharedObsStore.create(project) as store:
+            pool = multiprocessing.Pool(4, init, (store.name,))
+            ...
+        # in each worker:
+        store = SharedObsStore.attach(name)
+        times = numpy.frombuffer(store.buffer('times'), 'd')
+    cleanup_shared_stores removes stores left by processes that crashed.
+    """
+    name_prefix = 'tinbergen-obs-'
+    columns = (('times', 'd'), ('behaviors', 'i'), ('values', 'i'))
+    
+    def __init__(self, path, owner=False):
+        self.path = path
+        self.owner = owner
+        self.__buffers = dict()
+        with open(os.path.join(path, 'header.pickle'), 'rb') as f:
+            header = pickle.load(f)
+        self.files = header['files']
+        self.file_starts = header['file_starts']
+        self.behavior_names = header['behavior_names']
+        self.value_strings = header['value_strings']
+        for column,typecode in self.columns:
+            with open(os.path.join(path, column), 'rb') as f:
+                if os.fstat(f.fileno()).st_size > 0:
+                    self.__buffers[column] = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self.__buffers[column] = ''
+    
+    @property
+    def name(self):
+        """
+        The name by which other processes attach to the store.
+        """
+        return os.path.basename(self.path)
+    
+    @classmethod
+    def create(cls, project, pairs=None, directory=None):
+        """
+        Load the observation files of a project (or those of pairs, a list of
+        (videofile, observer) pairs) into a new store, owned by this process.
+        """
+        if pairs is None:
+            pairs = project.list_obsfiles()
+        if directory is None:
+            directory = shared_memory_dir()
+        path = tempfile.mkdtemp(prefix='{0}{1}-'.format(cls.name_prefix,
+                                                        os.getpid()),
+                                dir=directory)
+        _live_stores.add(path)
+        try:
+            cls.__write(path, project, pairs)
+            return cls(path, owner=True)
+        except:
+            _remove_store(path)
+            raise
+    
+    @classmethod
+    def attach(cls, name, directory=None):
+        """
+        Attach to a store made by another process.
+        """
+        if directory is None:
+            directory = shared_memory_dir()
+        return cls(os.path.join(directory, name))
+    
+    @classmethod
+    def __write(cls, path, project, pairs):
+        columns = dict((column, array.array(typecode))
+                       for column,typecode in cls.columns)
+        behavior_names = []
+        behavior_codes = dict()
+        value_strings = []
+        value_codes = dict()
+        file_starts = array.array('l', [0])
+        for videofile,observer in pairs:
+            for obs in read_obsfile(project.get_obsfile(videofile, observer)):
+                columns['times'].append(obs_time(obs))
+                name = obs.get('name')
+                if name is None:
+                    columns['behaviors'].append(-1)
+                else:
+                    if name not in behavior_codes:
+                        behavior_codes[name] = len(behavior_names)
+                        behavior_names.append(name)
+                    columns['behaviors'].append(behavior_codes[name])
+                value = obs.get('value')
+                if value is None:
+                    columns['values'].append(-1)
+                else:
+                    if not isinstance(value, str):
+                        value = ','.join(value)
+                    if value not in value_codes:
+                        value_codes[value] = len(value_strings)
+                        value_strings.append(value)
+                    columns['values'].append(value_codes[value])
+            file_starts.append(len(columns['times']))
+        for column,typecode in cls.columns:
+            with open(os.path.join(path, column), 'wb') as f:
+                columns[column].tofile(f)
+        header = {'files': list(pairs), 'file_starts': file_starts,
+                  'behavior_names': behavior_names,
+                  'value_strings': value_strings}
+        with open(os.path.join(path, 'header.pickle'), 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+    
+    def __len__(self):
+        return self.file_starts[-1]
+    
+    def buffer(self, column):
+        """
+        The contents of a column, as a read-only buffer of raw numbers (of
+        the type given in columns), shared with every other process.
+        """
+        return self.__buffers[column]
+    
+    def file_rows(self, index):
+        """
+        The rows of the index'th file, as (start, end).
+        """
+        return self.file_starts[index], self.file_starts[index + 1]
+    
+    def get(self, column, row):
+        """
+        Read one element of a column.
+        """
+        typecode = dict(self.columns)[column]
+        return struct.unpack_from(typecode, self.__buffers[column],
+                                  row * struct.calcsize(typecode))[0]
+    
+    def close(self):
+        """
+        Release the mapped columns, and if this process owns the store,
+        remove it.
+        """
+        for buf in self.__buffers.values():
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+        self.__buffers.clear()
+        if self.owner:
+            _remove_store(self.path)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 class NameSet(frozenset):
     """
     A helper datatype to represent a set of names, mostly for the "values" field
@@ -673,6 +2114,99 @@ def parse_keyvals(keyvalstr):
         newdict[key] = val
     return newdict
 
+class KeyvalEncoder(object):
+    r"""
+    A caching encoder for key=value strings, producing exactly the same output
+    as as_keyvalstr. Observations repeat a small vocabulary of keys and values
+    taken from the ethogram, so the escaped form of each string is remembered
+    the first time it is seen. Strings with no characters needing escapes are
+    used as-is, and numbers (such as times) are never escaped.
+    """
+    key_special = re.compile(r'[\s\\=]')
+    value_special = re.compile(r'[\s\\,]')
+    max_cached = 4096
+    
+    def __init__(self):
+        self.__keys = dict()
+        self.__values = dict()
+    
+    def escape_key(self, key):
+        r"""
+        Escape whitespace, = and \ in a key. Raises TypeError if key is not a
+        string.
+        """
+        try:
+            return self.__keys[key]
+        except KeyError:
+            pass
+        if self.key_special.search(key) is None:
+            keystr = key
+        else:
+            keystr = self.key_special.sub(r'\\\g<0>', key)
+        if len(self.__keys) < self.max_cached:
+            self.__keys[key] = keystr
+        return keystr
+    
+    def escape_value(self, val):
+        r"""
+        Convert a single value to a string, escaping whitespace, commas and \.
+        """
+        if isinstance(val, (int, long, float)):
+            return str(val)
+        val = str(val)
+        try:
+            return self.__values[val]
+        except KeyError:
+            pass
+        if self.value_special.search(val) is None:
+            valstr = val
+        else:
+            valstr = self.value_special.sub(r'\\\g<0>', val)
+        if len(self.__values) < self.max_cached:
+            self.__values[val] = valstr
+        return valstr
+    
+    def encode(self, dictobj):
+        """
+        Get a key=value string representation of a dictionary object. See
+        as_keyvalstr.
+        """
+        keyvals = []
+        for key,val in dictobj.items():
+            keystr = self.escape_key(key)
+            if not isinstance(val, str) and isinstance(val, collections.Iterable):
+                valstr = ','.join([self.escape_value(v) for v in val])
+            else:
+                valstr = self.escape_value(val)
+            keyvals.append(keystr + '=' + valstr)
+        return ' '.join(keyvals)
+
+_shared_encoder = KeyvalEncoder()
+
+def write_obslist(fileobj, obslist, encoder=None, chunk_rows=1024):
+    """
+    Write a list of observations to an open file as 'obs: key=value ...' lines.
+    Lines are collected and written chunk_rows at a time rather than one by
+    one. Observations which cannot be encoded are not written; returns a list
+    of their indices in obslist.
+    """
+    if encoder is None:
+        encoder = _shared_encoder
+    skipped = []
+    chunk = []
+    for ind,obs in enumerate(obslist):
+        try:
+            chunk.append('obs: ' + encoder.encode(obs) + '\n')
+        except TypeError:
+            skipped.append(ind)
+            continue
+        if len(chunk) >= chunk_rows:
+            fileobj.write(''.join(chunk))
+            chunk = []
+    if chunk:
+        fileobj.write(''.join(chunk))
+    return skipped
+
 def as_keyvalstr(dictobj):
     r"""
     Get a key=value string representation of a dictionary object. All keys and
@@ -684,16 +2218,7 @@ def as_keyvalstr(dictobj):
     comma-separated list with each element escaped according to the rules for
     values.
     """
-    keyvals = []
-    for key,val in dictobj.items():
-        keystr = re.sub(r'([\s\\=])', r'\\\1', key)
-        if not isinstance(val, str) and isinstance(val, collections.Iterable):
-            val_list = [re.sub(r'([\s\\,])', r'\\\1', str(v)) for v in val]
-            valstr = ','.join(val_list)
-        else:
-            valstr = re.sub(r'([\s\\,])', r'\\\1', str(val))
-        keyvals.append(keystr + '=' + valstr)
-    return ' '.join(keyvals)
+    return _shared_encoder.encode(dictobj)
 
 def join_dicts(*pargs, **kargs):
     """
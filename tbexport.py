@@ -0,0 +1,255 @@
+"""
+Export of a whole project's observations as per-frame arrays, for training
+classifiers and other tools that want one label per video frame.
+
+For each observation file, the export writes three .npy files, which can be
+opened without copying by numpy.load(path, mmap_mode='r'):
+    <video>.<observer>.labels.npy   int16, frames x categorical behaviors
+                                    (state and binary), the index of each
+                                    behavior's value in its categories, or
+                                    -1 where the value is unknown
+    <video>.<observer>.values.npy   float32, frames x variable behaviors,
+                                    nan before the first observation
+    <video>.<observer>.moments.npy  int64, events x 2, the (frame, moment
+                                    behavior) of each moment event, in order
+                                    of frame
+along with manifest.json in the output directory, which lists the columns,
+categories and files. The value of a behavior at frame n is the last value
+coded at or before frame n.
+
+Usage from the command line:
+    python tbexport.py project.tbproj output-dir --framerate 30000/1001
+        [--processes N] [--observers aaa,bbb] [--durations durations.json]
+        [--probed]
+durations.json maps video files to their durations in seconds; without it,
+each export ends at the last observation. With --probed, the frame rates and
+durations found by tbprobe.py are used for the videos it has probed.
+"""
+
+import os
+import sys
+import json
+import numpy as np
+import tbdatamodel
+import tbanalysis
+
+manifest_version = 1
+label_dtype = np.int16
+value_dtype = np.float32
+
+class ExportColumns(object):
+    """
+    The columns of an export, taken from an ethogram: categorical holds the
+    state and binary behaviors, in order of name, with their sorted values
+    in categories; variables and moments hold the variable and moment
+    behaviors in order of name.
+    """
+    def __init__(self, ethogram):
+        self.coding = tbanalysis.SequenceCoding(ethogram)
+        kinds = self.coding.kinds
+        self.categorical = sorted(self.coding.values)
+        self.categories = dict((name, self.coding.values[name])
+                               for name in self.categorical)
+        self.variables = sorted(name for name in kinds
+                                if kinds[name] == 'variable')
+        self.moments = sorted(name for name in kinds
+                              if kinds[name] == 'moment')
+    
+    def describe(self):
+        """
+        The columns as a JSON-ready dict, for the manifest.
+        """
+        return {'labels': [{'name': name, 'kind': self.coding.kinds[name],
+                            'categories': self.categories[name]}
+                           for name in self.categorical],
+                'values': self.variables,
+                'moments': self.moments}
+
+def frame_tensors(obslist, columns, rate, n_frames=None, initial=None):
+    """
+    Convert one observation set to per-frame arrays. Returns (labels, values,
+    moments) as described in the module documentation. Observations are
+    placed by their stored frame number, or by their time converted at rate
+    (see tbanalysis.obs_frames). n_frames defaults to one past the frame of
+    the last observation. initial maps behavior names to their values before
+    their first observation; by default, see
+    tbanalysis.default_initial_values.
+    """
+    coding = columns.coding
+    if initial is None:
+        initial = tbanalysis.default_initial_values(coding)
+    frames = tbanalysis.obs_frames(obslist, rate)
+    events = np.array([coding.label_index.get(coding.event_label(obs), -1)
+                       for obs in obslist], dtype=np.intp)
+    numbers = tbanalysis.strings_to_float(
+        [obs.get('value', '') for obs in obslist])
+    keep = (events >= 0) & (frames >= 0)
+    order = np.argsort(frames[keep], kind='mergesort')
+    frames = frames[keep][order]
+    events = events[keep][order]
+    numbers = numbers[keep][order]
+    if n_frames is None:
+        n_frames = int(frames[-1]) + 1 if len(frames) else 0
+    labels = np.empty((n_frames, len(columns.categorical)), dtype=label_dtype)
+    values = np.empty((n_frames, len(columns.variables)), dtype=value_dtype)
+    for col,name in enumerate(columns.categorical):
+        mask = (coding.first_code[name] <= events) & \
+            (events < coding.first_code[name] + len(columns.categories[name]))
+        if initial.get(name) is None:
+            start_value = -1
+        else:
+            start_value = columns.categories[name].index(initial[name])
+        labels[:,col] = _fill_changes(frames[mask],
+                                      events[mask] - coding.first_code[name],
+                                      n_frames, start_value)
+    for col,name in enumerate(columns.variables):
+        mask = events == coding.first_code[name]
+        values[:,col] = _fill_changes(frames[mask], numbers[mask], n_frames,
+                                      np.nan)
+    moment_index = dict((coding.first_code[name], ind)
+                        for ind,name in enumerate(columns.moments))
+    is_moment = np.array([event in moment_index for event in events],
+                         dtype=bool) & (frames < n_frames)
+    moments = np.empty((is_moment.sum(), 2), dtype=np.int64)
+    moments[:,0] = frames[is_moment]
+    moments[:,1] = [moment_index[event] for event in events[is_moment]]
+    return labels, values, moments
+
+def _fill_changes(change_frames, change_values, n_frames, start_value):
+    # The value at each frame is that of the last change at or before it
+    ind = np.searchsorted(change_frames, np.arange(n_frames), side='right') - 1
+    filled = np.empty(n_frames, dtype=np.asarray(change_values).dtype)
+    filled[:] = start_value
+    filled[ind >= 0] = change_values[ind[ind >= 0]]
+    return filled
+
+def _save_array(path, arr):
+    # Written next to its final name, then renamed, so that a reader never
+    # maps a half-written file
+    out = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=arr.dtype,
+                                    shape=arr.shape)
+    out[...] = arr
+    out.flush()
+    del out
+    os.rename(path + '.tmp', path)
+
+def _export_task(path, shared):
+    columns, targets, initial = shared
+    stem, rate, n_frames = targets[path]
+    labels, values, moments = frame_tensors(tbdatamodel.read_obsfile(path),
+                                            columns, rate, n_frames, initial)
+    outdir = os.path.dirname(stem)
+    if not os.path.exists(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            # Another worker may have made it first
+            if not os.path.isdir(outdir):
+                raise
+    _save_array(stem + '.labels.npy', labels)
+    _save_array(stem + '.values.npy', values)
+    _save_array(stem + '.moments.npy', moments)
+    return len(labels), len(moments)
+
+def export_project(project, out_dir, framerate, processes=None,
+                   observers=None, durations=None, framerates=None,
+                   initial=None):
+    """
+    Export every observation file in a project (or only those of the observer
+    codes in observers) to per-frame arrays in out_dir, using a pool of
+    worker processes, and write out_dir/manifest.json. framerate is the frame
+    rate of the videos (see tbdatamodel.frame_rate), and framerates
+    optionally maps video files to their own rates. durations optionally maps
+    video files to their durations in seconds. Returns the manifest, as a
+    dict.
+    """
+    columns = ExportColumns(project.ethogram)
+    pairs = tbanalysis.select_obsfiles(project, observers)
+    if durations is None:
+        durations = dict()
+    if framerates is None:
+        framerates = dict()
+    targets = dict()
+    entries = []
+    for videofile,observer in pairs:
+        rate = tbdatamodel.frame_rate(framerates.get(videofile, framerate))
+        n_frames = None
+        if videofile in durations:
+            n_frames = tbdatamodel.time_to_frame(durations[videofile], rate)
+        relstem = os.path.normpath(videofile) + '.' + observer
+        targets[project.get_obsfile(videofile, observer)] = (
+            os.path.join(out_dir, relstem), rate, n_frames)
+        entries.append({'video': videofile, 'observer': observer,
+                        'framerate': str(rate),
+                        'labels': relstem + '.labels.npy',
+                        'values': relstem + '.values.npy',
+                        'moments': relstem + '.moments.npy'})
+    results = tbanalysis.map_obsfiles(project, _export_task,
+                                      (columns, targets, initial), processes,
+                                      pairs)
+    for entry,(videofile,observer,(n_frames,n_moments)) in zip(entries,
+                                                               results):
+        entry['frames'] = n_frames
+        entry['moment_events'] = n_moments
+    manifest = {'version': manifest_version,
+                'columns': columns.describe(),
+                'files': entries}
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    manifest_file = os.path.join(out_dir, 'manifest.json')
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+    return manifest
+
+def load_manifest(out_dir):
+    """
+    Read the manifest of an export.
+    """
+    with open(os.path.join(out_dir, 'manifest.json'), 'r') as f:
+        return json.load(f)
+
+def open_tensors(out_dir, entry):
+    """
+    Map the arrays of one file in an export (an element of the manifest's
+    'files' list) read-only, without copying. Returns (labels, values,
+    moments).
+    """
+    return tuple(np.load(os.path.join(out_dir, entry[key]), mmap_mode='r')
+                 for key in ('labels', 'values', 'moments'))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Export observations as per-frame arrays.')
+    parser.add_argument('project_file')
+    parser.add_argument('out_dir')
+    parser.add_argument('--framerate', required=True,
+                        help='video frame rate, eg 25 or 30000/1001')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--observers', default=None,
+                        help='comma-separated observer codes to export')
+    parser.add_argument('--durations', default=None,
+                        help='JSON file mapping videos to durations')
+    parser.add_argument('--probed', action='store_true',
+                        help='use the frame rates and durations found by '
+                             'tbprobe.py')
+    args = parser.parse_args()
+    project = tbdatamodel.Project(args.project_file)
+    observers = args.observers.split(',') if args.observers else None
+    durations = None
+    framerates = None
+    if args.probed:
+        import tbprobe
+        video_info = tbprobe.VideoInfoCache(project)
+        durations = video_info.durations()
+        framerates = video_info.framerates()
+    if args.durations:
+        with open(args.durations, 'r') as f:
+            durations = json.load(f)
+    manifest = export_project(project, args.out_dir, args.framerate,
+                              args.processes, observers, durations,
+                              framerates)
+    sys.stderr.write('{0} file(s) exported to {1}\n'.format(
+        len(manifest['files']), args.out_dir))
@@ -0,0 +1,241 @@
+"""
+Migration of a project's stored observations to a changed ethogram.
+
+Each stored observation keeps the entry it was coded with, along with the
+name, kind, value and other keys that Ethogram.parse_entry gave that entry at
+the time. Once behaviors are renamed or codes changed in the .tbethogram file,
+those keys are stale; migrating derives them again from each entry under the
+new ethogram, after renaming any symbols that changed.
+
+Example:
+    migration = ObsMigration(old_ethogram, project.ethogram, {'lo': 'loc'})
+    results = migrate_project(project, migration, dry_run=True)
+    print(migration_report(results))
+
+Usage from the command line:
+    python tbmigrate.py project.tbproj old.tbethogram [--new new.tbethogram]
+                        [--rename OLD=NEW ...] [--dry-run] [--processes N]
+The new ethogram is the project's, unless given. With --dry-run, prints the
+changes that would be made to each file and saves nothing. Otherwise each
+changed file is saved with Project.save_obslist, which keeps its previous
+version as a numbered backup.
+"""
+
+import sys
+import collections
+import multiprocessing
+import tbdatamodel
+
+# The result of migrating one observation file. changes is a list of
+# (old_obs, new_obs) pairs for the observations that changed, unknown the
+# set of symbols (after renaming) that are not in the new ethogram, and
+# obslist the migrated observations, or None if nothing changed.
+FileMigration = collections.namedtuple('FileMigration',
+                                       ['videofile', 'observer', 'n_obs',
+                                        'changes', 'unknown', 'obslist'])
+
+def entry_symbol(entry):
+    """
+    The symbol of an entry (its first word), or '' for an empty entry.
+    """
+    items = entry.split(None, 1)
+    return items[0] if items else ''
+
+def written_form(obs):
+    """
+    An observation as it is written to file, key by key, so that
+    observations read back from a file compare equal to the ones they were
+    saved from (eg, values split at commas).
+    """
+    return dict((key, tbdatamodel.as_keyvalstr({key: value}))
+                for key,value in obs.items())
+
+class ObsMigration(object):
+    """
+    Moves observations from old_ethogram to new_ethogram. renames optionally
+    maps old symbols to the new symbols that replace them in entries; any
+    other symbol is kept as it is.
+    
+    The keys that old_ethogram derives from an observation's entry are
+    replaced by those that new_ethogram derives from the renamed entry. Keys
+    that were not derived from the entry, such as time and frame, are kept.
+    Observations whose symbol is not in new_ethogram are left as they are.
+    """
+    def __init__(self, old_ethogram, new_ethogram, renames=None):
+        self.old_ethogram = old_ethogram
+        self.new_ethogram = new_ethogram
+        self.renames = dict(renames or {})
+        self.symbols = frozenset(new_ethogram.codes)
+        missing = [new for new in self.renames.values()
+                   if new not in self.symbols]
+        if missing:
+            raise ValueError('Renamed symbol(s) not in the new ethogram: '
+                             '{0}'.format(', '.join(sorted(missing))))
+    
+    def migrate_entry(self, entry):
+        """
+        Rename the symbol of an entry (a string; see tbdatamodel.obs_entry),
+        if it has changed.
+        """
+        items = entry.split(None, 1)
+        if not items or items[0] not in self.renames:
+            return entry
+        return ' '.join([self.renames[items[0]]] + items[1:])
+    
+    def migrate_obs(self, obs):
+        """
+        Migrate a single observation. Returns a new dict, or None if the
+        observation's symbol is not in the new ethogram.
+        """
+        old_entry = tbdatamodel.obs_entry(obs)
+        entry = self.migrate_entry(old_entry)
+        if entry_symbol(entry) not in self.symbols:
+            return None
+        derived = self.old_ethogram.parse_entry(old_entry)
+        migrated = tbdatamodel.keys_lose(obs, set(derived))
+        migrated.update(self.new_ethogram.parse_entry(entry))
+        return migrated
+    
+    def migrate_obslist(self, obslist):
+        """
+        Migrate a list of observations. Returns the migrated list, the
+        (old_obs, new_obs) pairs that changed, and the set of unknown
+        symbols.
+        """
+        migrated = []
+        changes = []
+        unknown = set()
+        for obs in obslist:
+            new_obs = self.migrate_obs(obs)
+            if new_obs is None:
+                symbol = entry_symbol(self.migrate_entry(
+                    tbdatamodel.obs_entry(obs)))
+                if symbol:
+                    unknown.add(symbol)
+                migrated.append(obs)
+            else:
+                if written_form(new_obs) != written_form(obs):
+                    changes.append((obs, new_obs))
+                migrated.append(new_obs)
+        return migrated, changes, unknown
+
+_worker_migration = None
+
+def _init_worker(migration):
+    global _worker_migration
+    _worker_migration = migration
+
+def _migrate_file_task(task):
+    videofile, observer, path, keep_obslist = task
+    obslist = tbdatamodel.read_obsfile(path)
+    migrated, changes, unknown = _worker_migration.migrate_obslist(obslist)
+    if not changes or not keep_obslist:
+        migrated = None
+    return FileMigration(videofile, observer, len(obslist), changes, unknown,
+                         migrated)
+
+def migrate_project(project, migration, dry_run=False, processes=None):
+    """
+    Migrate every observation file in a project with an ObsMigration,
+    spreading the files over a pool of worker processes. Unless dry_run,
+    each file with changes is then saved with project.save_obslist, so its
+    previous version is kept as a numbered backup. Returns a list of
+    FileMigration tuples, in order of file.
+    """
+    tasks = [(videofile, observer,
+              project.get_obsfile(videofile, observer), not dry_run)
+             for videofile,observer in project.list_obsfiles()]
+    if len(tasks) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (migration,))
+        try:
+            results = pool.map(_migrate_file_task, tasks, chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(migration)
+        results = [_migrate_file_task(task) for task in tasks]
+    if not dry_run:
+        for result in results:
+            if result.obslist is not None:
+                project.save_obslist(result.videofile, result.observer,
+                                     result.obslist)
+    return results
+
+def migration_report(results, max_changes=10):
+    """
+    Describe the results of migrate_project as text: for each file with
+    changes or unknown symbols, a summary line, then up to max_changes
+    changed observations as - and + lines, as they are written to file.
+    """
+    lines = []
+    for result in results:
+        if not result.changes and not result.unknown:
+            continue
+        lines.append('{0} ({1}): {2} of {3} observation(s) changed'.format(
+            result.videofile, result.observer, len(result.changes),
+            result.n_obs))
+        if result.unknown:
+            lines.append('  unknown symbol(s), left as they are: {0}'.format(
+                ', '.join(sorted(result.unknown))))
+        for old_obs,new_obs in result.changes[:max_changes]:
+            lines.append('  - obs: ' + tbdatamodel.as_keyvalstr(old_obs))
+            lines.append('  + obs: ' + tbdatamodel.as_keyvalstr(new_obs))
+        if len(result.changes) > max_changes:
+            lines.append('  ... {0} more'.format(
+                len(result.changes) - max_changes))
+    return '\n'.join(lines)
+
+def parse_rename(text):
+    """
+    Parse a command line rename of the form OLD=NEW.
+    """
+    old, sep, new = text.partition('=')
+    if not sep or not old or not new:
+        raise ValueError('Renames must be given as OLD=NEW')
+    return old, new
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Update stored observations to a changed ethogram.')
+    parser.add_argument('project_file')
+    parser.add_argument('old_ethogram',
+                        help='the ethogram the observations were coded with')
+    parser.add_argument('--new', dest='new_ethogram', default=None,
+                        help='the ethogram to migrate to (by default, the '
+                             "project's)")
+    parser.add_argument('--rename', action='append', default=[],
+                        metavar='OLD=NEW', help='a symbol that has changed')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report the changes that would be made')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--max-changes', type=int, default=10,
+                        help='changed observations to list for each file')
+    args = parser.parse_args()
+    try:
+        renames = dict(parse_rename(text) for text in args.rename)
+    except ValueError as e:
+        parser.error(str(e))
+    project = tbdatamodel.Project(args.project_file, use_cache=True)
+    with open(args.old_ethogram) as f:
+        old_ethogram = tbdatamodel.Ethogram.new_from_file(f)
+    if args.new_ethogram is None:
+        new_ethogram = project.ethogram
+    else:
+        with open(args.new_ethogram) as f:
+            new_ethogram = tbdatamodel.Ethogram.new_from_file(f)
+    try:
+        migration = ObsMigration(old_ethogram, new_ethogram, renames)
+    except ValueError as e:
+        parser.error(str(e))
+    results = migrate_project(project, migration, args.dry_run, args.processes)
+    report = migration_report(results, args.max_changes)
+    if report:
+        print(report)
+    changed = [result for result in results if result.changes]
+    sys.stderr.write('{0} of {1} file(s) {2}, {3} observation(s)\n'.format(
+        len(changed), len(results),
+        'would change' if args.dry_run else 'changed',
+        sum(len(result.changes) for result in changed)))
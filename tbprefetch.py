@@ -0,0 +1,96 @@
+"""
+Loading of observation files ahead of time, so that moving on to a nearby
+video does not have to wait for the disk (or the network).
+"""
+
+import os
+import threading
+import collections
+import multiprocessing.pool
+import tbdatamodel
+
+def file_signature(path):
+    """
+    The modification time and size of a file, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+class ObsPrefetcher(object):
+    """
+    Loads the observations of the videos a coder is likely to open next, in a
+    small pool of threads, and holds on to at most max_entries of them until
+    they are taken. An observation set is only handed out if its file has not
+    changed since it was read; otherwise it is read again.
+    
+    Example:
+        prefetcher = ObsPrefetcher(project)
+        prefetcher.prefetch([(next_video, 'aaa'), (prev_video, 'aaa')])
+        ...
+        obslist = prefetcher.take(next_video, 'aaa')
+    """
+    def __init__(self, project, threads=2, max_entries=8):
+        self.project = project
+        self.threads = threads
+        self.max_entries = max_entries
+        self.__pool = None
+        self.__lock = threading.Lock()
+        # (videofile, observer) -> AsyncResult of (signature, obslist), in
+        # order of request, oldest first
+        self.__entries = collections.OrderedDict()
+    
+    def prefetch(self, pairs):
+        """
+        Start loading the observations for each (videofile, observer) pair,
+        unless they are already loaded or loading.
+        """
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = multiprocessing.pool.ThreadPool(self.threads)
+            for pair in pairs:
+                if None in pair:
+                    continue
+                result = self.__entries.pop(pair, None)
+                if result is None:
+                    result = self.__pool.apply_async(self.__load, pair)
+                self.__entries[pair] = result
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+    
+    def take(self, videofile, observer):
+        """
+        Get the observations for a video file and observer, as
+        Project.load_obs_from_file would, using the prefetched copy if there
+        is an up to date one. The copy is given up to the caller.
+        """
+        with self.__lock:
+            result = self.__entries.pop((videofile, observer), None)
+        if result is not None:
+            try:
+                signature, obslist = result.get()
+            except EnvironmentError:
+                signature = obslist = None
+            path = self.project.get_obsfile(videofile, observer)
+            if obslist is not None and signature == file_signature(path):
+                return obslist
+        return self.project.load_obs_from_file(videofile, observer)
+    
+    def close(self):
+        """
+        Stop the loading threads and forget everything prefetched.
+        """
+        with self.__lock:
+            self.__entries.clear()
+            if self.__pool is not None:
+                self.__pool.terminate()
+                self.__pool = None
+    
+    def __load(self, videofile, observer):
+        # The file is stat'ed before it is read, so that a change made while
+        # reading leaves a signature that will not match
+        path = self.project.get_obsfile(videofile, observer)
+        signature = file_signature(path)
+        return signature, self.project.load_obs_from_file(videofile, observer)
@@ -0,0 +1,289 @@
+"""
+Video metadata (frame rate, duration, frame count and picture size) for every
+video in a project, found with GStreamer's discoverer and kept in
+<project-root>/.tinbergen/videoinfo.json, so that tools can convert between
+times and frames, or close the final bouts of behaviors at the end of a
+video, without opening a pipeline.
+
+Example:
+    cache = probe_videos(project)
+    info = cache.get('a/b/video.mp4')
+    if info is not None:
+        print(info.framerate, info.duration, info.frames)
+    durations = cache.durations()
+
+A video is probed again whenever its size or modification time changes.
+
+Usage from the command line:
+    python tbprobe.py project.tbproj [--processes N] [--timeout SECONDS]
+"""
+
+import os
+import sys
+import json
+import time
+import collections
+import multiprocessing
+import tbdatamodel
+
+# framerate is a fractions.Fraction, duration is in seconds, and frames is the
+# number of frames in the duration at framerate
+VideoInfo = collections.namedtuple('VideoInfo', ['framerate', 'duration',
+                                                 'frames', 'width', 'height'])
+
+cache_version = 1
+default_timeout = 10.0
+
+class ProbeError(RuntimeError):
+    pass
+
+def probe_file(path, timeout=default_timeout):
+    """
+    Find the metadata of a video file, giving up after timeout seconds.
+    Returns a VideoInfo, or raises ProbeError if the file can't be read or
+    has no video stream.
+    """
+    # Imported here so that the rest of the module works without GStreamer
+    import gst
+    import gst.pbutils
+    discoverer = gst.pbutils.Discoverer(int(timeout * gst.SECOND))
+    try:
+        info = discoverer.discover_uri('file://' + os.path.abspath(path))
+    except gst.GError as e:
+        raise ProbeError(str(e))
+    streams = info.get_video_streams()
+    if not streams:
+        raise ProbeError('no video stream')
+    stream = streams[0]
+    if stream.get_framerate_denom() == 0:
+        raise ProbeError('unknown frame rate')
+    framerate = tbdatamodel.frame_rate('{0}/{1}'.format(
+        stream.get_framerate_num(), stream.get_framerate_denom()))
+    duration = float(info.get_duration()) / gst.SECOND
+    return VideoInfo(framerate, duration,
+                     tbdatamodel.time_to_frame(duration, framerate),
+                     stream.get_width(), stream.get_height())
+
+def _probe_task(args):
+    path, timeout = args
+    try:
+        return probe_file(path, timeout), None
+    except ProbeError as e:
+        return None, str(e)
+
+def _probe_worker(task, connection):
+    connection.send(_probe_task(task))
+    connection.close()
+
+def run_probes(tasks, processes=None, grace=5.0, poll_interval=0.05):
+    """
+    Run _probe_task for each (path, timeout) task, each in a process of its
+    own, at most processes (by default, one per CPU) at a time. A process
+    still running grace seconds after its timeout is killed, so a file
+    that hangs GStreamer can hold up neither the caller nor the other files.
+    Returns a list of (info, error) pairs, in order of task.
+    """
+    n_workers = processes or multiprocessing.cpu_count()
+    results = [None] * len(tasks)
+    waiting = list(reversed(range(len(tasks))))
+    running = []
+    while waiting or running:
+        while waiting and len(running) < n_workers:
+            ind = waiting.pop()
+            receiver, sender = multiprocessing.Pipe(False)
+            worker = multiprocessing.Process(target=_probe_worker,
+                                             args=(tasks[ind], sender))
+            worker.daemon = True
+            worker.start()
+            sender.close()
+            deadline = time.time() + tasks[ind][1] + grace
+            running.append((ind, worker, receiver, deadline))
+        still_running = []
+        for ind,worker,receiver,deadline in running:
+            if receiver.poll():
+                try:
+                    results[ind] = receiver.recv()
+                except EOFError:
+                    # The worker died without an answer
+                    results[ind] = (None, 'probe failed')
+            elif time.time() > deadline:
+                worker.terminate()
+                results[ind] = (None, 'timed out')
+            else:
+                still_running.append((ind, worker, receiver, deadline))
+                continue
+            receiver.close()
+            worker.join()
+        if len(still_running) == len(running):
+            time.sleep(poll_interval)
+        running = still_running
+    return results
+
+def file_signature(path):
+    """
+    The size and modification time of a file, as the cache compares them, or
+    None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+class VideoInfoCache(object):
+    """
+    The probed metadata of a project's videos, by video file. Entries are
+    only given out while the video's size and modification time are those
+    it was probed with.
+    """
+    def __init__(self, project, cache_file=None):
+        self.project = project
+        if cache_file is None:
+            cache_file = project.join_cache_path('videoinfo.json')
+        self.cache_file = cache_file
+        self.__entries = dict()
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+            if cached.get('version') == cache_version:
+                # Back to the byte strings used for paths everywhere else
+                self.__entries = dict((videofile.encode('utf-8'), entry)
+                                      for videofile,entry
+                                      in cached['videos'].items())
+    
+    def get(self, videofile):
+        """
+        The VideoInfo of a video file, or None if it has not been probed
+        since it last changed, or could not be probed.
+        """
+        entry = self.__entries.get(videofile)
+        if entry is None or 'error' in entry:
+            return None
+        if entry['signature'] != file_signature(
+                self.project.join_video_path(videofile)):
+            return None
+        return VideoInfo(tbdatamodel.frame_rate(str(entry['framerate'])),
+                         entry['duration'], entry['frames'], entry['width'],
+                         entry['height'])
+    
+    def error(self, videofile):
+        """
+        Why a video file could not be probed, or None if it could.
+        """
+        entry = self.__entries.get(videofile)
+        if entry is None:
+            return None
+        return entry.get('error')
+    
+    def stale(self, videofiles):
+        """
+        The video files in videofiles that have not been probed since they
+        last changed.
+        """
+        stale = []
+        for videofile in videofiles:
+            entry = self.__entries.get(videofile)
+            if entry is None or entry['signature'] != file_signature(
+                    self.project.join_video_path(videofile)):
+                stale.append(videofile)
+        return stale
+    
+    def update(self, videofile, info, error=None, signature=None):
+        """
+        Record the result of probing a video file: its VideoInfo, or None and
+        the reason it failed. signature is the file's signature when it was
+        probed (by default, its current one).
+        """
+        if signature is None:
+            signature = file_signature(self.project.join_video_path(videofile))
+        if info is None:
+            self.__entries[videofile] = {'signature': signature,
+                                         'error': error}
+        else:
+            self.__entries[videofile] = {'signature': signature,
+                                         'framerate': str(info.framerate),
+                                         'duration': info.duration,
+                                         'frames': info.frames,
+                                         'width': info.width,
+                                         'height': info.height}
+    
+    def save(self):
+        """
+        Write the cache to disk.
+        """
+        cache_dir = os.path.dirname(self.cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        temp_file = '{0}.{1}.tmp'.format(self.cache_file, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump({'version': cache_version, 'videos': self.__entries}, f)
+        os.rename(temp_file, self.cache_file)
+    
+    def durations(self):
+        """
+        The duration of every video with known metadata, as a dict of
+        seconds by video file (as tbanalysis.project_cooccurrence and
+        tbexport.export_project take them).
+        """
+        return self.__known('duration')
+    
+    def framerates(self):
+        """
+        The frame rate of every video with known metadata, as a dict by
+        video file.
+        """
+        return self.__known('framerate')
+    
+    def __known(self, field):
+        known = dict()
+        for videofile in self.__entries:
+            info = self.get(videofile)
+            if info is not None:
+                known[videofile] = getattr(info, field)
+        return known
+
+def probe_videos(project, videofiles=None, processes=None,
+                 timeout=default_timeout, cache=None):
+    """
+    Probe every video file in a project (or in videofiles) that has changed
+    since it was last probed, each in a worker process of its own (see
+    run_probes), giving up on any file after timeout seconds. The results
+    are saved, and the VideoInfoCache (cache, or the project's) is returned.
+    """
+    if cache is None:
+        cache = VideoInfoCache(project)
+    if videofiles is None:
+        videofiles = project.video_files
+    todo = cache.stale(videofiles)
+    if not todo:
+        return cache
+    signatures = [file_signature(project.join_video_path(videofile))
+                  for videofile in todo]
+    tasks = [(project.join_video_path(videofile), timeout)
+             for videofile in todo]
+    results = run_probes(tasks, processes)
+    for videofile,signature,(info,error) in zip(todo, signatures, results):
+        cache.update(videofile, info, error, signature)
+    cache.save()
+    return cache
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Find the frame rate and duration of project videos.')
+    parser.add_argument('project_file')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--timeout', type=float, default=default_timeout,
+                        help='seconds to allow for each video')
+    args = parser.parse_args()
+    project = tbdatamodel.Project(args.project_file, use_cache=True)
+    cache = probe_videos(project, processes=args.processes,
+                         timeout=args.timeout)
+    failed = [videofile for videofile in project.video_files
+              if cache.error(videofile) is not None]
+    for videofile in failed:
+        sys.stderr.write('{0}: {1}\n'.format(videofile,
+                                             cache.error(videofile)))
+    sys.stderr.write('{0} video(s), {1} could not be probed\n'.format(
+        len(project.video_files), len(failed)))
@@ -0,0 +1,196 @@
+"""
+Optional instrumentation of Tinbergen, for finding out where the time goes in
+a coding session.
+
+Nothing is changed unless profiling is turned on, either on the command line
+or through the environment:
+    python tinbergen.py project.tbproj --profile[=DIR] [--cprofile]
+    TINBERGEN_PROFILE=DIR TINBERGEN_CPROFILE=1 python tinbergen.py ...
+enable() then wraps the functions in data_targets, and instrument_ui wraps
+the GTK callbacks and seeks of the main window, so that every call is
+counted and timed. When the program exits, a JSON summary is written to DIR
+(by default the current directory) as tinbergen-profile-<time>-<pid>.json,
+and with --cprofile, the cProfile statistics of the main thread are saved
+next to it as a .prof file (see the pstats module).
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import functools
+import threading
+import tbdatamodel
+
+env_var = 'TINBERGEN_PROFILE'
+cprofile_env_var = 'TINBERGEN_CPROFILE'
+
+# (owner, attribute) for each function timed by enable()
+data_targets = [(tbdatamodel.Project, 'update_video_list'),
+                (tbdatamodel.Project, 'get_video_observers'),
+                (tbdatamodel.Project, 'load_obs_from_file'),
+                (tbdatamodel.Project, 'save_obslist'),
+                (tbdatamodel.Ethogram, 'parse_entry'),
+                (tbdatamodel, 'parse_keyvals')]
+
+class Metrics(object):
+    """
+    Call counts and times, by name. Safe to use from several threads.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.calls = dict()
+        self.total = dict()
+        self.longest = dict()
+        self.started = time.time()
+    
+    def record(self, name, seconds):
+        """
+        Record one call of name, which took seconds.
+        """
+        with self.__lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.total[name] = self.total.get(name, 0.0) + seconds
+            self.longest[name] = max(self.longest.get(name, 0.0), seconds)
+    
+    def summary(self):
+        """
+        The metrics as a JSON-ready dict.
+        """
+        with self.__lock:
+            metrics = dict((name, {'calls': self.calls[name],
+                                   'total': self.total[name],
+                                   'mean': self.total[name] / self.calls[name],
+                                   'max': self.longest[name]})
+                           for name in self.calls)
+        return {'started': self.started,
+                'duration': time.time() - self.started,
+                'pid': os.getpid(),
+                'argv': sys.argv,
+                'metrics': metrics}
+
+_metrics = None
+_originals = []
+_profiler = None
+
+def is_enabled():
+    return _metrics is not None
+
+def timed(func, name):
+    """
+    Wrap func so that each call is recorded under name.
+    """
+    @functools.wraps(func)
+    def wrapper(*pargs, **kargs):
+        start = time.time()
+        try:
+            return func(*pargs, **kargs)
+        finally:
+            _metrics.record(name, time.time() - start)
+    return wrapper
+
+def instrument(owner, attr, name=None):
+    """
+    Replace the function owner.attr (owner being a class or module) with a
+    timed version. name defaults to "Owner.attr", or "attr" for a module
+    function. Does nothing unless profiling is enabled.
+    """
+    if _metrics is None:
+        return
+    func = vars(owner)[attr]
+    if name is None:
+        if isinstance(owner, type(sys)):
+            name = attr
+        else:
+            name = owner.__name__ + '.' + attr
+    _originals.append((owner, attr, func))
+    setattr(owner, attr, timed(func, name))
+
+def instrument_ui(cls):
+    """
+    Time the GTK callbacks (the on_* methods) and the seeks of the main
+    window class, if profiling is enabled. Must be called before the window
+    is created, since signals are connected to the methods found then.
+    """
+    if _metrics is None:
+        return
+    for attr in sorted(vars(cls)):
+        if attr.startswith('on_') and callable(vars(cls)[attr]):
+            instrument(cls, attr)
+    instrument(cls, 'set_current_time')
+
+def enable(output_dir='.', use_cprofile=False):
+    """
+    Turn on profiling: time the functions in data_targets, and write a
+    summary (and cProfile statistics if use_cprofile) to output_dir at exit.
+    """
+    global _metrics, _profiler
+    if _metrics is not None:
+        return
+    _metrics = Metrics()
+    for owner,attr in data_targets:
+        instrument(owner, attr)
+    if use_cprofile:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    atexit.register(dump, output_dir)
+
+def disable():
+    """
+    Turn off profiling and put back the original functions. Returns the
+    metrics collected.
+    """
+    global _metrics, _profiler
+    metrics = _metrics
+    while _originals:
+        owner, attr, func = _originals.pop()
+        setattr(owner, attr, func)
+    if _profiler is not None:
+        _profiler.disable()
+    _metrics = None
+    _profiler = None
+    return metrics
+
+def dump(output_dir='.'):
+    """
+    Write the summary of this session (and the cProfile statistics, if
+    collected) to output_dir. Returns the path of the summary.
+    """
+    if _metrics is None:
+        return None
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    stem = os.path.join(output_dir, 'tinbergen-profile-{0}-{1}'.format(
+        time.strftime('%Y%m%d-%H%M%S', time.localtime(_metrics.started)),
+        os.getpid()))
+    with open(stem + '.json', 'w') as f:
+        json.dump(_metrics.summary(), f, indent=1, sort_keys=True)
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(stem + '.prof')
+    return stem + '.json'
+
+def configure(argv):
+    """
+    Enable profiling if it was asked for with --profile[=DIR] and --cprofile
+    in argv, or through the environment. Returns argv without those options.
+    """
+    output_dir = os.environ.get(env_var)
+    use_cprofile = bool(os.environ.get(cprofile_env_var))
+    remaining = []
+    for arg in argv:
+        if arg == '--profile':
+            output_dir = output_dir or '.'
+        elif arg.startswith('--profile='):
+            output_dir = arg.partition('=')[2]
+        elif arg == '--cprofile':
+            use_cprofile = True
+        else:
+            remaining.append(arg)
+    if use_cprofile and output_dir is None:
+        output_dir = '.'
+    if output_dir is not None:
+        enable(output_dir, use_cprofile)
+    return remaining
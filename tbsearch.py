@@ -0,0 +1,273 @@
+"""
+An inverted index over the observations of a project, for finding every row
+coded with a given entry, symbol, behavior or value, or every row whose entry
+did not parse into a behavior.
+
+Example:
+    index = build_index(project)
+    for hit in index.search(entry='sco 3'):
+        print(hit.video, hit.observer, hit.row, hit.time)
+    index.search(behavior='Locomotion', value='run', observer='aaa')
+    index.search(unparsed=True)
+
+Rows are numbered from 0 in file order, as returned by
+Project.load_obs_from_file.
+"""
+
+import array
+import bisect
+import collections
+import multiprocessing
+import tbdatamodel
+
+SearchHit = collections.namedtuple('SearchHit',
+                                   ['video', 'observer', 'row', 'time'])
+
+# Each posting is a file number and a row number packed into one integer, so
+# that a posting list is a single sorted array
+row_bits = 32
+row_mask = (1 << row_bits) - 1
+
+def obs_terms(obs):
+    """
+    The (field, term) keys under which an observation is indexed: its entry,
+    the entry's symbol, and its behavior and value, or ('unparsed', '') if
+    the entry did not name a behavior.
+    """
+    entry = tbdatamodel.obs_entry(obs)
+    terms = [('entry', entry)]
+    if entry.strip():
+        terms.append(('symbol', entry.split()[0]))
+    name = obs.get('name')
+    if name is None:
+        terms.append(('unparsed', ''))
+    else:
+        terms.append(('behavior', name))
+    value = obs.get('value')
+    if value is not None:
+        if not isinstance(value, str):
+            value = ','.join(value)
+        terms.append(('value', value))
+    return terms
+
+def file_postings(obslist):
+    """
+    Index one observation set. Returns a dict mapping each (field, term) key
+    to a pair of arrays: the rows with that key, and their times (nan where
+    the time is missing).
+    """
+    postings = dict()
+    for row,obs in enumerate(obslist):
+        try:
+            time = float(obs.get('time'))
+        except (TypeError, ValueError):
+            time = float('nan')
+        for key in obs_terms(obs):
+            if key not in postings:
+                postings[key] = (array.array('l'), array.array('d'))
+            rows, times = postings[key]
+            rows.append(row)
+            times.append(time)
+    return postings
+
+class ObsIndex(object):
+    """
+    The inverted index. For each (field, term) key it holds a sorted array of
+    postings (file and row numbers packed together) and a parallel array of
+    times. A file that is indexed again gets a new file number, and its old
+    postings are skipped until there are enough of them to be worth
+    compacting away.
+    """
+    def __init__(self):
+        # file number -> (video, observer), or None once re-indexed
+        self.__files = []
+        self.__file_numbers = dict()
+        self.__postings = dict()
+        self.__times = dict()
+        self.n_rows = 0
+        self.__dead_rows = 0
+        self.__file_rows = []
+    
+    def add_file(self, video, observer, obslist):
+        """
+        Index (or re-index) the observations of a video and observer.
+        """
+        self.add_postings(video, observer, file_postings(obslist),
+                          len(obslist))
+    
+    def add_postings(self, video, observer, postings, n_rows):
+        """
+        Add the result of file_postings for a video and observer, replacing
+        anything indexed for them before.
+        """
+        self.remove_file(video, observer)
+        number = len(self.__files)
+        if number > row_mask:
+            self.compact()
+            number = len(self.__files)
+        self.__files.append((video, observer))
+        self.__file_rows.append(n_rows)
+        self.__file_numbers[video, observer] = number
+        self.n_rows += n_rows
+        base = number << row_bits
+        for key,(rows,times) in postings.items():
+            if key not in self.__postings:
+                self.__postings[key] = array.array('l')
+                self.__times[key] = array.array('d')
+            self.__postings[key].extend(base + row for row in rows)
+            self.__times[key].extend(times)
+    
+    def remove_file(self, video, observer):
+        """
+        Forget the observations of a video and observer.
+        """
+        number = self.__file_numbers.pop((video, observer), None)
+        if number is None:
+            return
+        self.__files[number] = None
+        self.n_rows -= self.__file_rows[number]
+        self.__dead_rows += self.__file_rows[number]
+        if self.__dead_rows > max(self.n_rows, 100000):
+            self.compact()
+    
+    def compact(self):
+        """
+        Drop the postings of removed files, and renumber the files.
+        """
+        renumber = dict()
+        files = []
+        file_rows = []
+        for number,pair in enumerate(self.__files):
+            if pair is not None:
+                renumber[number] = len(files)
+                files.append(pair)
+                file_rows.append(self.__file_rows[number])
+        for key in list(self.__postings):
+            postings = array.array('l')
+            times = array.array('d')
+            for posting,time in zip(self.__postings[key], self.__times[key]):
+                number = renumber.get(posting >> row_bits)
+                if number is not None:
+                    postings.append((number << row_bits) |
+                                    (posting & row_mask))
+                    times.append(time)
+            if postings:
+                self.__postings[key] = postings
+                self.__times[key] = times
+            else:
+                del self.__postings[key]
+                del self.__times[key]
+        self.__files = files
+        self.__file_rows = file_rows
+        self.__file_numbers = dict((pair, number)
+                                   for number,pair in enumerate(files))
+        self.__dead_rows = 0
+    
+    def terms(self, field):
+        """
+        All the indexed terms of a field, sorted.
+        """
+        return sorted(term for f,term in self.__postings if f == field)
+    
+    def search(self, entry=None, symbol=None, behavior=None, value=None,
+               unparsed=False, observer=None, video=None, limit=None):
+        """
+        Find the rows matching every one of the given terms, optionally only
+        those of one observer or video. At least one of entry, symbol,
+        behavior, value or unparsed must be given. Returns a list of up to
+        limit SearchHit tuples, in order of file and row.
+        """
+        keys = [(field, term) for field,term in (('entry', entry),
+                                                 ('symbol', symbol),
+                                                 ('behavior', behavior),
+                                                 ('value', value))
+                if term is not None]
+        if unparsed:
+            keys.append(('unparsed', ''))
+        if not keys:
+            raise ValueError('A search needs at least one term')
+        if any(key not in self.__postings for key in keys):
+            return []
+        # Walk the shortest posting list, and look each posting up in the
+        # others, which are sorted
+        keys.sort(key=lambda key: len(self.__postings[key]))
+        driver = self.__postings[keys[0]]
+        driver_times = self.__times[keys[0]]
+        others = [self.__postings[key] for key in keys[1:]]
+        hits = []
+        for ind,posting in enumerate(driver):
+            pair = self.__files[posting >> row_bits]
+            if pair is None:
+                continue
+            if ((observer is not None and pair[1] != observer) or
+                    (video is not None and pair[0] != video)):
+                continue
+            found = True
+            for other in others:
+                pos = bisect.bisect_left(other, posting)
+                if pos == len(other) or other[pos] != posting:
+                    found = False
+                    break
+            if found:
+                hits.append(SearchHit(pair[0], pair[1], posting & row_mask,
+                                      driver_times[ind]))
+                if limit is not None and len(hits) >= limit:
+                    break
+        return hits
+
+def parse_query(text):
+    """
+    Turn a query typed into the search panel into keyword arguments for
+    ObsIndex.search. The query is a list of field:term words, with fields
+    entry, symbol, behavior, value, observer and video, and the word
+    "unparsed". Any other text is matched against whole entries if it has
+    more than one word, and against symbols otherwise. For example:
+        sco 3                   rows with the entry "sco 3"
+        lwa observer:aaa        rows with symbol lwa, by observer aaa
+        behavior:Locomotion value:run
+        unparsed
+    """
+    query = dict()
+    words = []
+    for word in text.split():
+        field, sep, term = word.partition(':')
+        if sep and field in ('entry', 'symbol', 'behavior', 'value',
+                             'observer', 'video'):
+            query[field] = term
+        elif word == 'unparsed':
+            query['unparsed'] = True
+        else:
+            words.append(word)
+    if len(words) > 1:
+        query['entry'] = ' '.join(words)
+    elif words:
+        query['symbol'] = words[0]
+    return query
+
+def _index_file_task(path):
+    obslist = tbdatamodel.read_obsfile(path)
+    return file_postings(obslist), len(obslist)
+
+def build_index(project, processes=None, pairs=None):
+    """
+    Index every observation file in a project (or those in pairs, a list of
+    (videofile, observer) pairs), reading and indexing the files in a pool
+    of worker processes. Returns an ObsIndex.
+    """
+    if pairs is None:
+        pairs = project.list_obsfiles()
+    paths = [project.get_obsfile(videofile, observer)
+             for videofile,observer in pairs]
+    if len(paths) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_index_file_task, paths, chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_index_file_task(path) for path in paths]
+    index = ObsIndex()
+    for (videofile,observer),(postings,n_rows) in zip(pairs, results):
+        index.add_postings(videofile, observer, postings, n_rows)
+    return index
@@ -0,0 +1,223 @@
+"""
+Batch validation of stored observations against a project's ethogram.
+
+Usage from the command line:
+    python tbvalidate.py project.tbproj [--incremental] [--processes N]
+Prints one line per problem, as file:line: key: reason.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import collections
+import multiprocessing
+import tbdatamodel
+
+ValidationIssue = collections.namedtuple('ValidationIssue',
+                                         ['file', 'line', 'key', 'reason'])
+
+class ObsValidator(object):
+    """
+    Checks observations against an ethogram. The behavior kinds, the allowed
+    values of state and binary behaviors, and the known symbols are all
+    gathered up front into plain sets and dicts, so that checking a row is a
+    handful of lookups (and so the validator can be sent to worker processes).
+    """
+    def __init__(self, ethogram):
+        self.kinds = dict()
+        self.values = dict()
+        for name,behavior in ethogram.behaviors.items():
+            self.kinds[name] = behavior['kind']
+            if 'values' in behavior:
+                self.values[name] = frozenset(behavior['values'])
+        self.symbols = frozenset(ethogram.codes)
+    
+    def fingerprint(self):
+        """
+        A string identifying the ethogram rules used by this validator. Saved
+        results are only reused if the fingerprint has not changed.
+        """
+        rules = (sorted(self.kinds.items()),
+                 sorted((name, sorted(vals)) for name,vals in self.values.items()),
+                 sorted(self.symbols))
+        return hashlib.sha1(repr(rules)).hexdigest()
+    
+    def check(self, obs):
+        """
+        Check a single observation. Returns a list of (key, reason) pairs, which
+        is empty if the observation is valid.
+        """
+        problems = []
+        try:
+            float(obs.get('time'))
+        except (TypeError, ValueError):
+            problems.append(('time', 'missing or non-numeric time'))
+        if 'frame' in obs:
+            try:
+                if int(obs['frame']) < 0:
+                    problems.append(('frame', 'negative frame number'))
+            except (TypeError, ValueError):
+                problems.append(('frame', 'non-integer frame number'))
+        entry = tbdatamodel.obs_entry(obs)
+        symbol = entry.split()[0] if entry.strip() else ''
+        if not symbol:
+            problems.append(('entry', 'empty entry'))
+        elif symbol not in self.symbols:
+            problems.append(('entry', 'unknown symbol {0!r}'.format(symbol)))
+        name = obs.get('name')
+        if name is None:
+            problems.append(('name', 'no behavior'))
+            return problems
+        kind = self.kinds.get(name)
+        if kind is None:
+            problems.append(('name', 'unknown behavior {0!r}'.format(name)))
+            return problems
+        if obs.get('kind') != kind:
+            problems.append(('kind', 'kind {0!r} does not match {1!r}'.format(
+                obs.get('kind'), kind)))
+        if name in self.values and obs.get('value') not in self.values[name]:
+            problems.append(('value', 'invalid value {0!r} for {1}'.format(
+                obs.get('value'), name)))
+        return problems
+    
+    def check_file(self, path, filename=None):
+        """
+        Check every observation in a .tbobs file. Issues are reported against
+        filename (by default, path) and the 1-based line number in the file.
+        """
+        if filename is None:
+            filename = path
+        issues = []
+        with tbdatamodel.open_obsfile(path) as f:
+            for lineno,line in enumerate(f, 1):
+                head,sep,tail = line.partition(':')
+                if head.strip() != 'obs':
+                    continue
+                obs = tbdatamodel.parse_keyvals(tail.strip())
+                for key,reason in self.check(obs):
+                    issues.append(ValidationIssue(filename, lineno, key, reason))
+        return issues
+
+class ValidationReport(object):
+    """
+    The result of validating a project: a list of ValidationIssue tuples in
+    file and line order, plus the number of files that were checked and the
+    number whose results were reused from a previous run.
+    """
+    def __init__(self, issues, checked, reused):
+        self.issues = issues
+        self.checked = checked
+        self.reused = reused
+    
+    def by_file(self):
+        """
+        Group the issues into a dict mapping each file to its issues.
+        """
+        grouped = collections.OrderedDict()
+        for issue in self.issues:
+            grouped.setdefault(issue.file, []).append(issue)
+        return grouped
+    
+    def __len__(self):
+        return len(self.issues)
+    
+    def __iter__(self):
+        return iter(self.issues)
+    
+    def __str__(self):
+        return '\n'.join('{0}:{1}: {2}: {3}'.format(*issue)
+                         for issue in self.issues)
+
+_worker_validator = None
+
+def _init_worker(validator):
+    global _worker_validator
+    _worker_validator = validator
+
+def _check_file_task(task):
+    path, filename = task
+    return filename, _worker_validator.check_file(path, filename)
+
+def validate_project(project, processes=None, incremental=False,
+                     state_file=None):
+    """
+    Check every observation file in a project against the project's ethogram,
+    spreading the files over a pool of worker processes. Returns a
+    ValidationReport.
+    
+    With incremental=True, the results of the previous run are kept in
+    state_file (by default <project-root>/.tinbergen/validation.json), and
+    only files whose modification time or size have changed since then (or
+    every file, if the ethogram has changed) are checked again.
+    """
+    validator = ObsValidator(project.ethogram)
+    fingerprint = validator.fingerprint()
+    if state_file is None:
+        state_file = project.join_cache_path('validation.json')
+    previous = {}
+    if incremental and os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        if state.get('ethogram') == fingerprint:
+            previous = state.get('files', {})
+    
+    files = {}
+    tasks = []
+    issues = []
+    for videofile,observer in project.list_obsfiles():
+        path = project.get_obsfile(videofile, observer)
+        filename = project.rel_project_path(path)
+        stat = os.stat(path)
+        files[filename] = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        old = previous.get(filename)
+        if (old is not None and old['mtime'] == stat.st_mtime and
+                old['size'] == stat.st_size):
+            files[filename]['issues'] = old['issues']
+            issues.extend(ValidationIssue(filename, *item)
+                          for item in old['issues'])
+        else:
+            tasks.append((path, filename))
+    
+    if len(tasks) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (validator,))
+        try:
+            results = pool.map(_check_file_task, tasks, chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(validator)
+        results = [_check_file_task(task) for task in tasks]
+    for filename,file_issues in results:
+        files[filename]['issues'] = [issue[1:] for issue in file_issues]
+        issues.extend(file_issues)
+    
+    if incremental:
+        state_dir = os.path.dirname(state_file)
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump({'ethogram': fingerprint, 'files': files}, f)
+        os.rename(state_file + '.tmp', state_file)
+    
+    issues.sort(key=lambda issue: (issue.file, issue.line))
+    return ValidationReport(issues, len(tasks), len(files) - len(tasks))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Check observation files against the project ethogram.')
+    parser.add_argument('project_file')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only re-check files changed since the last run')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes')
+    args = parser.parse_args()
+    project = tbdatamodel.Project(args.project_file)
+    report = validate_project(project, args.processes, args.incremental)
+    if len(report):
+        print(report)
+    sys.stderr.write('{0} issue(s); {1} file(s) checked, {2} unchanged\n'
+                     .format(len(report), report.checked, report.reused))
+    sys.exit(1 if len(report) else 0)
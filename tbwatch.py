@@ -0,0 +1,472 @@
+"""
+Watching a project's directories for changes made by other coders.
+
+A ProjectWatcher runs in a background thread and reports new, removed and
+modified video and observation files as they appear under <video-root> and
+<project-root>, so that the project's video list and observer index can be
+updated one file at a time instead of walking the whole tree again.
+
+On Linux, changes are picked up through inotify. inotify only sees changes
+made by the local machine, so directories on network file systems (NFS, CIFS
+and the like), and systems without inotify, fall back to polling the
+modification times of the known directories and observation files.
+"""
+
+import os
+import errno
+import select
+import struct
+import threading
+import collections
+import ctypes
+import ctypes.util
+import tbdatamodel
+
+# A change to a file. kind is 'added', 'removed' or 'modified'; root is
+# 'video' or 'project'; path is relative to that root, in the same form as
+# Project.video_files.
+FileEvent = collections.namedtuple('FileEvent', ['kind', 'root', 'path'])
+
+network_fs_types = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'ncpfs',
+                    'fuse.sshfs', '9p', 'vboxsf', 'prl_fs', 'vmhgfs')
+
+def is_network_path(path):
+    """
+    Check whether a path is on a network file system, by finding the mount
+    point containing it in /proc/mounts. Returns False if this can't be
+    determined.
+    """
+    path = os.path.realpath(path)
+    best_mount, best_type = '', ''
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                if ((path == mount or path.startswith(mount.rstrip('/') + '/'))
+                        and len(mount) > len(best_mount)):
+                    best_mount, best_type = mount, fields[2]
+    except IOError:
+        return False
+    return best_type in network_fs_types
+
+class PollingWatcher(object):
+    """
+    Watches a set of directory trees by polling. Each poll stats every known
+    directory, lists again only the directories whose modification time has
+    changed, and stats the files selected by the interesting function (a
+    predicate on absolute paths) to notice modifications. Events are
+    (kind, path) pairs with absolute paths, for interesting files only.
+    """
+    def __init__(self, roots, interesting):
+        self.roots = roots
+        self.interesting = interesting
+        self._stop = threading.Event()
+        # directory -> {name: is_dir}
+        self._listings = dict()
+        self._dir_mtimes = dict()
+        # interesting file -> (mtime, size)
+        self._file_stats = dict()
+        for root in roots:
+            if root not in self._listings:
+                self._scan_dir(root, None)
+    
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds, then return a list of the changes since
+        the last call.
+        """
+        self._stop.wait(timeout)
+        if self._stop.is_set():
+            return []
+        return self.poll()
+    
+    def poll(self):
+        """
+        Check for changes right away, and return them as a list of events.
+        """
+        events = []
+        for dirpath in list(self._listings):
+            if dirpath not in self._listings:
+                # Removed while handling an earlier directory
+                continue
+            try:
+                mtime = os.stat(dirpath).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self._dir_mtimes.get(dirpath):
+                self._rescan_dir(dirpath, events)
+        changed = set(path for kind,path in events)
+        for path,old_stat in self._file_stats.items():
+            if path in changed:
+                continue
+            stat = self._stat(path)
+            if stat != old_stat:
+                self._file_stats[path] = stat
+                events.append(('modified', path))
+        return events
+    
+    def is_stopped(self):
+        return self._stop.is_set()
+    
+    def stop(self):
+        """
+        Make any wait in progress return immediately.
+        """
+        self._stop.set()
+    
+    def close(self):
+        self.stop()
+    
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+    
+    def _list_dir(self, dirpath):
+        listing = dict()
+        try:
+            mtime = os.stat(dirpath).st_mtime
+            names = os.listdir(dirpath)
+        except OSError:
+            return None, None
+        for name in names:
+            listing[name] = os.path.isdir(os.path.join(dirpath, name))
+        return listing, mtime
+    
+    def _scan_dir(self, dirpath, events):
+        # Start tracking a directory and everything below it. If events is a
+        # list, every interesting file found is reported as added.
+        listing, mtime = self._list_dir(dirpath)
+        if listing is None:
+            return
+        self._listings[dirpath] = listing
+        self._dir_mtimes[dirpath] = mtime
+        self._dir_added(dirpath)
+        for name,is_dir in listing.items():
+            path = os.path.join(dirpath, name)
+            if is_dir:
+                if path not in self._listings:
+                    self._scan_dir(path, events)
+            elif self.interesting(path):
+                self._file_stats[path] = self._stat(path)
+                if events is not None:
+                    events.append(('added', path))
+    
+    def _forget_dir(self, dirpath, events):
+        # Stop tracking a directory that has gone away, reporting its
+        # interesting files as removed.
+        listing = self._listings.pop(dirpath, {})
+        self._dir_mtimes.pop(dirpath, None)
+        self._dir_removed(dirpath)
+        for name,is_dir in listing.items():
+            path = os.path.join(dirpath, name)
+            if is_dir:
+                self._forget_dir(path, events)
+            elif path in self._file_stats:
+                del self._file_stats[path]
+                events.append(('removed', path))
+    
+    def _rescan_dir(self, dirpath, events):
+        # List a known directory again and report the differences.
+        old = self._listings.get(dirpath)
+        if old is None:
+            return
+        new, mtime = self._list_dir(dirpath)
+        if new is None:
+            self._forget_dir(dirpath, events)
+            return
+        self._listings[dirpath] = new
+        self._dir_mtimes[dirpath] = mtime
+        for name in set(old) | set(new):
+            path = os.path.join(dirpath, name)
+            was_dir, is_dir = old.get(name), new.get(name)
+            if was_dir and not is_dir:
+                self._forget_dir(path, events)
+            elif was_dir is False and path in self._file_stats:
+                if is_dir is None or is_dir:
+                    del self._file_stats[path]
+                    events.append(('removed', path))
+                else:
+                    # Still here, but possibly replaced by a rename
+                    stat = self._stat(path)
+                    if stat != self._file_stats[path]:
+                        self._file_stats[path] = stat
+                        events.append(('modified', path))
+            if is_dir and not was_dir:
+                self._scan_dir(path, events)
+            elif (is_dir is False and path not in self._file_stats and
+                    self.interesting(path)):
+                self._file_stats[path] = self._stat(path)
+                events.append(('added', path))
+    
+    def _dir_added(self, dirpath):
+        pass
+    
+    def _dir_removed(self, dirpath):
+        pass
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Watches a set of directory trees using Linux inotify. inotify tells us
+    which directories have changed and which files have been rewritten, and
+    only those are examined; nothing is polled. Raises OSError if inotify is
+    unavailable or runs out of watches.
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+    watch_mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    dir_change_mask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    event_struct = struct.Struct('iIII')
+    
+    def __init__(self, roots, interesting):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # stop writes to this pipe to wake a wait blocked in select
+        self._wake_read, self._wake_write = os.pipe()
+        self._watches = dict()
+        self._watch_dirs = dict()
+        self._initializing = True
+        try:
+            PollingWatcher.__init__(self, roots, interesting)
+        except OSError:
+            for fd in (self._fd, self._wake_read, self._wake_write):
+                os.close(fd)
+            raise
+        self._initializing = False
+    
+    def wait(self, timeout):
+        if self._stop.is_set():
+            return []
+        try:
+            ready = select.select([self._fd, self._wake_read], [], [],
+                                  timeout)[0]
+        except (select.error, ValueError):
+            return []
+        if not ready or self._stop.is_set():
+            return []
+        return self.poll()
+    
+    def poll(self):
+        dirty_dirs = set()
+        written = set()
+        overflow = False
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not buf:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = self.event_struct.unpack_from(buf,
+                                                                         pos)
+                pos += self.event_struct.size
+                name = buf[pos:pos+length].rstrip('\0')
+                pos += length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                dirpath = self._watch_dirs.get(wd)
+                if dirpath is None:
+                    continue
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    dirty_dirs.add(os.path.dirname(dirpath))
+                elif mask & self.dir_change_mask:
+                    dirty_dirs.add(dirpath)
+                elif mask & self.IN_CLOSE_WRITE:
+                    written.add(os.path.join(dirpath, name))
+        if overflow:
+            # Events were lost; fall back to a full poll this one time.
+            return PollingWatcher.poll(self)
+        events = []
+        for dirpath in sorted(dirty_dirs):
+            self._rescan_dir(dirpath, events)
+        changed = set(path for kind,path in events)
+        for path in written - changed:
+            if path in self._file_stats:
+                self._file_stats[path] = self._stat(path)
+                events.append(('modified', path))
+        return events
+    
+    def stop(self):
+        PollingWatcher.stop(self)
+        if self._wake_write >= 0:
+            try:
+                os.write(self._wake_write, b'x')
+            except OSError:
+                pass
+    
+    def close(self):
+        self.stop()
+        for name in ('_fd', '_wake_read', '_wake_write'):
+            fd = getattr(self, name)
+            if fd >= 0:
+                os.close(fd)
+                setattr(self, name, -1)
+    
+    def _dir_added(self, dirpath):
+        wd = self._libc.inotify_add_watch(self._fd, dirpath, self.watch_mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC and self._initializing:
+                raise OSError(err, 'out of inotify watches')
+            # Later on, a directory we can't watch is still listed again if
+            # its parent changes; we just won't hear about changes inside it.
+            return
+        self._watches[dirpath] = wd
+        self._watch_dirs[wd] = dirpath
+    
+    def _dir_removed(self, dirpath):
+        wd = self._watches.pop(dirpath, None)
+        if wd is not None:
+            self._watch_dirs.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+class ProjectWatcher(object):
+    """
+    Keeps a Project's video list and observer index up to date as files are
+    added, removed and modified under its video and project roots.
+    
+    Changes are collected in a background thread and passed as a list of
+    FileEvent tuples to callback. By default the callback is apply_events,
+    which updates the project directly; a GUI should instead pass a callback
+    that hands the events to its main loop, and call apply_events there.
+        
+        watcher = ProjectWatcher(project)
+        watcher.start()
+        ...
+        watcher.stop()
+    
+    method may be 'inotify', 'poll' or None (choose automatically).
+    """
+    def __init__(self, project, callback=None, interval=2.0, method=None):
+        self.project = project
+        if callback is None:
+            callback = lambda events: apply_events(project, events)
+        self.callback = callback
+        self.interval = interval
+        self.method = method
+        self.watcher = None
+        self._thread = None
+        self._video_root = os.path.abspath(project.join_video_path())
+        self._project_root = os.path.abspath(project.join_project_path())
+    
+    def start(self, build_index=True):
+        """
+        Build the project's observer index (unless build_index is False, when
+        the caller builds it) and begin watching.
+        """
+        if build_index:
+            self.project.build_observer_index()
+        roots = [self._video_root, self._project_root]
+        method = self.method
+        if method is None:
+            if any(is_network_path(root) for root in roots):
+                method = 'poll'
+            else:
+                method = 'inotify'
+        self.watcher = None
+        if method == 'inotify':
+            try:
+                self.watcher = InotifyWatcher(roots, self.is_interesting)
+            except OSError:
+                self.watcher = None
+        if self.watcher is None:
+            self.watcher = PollingWatcher(roots, self.is_interesting)
+        self._thread = threading.Thread(target=self._run,
+                                        name='tinbergen-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        """
+        Stop watching. No callbacks are made after stop returns.
+        """
+        if self.watcher is None:
+            return
+        self.watcher.stop()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.watcher.close()
+        self.watcher = None
+    
+    def is_interesting(self, path):
+        return bool(self.classify(path))
+    
+    def classify(self, path):
+        """
+        Translate an absolute path to a list of (root, relative path) pairs,
+        one for each root in which the path names a file we care about: a
+        movie file under video-root or an observation file under project-root.
+        """
+        found = []
+        dirname, filename = os.path.split(path)
+        if (self._within(path, self._video_root) and
+                tbdatamodel.is_video_file(filename)):
+            found.append(('video', os.path.join(
+                self.project.rel_video_path(dirname), filename)))
+        if self._within(path, self._project_root):
+            relpath = os.path.join(self.project.rel_project_path(dirname),
+                                   filename)
+            if tbdatamodel.split_obsfile_name(relpath) is not None:
+                found.append(('project', relpath))
+        return found
+    
+    @staticmethod
+    def _within(path, root):
+        return path.startswith(root.rstrip(os.sep) + os.sep)
+    
+    def _run(self):
+        watcher = self.watcher
+        while not watcher.is_stopped():
+            changes = watcher.wait(self.interval)
+            events = []
+            for kind,path in changes:
+                for root,relpath in self.classify(path):
+                    events.append(FileEvent(kind, root, relpath))
+            if events and not watcher.is_stopped():
+                self.callback(events)
+
+def apply_events(project, events):
+    """
+    Apply a list of FileEvent tuples to a project's video list and observer
+    index.
+    """
+    for event in events:
+        if event.root == 'video':
+            if event.kind == 'added':
+                project.add_video_file(event.path)
+            elif event.kind == 'removed':
+                project.remove_video_file(event.path)
+        elif event.root == 'project':
+            videofile, observer = tbdatamodel.split_obsfile_name(event.path)
+            if event.kind == 'added':
+                project.add_video_observer(videofile, observer)
+            elif event.kind == 'removed':
+                project.remove_video_observer(videofile, observer)
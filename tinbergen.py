@@ -10,7 +10,15 @@ import gobject
 import gtk
 import gst
 import tbdatamodel
+import tbwatch
+import tbprofile
+import tbprefetch
+import tbsearch
+import tbprobe
 import string
+import threading
+import timeit
+import collections
 #import math
 
 NO_TIME = float('nan')
@@ -23,6 +31,71 @@ else:
     script_dir = os.path.dirname(__file__)
 mainwin_gladefile = os.path.join(script_dir, 'tb_mainwin.glade')
 
+class PipelinePool(object):
+    """
+    A few playbin2 pipelines kept paused on the videos next to the one being
+    coded, so that switching to one of them does not have to wait for the
+    video to open and preroll. Pipelines are made by make_pipeline(), at most
+    size of them are kept, and those no longer wanted are stopped and reused.
+    """
+    def __init__(self, make_pipeline, size=2):
+        self.make_pipeline = make_pipeline
+        self.size = size
+        # uri -> pipeline paused (or pausing) on that uri
+        self.warm = collections.OrderedDict()
+        self.spare = []
+    
+    def preroll(self, uris):
+        """
+        Keep pipelines paused on the given uris (the first size of them),
+        stopping any others.
+        """
+        uris = uris[:self.size]
+        for uri in list(self.warm):
+            if uri not in uris:
+                self.release(self.warm.pop(uri))
+        for uri in uris:
+            if uri in self.warm:
+                continue
+            if self.spare:
+                pipeline = self.spare.pop()
+            else:
+                pipeline = self.make_pipeline()
+            pipeline.set_property('uri', uri)
+            pipeline.set_state(gst.STATE_PAUSED)
+            self.warm[uri] = pipeline
+    
+    def take(self, uri):
+        """
+        Remove and return the pipeline paused on uri, or None if there is
+        none (or it failed to open the video).
+        """
+        pipeline = self.warm.pop(uri, None)
+        if pipeline is None:
+            return None
+        status,state,pending = pipeline.get_state(0)
+        if gst.STATE_PAUSED not in (state, pending):
+            self.release(pipeline)
+            return None
+        return pipeline
+    
+    def release(self, pipeline):
+        """
+        Stop a pipeline, keeping it for reuse if there is room.
+        """
+        pipeline.set_state(gst.STATE_NULL)
+        if len(self.warm) + len(self.spare) < self.size:
+            self.spare.append(pipeline)
+    
+    def clear(self):
+        """
+        Stop and forget every pipeline.
+        """
+        for pipeline in self.warm.values() + self.spare:
+            pipeline.set_state(gst.STATE_NULL)
+        self.warm.clear()
+        self.spare = []
+
 class MainUI:
     """
     A class to open a window for coding a Tinbergen project.
@@ -35,6 +108,10 @@ class MainUI:
                     'speed x1': gtk.gdk.keyval_from_name('bracketright'),
                     'speed x.5': gtk.gdk.keyval_from_name('bracketleft')}
     hotkey_list = [gtk.gdk.keyval_from_name(c) for c in string.ascii_letters+string.digits]
+    # Most symbols to offer at once while an entry is being typed
+    max_completions = 20
+    # Most search hits to list at once
+    max_search_hits = 500
     
     def __init__(self, project):
         self.project = project
@@ -48,7 +125,9 @@ class MainUI:
         builder.add_from_file(mainwin_gladefile)
         # Get references to relevant objects as attributes of self:
         ui_objects = ['main_win','observer_combo','file_nav','behavior_nav',
-                      'video_area', 'play_button', 'time_scale']
+                      'video_area', 'play_button', 'time_scale',
+                      'file_progress', 'search_entry', 'search_status',
+                      'search_results']
         for item in ui_objects:
             setattr(self, item, builder.get_object(item))
         
@@ -56,21 +135,40 @@ class MainUI:
         # Connect signals from UI to methods of self:
         builder.connect_signals(self)
         self.behavior_entry_cell = gtk.CellRendererText()
+        # Observations and videos next to the current one are loaded ahead
+        # of time; prerolling pipelines draw into a window never shown
+        self.obs_prefetcher = tbprefetch.ObsPrefetcher(project)
+        self.pipelines = PipelinePool(self.make_player)
+        self.preroll_window = gtk.Window()
+        self.preroll_window.realize()
         self.configure_observer_combo()
         self.configure_file_nav()
         self.configure_behavior_nav()
+        self.configure_search_results()
         
-        self.player = gst.element_factory_make('playbin2')
-        bus = self.player.get_bus()
-        bus.add_signal_watch()
-        bus.enable_sync_message_emission()
-        bus.connect('message::eos', self.on_video_end)
-        bus.connect('message::state-changed', self.on_player_state_change)
-        bus.connect('sync-message::element', self.on_attach_video_window)
+        self.player = self.make_player()
         
         self.time_update_handle = None
         self.current_framerate = None
+        # Time to seek to once the video being opened has prerolled
+        self.pending_seek = None
+        # The search index is built by the loader thread; until then, the
+        # observation files that change are only noted, to index afterwards
+        self.obs_index = None
+        self.unindexed_obsfiles = set()
+        # Frame rates and durations of videos opened before (or probed with
+        # tbprobe.py); only used from the main loop
+        self.video_info = tbprobe.VideoInfoCache(project)
+        project.save_listeners.append(self.on_obs_saved)
+        # Pick up videos and observation files added by other coders; changes
+        # found before the project has finished loading wait in
+        # queued_file_events
+        self.files_loaded = False
+        self.queued_file_events = []
+        self.watcher = tbwatch.ProjectWatcher(project,
+                                              self.on_project_files_changed)
         self.main_win.show()
+        self.start_file_loader()
     
     def get_current_observer(self):
         "Returns the current observer."
@@ -117,7 +215,9 @@ class MainUI:
         """
         if new == self._cur_video:
             return
-        if new not in self.project.video_files:
+        # Check against file_nav's catalog, since the project's video list
+        # may still be loading
+        if new not in self.catalog:
             new = None
         # Close the video
         self.player.set_state(gst.STATE_NULL)
@@ -127,39 +227,100 @@ class MainUI:
         # If the selected video is not the new video, update the selection
         nav_selection = self.file_nav.get_selection()
         nav_model, nav_iter = nav_selection.get_selected()
-        if nav_iter is None:
+        if nav_iter is None or nav_model.get_value(nav_iter, 2):
             nav_current = None
         else:
-            nav_current = nav_model.get_value(nav_iter, 0)
+            nav_current = nav_model.get_value(nav_iter, 1)
         if new != nav_current:
             if new is None:
                 nav_selection.unselect_all()
             else:
-                for ind in xrange(len(nav_model)):
-                    if new == nav_model[ind][0]:
-                        nav_selection.select_path(ind)
-                        break
+                nav_selection.select_iter(self.reveal_video_row(new))
         if new is not None:
-            # Open the new video
-            video_path = self.project.join_video_path(new)
-            self.player.set_property('uri', 'file://' + video_path)
-            self.player.set_state(gst.STATE_PAUSED)
+            # With probed metadata, the time scale can be set up before the
+            # video has prerolled
+            info = self.video_info.get(new)
+            if info is not None:
+                self.configure_time_scale(info.duration, info.framerate)
+            # Open the new video, in a prerolled pipeline if there is one
+            uri = 'file://' + self.project.join_video_path(new)
+            warm = self.pipelines.take(uri)
+            if warm is None:
+                self.player.set_property('uri', uri)
+                self.player.set_state(gst.STATE_PAUSED)
+            else:
+                self.promote_player(warm)
         self.open_observations()
     
-    def get_current_time(self):
+    def make_player(self):
+        # A playbin2 whose bus messages come to this window; only those from
+        # self.player are acted on, apart from attaching the video window
+        player = gst.element_factory_make('playbin2')
+        bus = player.get_bus()
+        bus.add_signal_watch()
+        bus.enable_sync_message_emission()
+        bus.connect('message::eos', self.on_video_end)
+        bus.connect('message::state-changed', self.on_player_state_change)
+        bus.connect('sync-message::element', self.on_attach_video_window,
+                    player)
+        return player
+    
+    def promote_player(self, player):
+        """
+        Make a prerolled pipeline the current player, moving its video into
+        the main window.
         """
-        For the currently open video, get the current time, in seconds. If there
-        is no video open, return 0.
+        old_player = self.player
+        self.player = player
+        self.pipelines.release(old_player)
+        imagesink = player.get_data('video-sink')
+        if imagesink is not None:
+            imagesink.set_xwindow_id(self.video_area.window.xid)
+            imagesink.expose()
+        status,state,pending = player.get_state(0)
+        if state == gst.STATE_PAUSED:
+            # Already prerolled, so there will be no state change to wait for
+            self.on_video_loaded()
+    
+    def prefetch_neighbours(self):
+        """
+        Start loading the observations and videos on either side of the
+        current video in its directory.
+        """
+        if self._cur_video is None:
+            return
+        neighbours = [f for f in reversed(self.catalog.neighbours(
+            self._cur_video)) if f is not None]
+        self.obs_prefetcher.prefetch([(f, self._cur_observer)
+                                      for f in neighbours])
+        self.pipelines.preroll(['file://' + self.project.join_video_path(f)
+                                for f in neighbours])
+    
+    def get_current_frame(self):
+        """
+        For the currently open video, get the number of the current frame. If
+        there is no video open, return 0.
         """
         try:
             nanosecs, format = self.player.query_position(gst.FORMAT_TIME)
-            #return float(nanosecs) / gst.SECOND
-            #return math.floor(float(nanosecs) / gst.SECOND
-            #   * self.current_framerate) / self.current_framerate
-            return (float(nanosecs / int(gst.SECOND / self.current_framerate))
-                / self.current_framerate)
         except gst.QueryError:
             return 0
+        # Exact integer arithmetic, so that a position always falls in the
+        # same frame regardless of float round-off
+        rate = self.current_framerate
+        if rate is None:
+            return 0
+        return (nanosecs * rate.numerator) // (gst.SECOND * rate.denominator)
+    
+    def get_current_time(self):
+        """
+        For the currently open video, get the current time, in seconds, as the
+        start time of the current frame. If there is no video open, return 0.
+        """
+        if self.current_framerate is None:
+            return 0
+        return tbdatamodel.frame_to_time(self.get_current_frame(),
+                                         self.current_framerate)
     
     def set_current_time(self, time):
         """
@@ -230,6 +391,7 @@ class MainUI:
         file_selection = nav.get_selection()
         file_selection.set_mode(gtk.SELECTION_SINGLE)
         file_selection.connect('changed', self.on_select_file)
+        nav.connect('test-expand-row', self.on_file_nav_expand)
         #file_selection.set_select_function(self.on_select_file)
         filename_column = gtk.TreeViewColumn('Movie File')
         observed_column = gtk.TreeViewColumn('Observed')
@@ -266,6 +428,7 @@ class MainUI:
         entry_cell.set_property('size-points', 9)
         entry_cell.set_property('editable', True)
         entry_cell.connect('edited', self.on_edit_entry)
+        entry_cell.connect('editing-started', self.on_start_edit_entry)
         name_cell = gtk.CellRendererText()
         name_cell.set_property('size-points', 9)
         value_cell = gtk.CellRendererText()
@@ -281,14 +444,152 @@ class MainUI:
         behav_col.set_cell_data_func(value_cell, self.render_behav_value)
         self.open_observations()
     
+    def configure_search_results(self):
+        # Create columns and cell renderers for the search_results treeview,
+        # whose model holds one tbsearch.SearchHit per row
+        nav = self.search_results
+        for title,render in (('Video', self.render_hit_video),
+                             ('Observer', self.render_hit_observer),
+                             ('Time', self.render_hit_time)):
+            column = gtk.TreeViewColumn(title)
+            cell = gtk.CellRendererText()
+            cell.set_property('size-points', 9)
+            column.pack_start(cell, True)
+            column.set_cell_data_func(cell, render)
+            nav.append_column(column)
+        nav.set_model(gtk.ListStore(object))
+    
+    def start_file_loader(self):
+        # Find the project's videos (unless they came from the startup cache)
+        # and start watching for changes, in a worker thread so that the
+        # window can be used in the meantime
+        if not self.project.videos_scanned:
+            self.file_progress.show()
+        loader = threading.Thread(target=self.load_files,
+                                  name='tinbergen-loader')
+        loader.daemon = True
+        loader.start()
+    
+    def load_files(self):
+        # Runs in the loader thread; GTK is only touched via idle callbacks
+        if not self.project.videos_scanned:
+            self.project.update_video_list(self.on_videos_found)
+        # The catalog is only changed in the main loop, so the observer index
+        # is found here but put in place by on_files_loaded
+        observers = self.project.find_observers()
+        self.watcher.start(build_index=False)
+        gobject.idle_add(self.on_files_loaded, observers)
+        # Indexed here in the loader thread: forking a pool of processes from
+        # a process already running GTK and GStreamer threads risks deadlocks.
+        # The project's observer index may not be in place yet, so the files
+        # are listed from the observers just found
+        pairs = [(videofile, observer)
+                 for videofile in self.project.video_files
+                 for observer in sorted(observers.get(videofile, ()))]
+        index = tbsearch.build_index(self.project, processes=1, pairs=pairs)
+        gobject.idle_add(self.on_index_built, index)
+    
     #------- TREE MODEL FACTORIES -------
     def make_file_model(self):
-        # Create a list store to hold files in the current project and attach
-        # it to the file_nav
-        file_store = gtk.ListStore(str)
-        for f in self.project.video_files:
-            file_store.append([f])
+        # Create a tree store to hold the project's directories and videos and
+        # attach it to the file_nav. Rows are only made for the top level to
+        # begin with, and for each directory when it is first expanded; each
+        # unexpanded directory has an empty placeholder row instead.
+        # Columns are: name shown, path (relative to video_root), is_dir
+        file_store = gtk.TreeStore(str, str, bool)
+        if self.project.videos_scanned:
+            self.catalog = self.project.catalog
+        else:
+            # Filled in by add_file_rows while the project is loading
+            self.catalog = tbdatamodel.VideoCatalog()
+        # TreeStore iters stay valid until their row is removed, so keep one
+        # for each row made to find rows without searching the model
+        self.file_iters = dict()
+        self.dir_iters = {'': None}
+        self.loaded_dirs = set()
         self.file_nav.set_model(file_store)
+        self.load_dir_rows('')
+    
+    def load_dir_rows(self, path):
+        # Make the rows for the contents of a directory, if not done yet
+        if path in self.loaded_dirs:
+            return
+        model = self.file_nav.get_model()
+        parent = self.dir_iters[path]
+        if parent is not None:
+            placeholder = model.iter_children(parent)
+            if placeholder is not None:
+                model.remove(placeholder)
+        directory = self.catalog.get_dir(path)
+        if directory is None:
+            return
+        self.loaded_dirs.add(path)
+        for name in sorted(directory.subdirs):
+            self.append_dir_row(parent, directory.subdirs[name])
+        for f in directory.videos:
+            self.file_iters[f] = model.append(parent, [os.path.basename(f), f,
+                                                       False])
+    
+    def append_dir_row(self, parent, directory):
+        model = self.file_nav.get_model()
+        treeiter = model.append(parent, [directory.name, directory.path, True])
+        model.append(treeiter, ['', '', False])
+        self.dir_iters[directory.path] = treeiter
+    
+    def show_video_row(self, videofile):
+        # Make a row for a video just added to the catalog, or for the
+        # directory it is in, if that directory's parent has been loaded
+        model = self.file_nav.get_model()
+        dirpath = self.catalog.dir_of(videofile)
+        ancestors = self.catalog.ancestors(dirpath)
+        for parent_path,path in zip(ancestors[:-1], ancestors[1:]):
+            if path not in self.dir_iters:
+                self.append_dir_row(self.dir_iters[parent_path],
+                                    self.catalog.get_dir(path))
+                return
+            if path not in self.loaded_dirs:
+                return
+        if videofile not in self.file_iters:
+            self.file_iters[videofile] = model.append(
+                self.dir_iters[dirpath],
+                [os.path.basename(videofile), videofile, False])
+    
+    def hide_video_row(self, videofile):
+        # Remove the row of a video just removed from the catalog, and the
+        # rows of any directories it left empty
+        model = self.file_nav.get_model()
+        treeiter = self.file_iters.pop(videofile, None)
+        if treeiter is not None:
+            model.remove(treeiter)
+        for path in self.catalog.ancestors(self.catalog.dir_of(videofile)):
+            if path in self.dir_iters and self.catalog.get_dir(path) is None:
+                model.remove(self.dir_iters[path])
+                # Forget the rows that went with it
+                prefix = path + os.sep
+                for table in (self.dir_iters, self.file_iters):
+                    for key in list(table):
+                        if key == path or key.startswith(prefix):
+                            del table[key]
+                self.loaded_dirs = set(loaded for loaded in self.loaded_dirs
+                                       if loaded != path and
+                                       not loaded.startswith(prefix))
+                break
+    
+    def reveal_video_row(self, videofile):
+        """
+        Load and expand the directories down to a video in file_nav, and
+        return the video's row.
+        """
+        model = self.file_nav.get_model()
+        dirpath = self.catalog.dir_of(videofile)
+        for path in self.catalog.ancestors(dirpath):
+            self.load_dir_rows(path)
+        if dirpath:
+            self.file_nav.expand_to_path(
+                model.get_path(self.dir_iters[dirpath]))
+        treeiter = self.file_iters[videofile]
+        self.file_nav.scroll_to_cell(model.get_path(treeiter))
+        return treeiter
     
     def make_behaviors_model(self, obslist):
         # Create a list store to hold observations for the current video and
@@ -300,6 +601,9 @@ class MainUI:
     
     #------- EVENT CALLBACKS -------
     def on_main_win_destroy(self, window):
+        self.watcher.stop()
+        self.obs_prefetcher.close()
+        self.pipelines.clear()
         self.player.set_state(gst.STATE_NULL)
         if self.time_update_handle is not None:
             gobject.source_remove(self.time_update_handle)
@@ -320,13 +624,18 @@ class MainUI:
         nav_model, nav_iter = selection.get_selected()
         if nav_iter is None:
             selected = None
+        elif nav_model.get_value(nav_iter, 2) or \
+                not nav_model.get_value(nav_iter, 1):
+            # A directory (or placeholder) row; keep the current video
+            return
         else:
-            selected = nav_model.get_value(nav_iter, 0)
+            selected = nav_model.get_value(nav_iter, 1)
         if self._cur_video != selected:
             self.set_current_video(selected)
     
     def on_main_key_press(self, window, event):
-        if self.behavior_entry_cell.get_property('editing'):
+        if (self.behavior_entry_cell.get_property('editing') or
+                self.search_entry.is_focus()):
             return False
         keyval = event.keyval
         if keyval == self.key_dispatch['new obs']:
@@ -381,8 +690,35 @@ class MainUI:
         self.set_current_time(time)
     
     def on_start_edit_entry(self, cell, editable, path):
-        pass
         #self.main_win.handler_block_by_func(self.on_main_key_press)
+        # Offer completions from the ethogram as the symbol is typed
+        completion = gtk.EntryCompletion()
+        completion.set_text_column(0)
+        desc_cell = gtk.CellRendererText()
+        desc_cell.set_property('foreground', 'gray')
+        completion.pack_start(desc_cell)
+        completion.add_attribute(desc_cell, 'text', 1)
+        # The model only ever holds matching symbols, so accept every row
+        completion.set_match_func(lambda completion, key, treeiter: True)
+        editable.set_completion(completion)
+        editable.connect('changed', self.on_entry_text_changed)
+        self.on_entry_text_changed(editable)
+    
+    def on_entry_text_changed(self, editable):
+        text = editable.get_text()
+        ethogram = self.project.ethogram
+        store = gtk.ListStore(str, str)
+        if len(text.split()) <= 1 and not text[-1:].isspace():
+            # Still typing the symbol
+            for symbol in ethogram.complete_entry(text, self.max_completions):
+                store.append([symbol, self.describe_code(symbol)])
+        editable.get_completion().set_model(store)
+        # Show the entry in red as soon as it can't be a symbol
+        items = text.split()
+        if items and not ethogram.symbols.is_prefix(items[0]):
+            editable.modify_text(gtk.STATE_NORMAL, gtk.gdk.color_parse('red'))
+        else:
+            editable.modify_text(gtk.STATE_NORMAL, None)
     
     def on_edit_entry(self, cell, path, new_entry):
         #self.main_win.handler_unblock_by_func(self.on_main_key_press)
@@ -392,7 +728,134 @@ class MainUI:
         model[path][1] = obs
         self.current_modified = True
     
+    def on_videos_found(self, batch):
+        # Called from the loader thread with each batch of videos found
+        gobject.idle_add(self.add_file_rows, batch)
+    
+    def add_file_rows(self, batch):
+        for f in batch:
+            if f not in self.catalog:
+                self.catalog.add_video(f)
+                self.show_video_row(f)
+        self.file_nav.queue_draw()
+        self.file_progress.set_text('Found {0} videos...'.format(
+            len(self.catalog)))
+        self.file_progress.pulse()
+        return False
+    
+    def on_files_loaded(self, observers):
+        self.file_progress.hide()
+        # Switch to the project's own catalog, which has the same videos and
+        # is kept up to date with observations from now on
+        self.project.build_observer_index(observers)
+        self.catalog = self.project.catalog
+        self.files_loaded = True
+        # Now apply the changes the watcher found in the meantime
+        events, self.queued_file_events = self.queued_file_events, []
+        if events:
+            self.update_project_files(events)
+        self.file_nav.queue_draw()
+        return False
+    
+    def on_index_built(self, index):
+        # Bring the new index up to date with the files saved or changed
+        # while it was being built
+        self.obs_index = index
+        for videofile,observer in self.unindexed_obsfiles:
+            self.reindex_obsfile(videofile, observer)
+        self.unindexed_obsfiles.clear()
+        self.search_status.set_text('{0} observations indexed'.format(
+            index.n_rows))
+        return False
+    
+    def on_obs_saved(self, videofile, observer, obslist):
+        if self.obs_index is None:
+            self.unindexed_obsfiles.add((videofile, observer))
+        else:
+            self.obs_index.add_file(videofile, observer, obslist)
+    
+    def reindex_obsfile(self, videofile, observer):
+        # Index an observation file again from disk, or forget it if it has
+        # gone
+        if self.obs_index is None:
+            self.unindexed_obsfiles.add((videofile, observer))
+        elif os.path.exists(self.project.get_obsfile(videofile, observer)):
+            self.obs_index.add_file(videofile, observer,
+                self.project.load_obs_from_file(videofile, observer))
+        else:
+            self.obs_index.remove_file(videofile, observer)
+    
+    def on_search_entry_activate(self, entry):
+        if self.obs_index is None:
+            self.search_status.set_text('Still indexing observations...')
+            return
+        query = tbsearch.parse_query(entry.get_text())
+        start = timeit.default_timer()
+        try:
+            hits = self.obs_index.search(limit=self.max_search_hits, **query)
+        except ValueError:
+            self.search_status.set_text('Nothing to search for')
+            return
+        elapsed = timeit.default_timer() - start
+        store = gtk.ListStore(object)
+        for hit in hits:
+            store.append([hit])
+        self.search_results.set_model(store)
+        if len(hits) >= self.max_search_hits:
+            status = 'First {0} matches ({1:.1f} ms)'
+        else:
+            status = '{0} matches ({1:.1f} ms)'
+        self.search_status.set_text(status.format(len(hits), elapsed * 1000))
+    
+    def on_search_result_activated(self, nav, path, column):
+        # Open the video and observations of a hit, and go to its time
+        hit = nav.get_model()[path][0]
+        if hit.video not in self.catalog:
+            return
+        self.set_current_observer(hit.observer)
+        if hit.video == self._cur_video:
+            self.seek_if_known(hit.time)
+        else:
+            self.pending_seek = hit.time
+            self.set_current_video(hit.video)
+        behaviors = self.behavior_nav.get_model()
+        if hit.row < len(behaviors):
+            self.behavior_nav.set_cursor(hit.row)
+    
+    def on_file_nav_expand(self, treeview, treeiter, path):
+        model = treeview.get_model()
+        if model.get_value(treeiter, 2):
+            self.load_dir_rows(model.get_value(treeiter, 1))
+        return False
+    
+    def on_project_files_changed(self, events):
+        # Called from the watcher thread; handle the changes in the main loop
+        gobject.idle_add(self.update_project_files, events)
+    
+    def update_project_files(self, events):
+        # Apply file changes found by the watcher to the project and file_nav
+        if not self.files_loaded:
+            # The catalog shown is still the one filled in while loading, so
+            # keep the changes until on_files_loaded replaces it
+            self.queued_file_events.extend(events)
+            return False
+        tbwatch.apply_events(self.project, events)
+        for event in events:
+            if event.root == 'video':
+                if event.kind == 'added':
+                    self.show_video_row(event.path)
+                elif event.kind == 'removed':
+                    self.hide_video_row(event.path)
+            elif event.root == 'project':
+                self.reindex_obsfile(
+                    *tbdatamodel.split_obsfile_name(event.path))
+        # Observers and directory counts may have changed
+        self.file_nav.queue_draw()
+        return False
+    
     def on_video_end(self, bus, message):
+        if message.src != self.player:
+            return
         self.player.set_state(gst.STATE_PAUSED)
     
     def on_select_observation(self, selection):
@@ -412,15 +875,20 @@ class MainUI:
         scale.handler_unblock_by_func(self.on_time_scale_value_changed)
         return True
     
-    def on_attach_video_window(self, bus, message):
+    def on_attach_video_window(self, bus, message, player):
         if message.structure is None:
             return
         message_name = message.structure.get_name()
         if message_name == 'prepare-xwindow-id':
             imagesink = message.src
             imagesink.set_property('force-aspect-ratio', True)
+            # Kept so the video can be moved when the player is promoted
+            player.set_data('video-sink', imagesink)
             gtk.gdk.threads_enter()
-            imagesink.set_xwindow_id(self.video_area.window.xid)
+            if player is self.player:
+                imagesink.set_xwindow_id(self.video_area.window.xid)
+            else:
+                imagesink.set_xwindow_id(self.preroll_window.window.xid)
             gtk.gdk.threads_leave()
     
     def on_player_state_change(self, bus, message):
@@ -432,17 +900,7 @@ class MainUI:
             return
         if prev_state == gst.STATE_READY:
             # A new video has been loaded and is all ready
-            buf = self.player.get_property('frame')
-            caps = buf.get_caps()
-            capstr = caps.get_structure(0)
-            self.current_framerate =  float(capstr['framerate'])
-            # Set up the time scale for the new video
-            scale = self.time_scale
-            scale.handler_block_by_func(self.on_time_scale_value_changed)
-            scale.set_range(0, self.get_video_duration())
-            scale.set_increments(1/self.current_framerate, 1)
-            scale.set_value(self.get_current_time())
-            scale.handler_unblock_by_func(self.on_time_scale_value_changed)
+            self.on_video_loaded()
         elif new_state == gst.STATE_PAUSED:
             # The video was playing and is now paused
             # we should update button icon and such
@@ -457,6 +915,54 @@ class MainUI:
             self.time_update_handle = gobject.timeout_add(100,
                                                           self.on_time_update)
     
+    def on_video_loaded(self):
+        # The current player has prerolled a new video
+        buf = self.player.get_property('frame')
+        caps = buf.get_caps()
+        capstr = caps.get_structure(0)
+        duration = self.get_video_duration()
+        framerate = tbdatamodel.frame_rate(capstr['framerate'])
+        self.configure_time_scale(duration, framerate)
+        self.remember_video_info(duration, framerate, capstr['width'],
+                                 capstr['height'])
+        if self.pending_seek is not None:
+            self.seek_if_known(self.pending_seek)
+            self.pending_seek = None
+    
+    def remember_video_info(self, duration, framerate, width, height):
+        # Keep the metadata of the video the current player has prerolled, so
+        # that its time scale can be set up straight away next time. Videos
+        # are only measured as they are opened, here in the main loop, rather
+        # than probed all at once (see tbprobe.py for that)
+        uri = self.player.get_property('uri')
+        if not uri or not uri.startswith('file://') or duration <= 0:
+            return
+        videofile = self.project.rel_video_path(uri[len('file://'):])
+        info = tbprobe.VideoInfo(framerate, duration,
+                                 tbdatamodel.time_to_frame(duration, framerate),
+                                 width, height)
+        if self.video_info.get(videofile) != info:
+            self.video_info.update(videofile, info)
+            try:
+                self.video_info.save()
+            except EnvironmentError:
+                pass
+    
+    def configure_time_scale(self, duration, framerate):
+        # Set up the time scale for the current video
+        self.current_framerate = framerate
+        scale = self.time_scale
+        scale.handler_block_by_func(self.on_time_scale_value_changed)
+        scale.set_range(0, duration)
+        scale.set_increments(float(1/framerate), 1)
+        scale.set_value(self.get_current_time())
+        scale.handler_unblock_by_func(self.on_time_scale_value_changed)
+    
+    def seek_if_known(self, time):
+        # Seek to a time that may be missing (nan), once a video is open
+        if time == time:
+            self.set_current_time(time)
+    
     #------- VIDEO PLAYBACK CONTROL -------
     def step_video_forward(self):
         if not self.is_video_loaded():
@@ -519,11 +1025,31 @@ class MainUI:
         cell.set_property('text', obs_name)
     
     def render_file_observers(self, column, cell, model, treeiter):
-        filename = model.get_value(treeiter, 0)
-        observers = self.project.get_video_observers(filename)
-        observer_str = ', '.join(observers)
+        path = model.get_value(treeiter, 1)
+        if model.get_value(treeiter, 2):
+            directory = self.catalog.get_dir(path)
+            if directory is None:
+                observer_str = ''
+            else:
+                observer_str = '{0}/{1}'.format(directory.n_observed,
+                                                directory.n_videos)
+        elif path:
+            observers = self.project.get_video_observers(path)
+            observer_str = ', '.join(observers)
+        else:
+            observer_str = ''
         cell.set_property('text', observer_str)
     
+    def render_hit_video(self, column, cell, model, treeiter):
+        cell.set_property('text', model.get_value(treeiter, 0).video)
+    
+    def render_hit_observer(self, column, cell, model, treeiter):
+        cell.set_property('text', model.get_value(treeiter, 0).observer)
+    
+    def render_hit_time(self, column, cell, model, treeiter):
+        time = model.get_value(treeiter, 0).time
+        cell.set_property('text', '{:.3f}'.format(time))
+    
     def render_behav_time(self, column, cell, model, treeiter):
         time = model.get_value(treeiter, 0)
         cell.set_property('text', '{:.3f}'.format(time))
@@ -540,6 +1066,14 @@ class MainUI:
         obs = model.get_value(treeiter, 1)
         cell.set_property('text', obs.get('value', ''))
     
+    def describe_code(self, symbol):
+        # A short description of what a symbol codes, for completions
+        code = self.project.ethogram.codes[symbol]
+        args = code.get('args')
+        if args:
+            return ' '.join([code['name']] + sorted(args))
+        return ' '.join([code['name'], code.get('value', '')]).strip()
+    
     #------- FILE NAVIGATION -------
     def make_new_observation(self, entry=None):
         if not self.can_edit_observations():
@@ -570,6 +1104,13 @@ class MainUI:
         for row in obs_model:
             obs = row[1]
             obs['time'] = row[0]
+            if self.current_framerate is not None:
+                # Rows without a usable time (nan) get no frame
+                try:
+                    obs['frame'] = tbdatamodel.time_to_frame(
+                        row[0], self.current_framerate)
+                except ValueError:
+                    obs.pop('frame', None)
             obslist.append(obs)
         self.project.save_obslist(self._cur_video, self._cur_observer, obslist)
     
@@ -580,16 +1121,19 @@ class MainUI:
         # Load observations for the current observer and video from file
         cur_video = self.get_current_video()
         cur_observer = self.get_current_observer()
-        obslist = self.project.load_obs_from_file(cur_video, cur_observer)
+        obslist = self.obs_prefetcher.take(cur_video, cur_observer)
         self.make_behaviors_model(obslist)
         entry_cell.set_property('editable', self.can_edit_observations())
-        entry_cell.connect('editing-started', self.on_start_edit_entry)
         self.current_modified = False
+        self.prefetch_neighbours()
 
 if __name__ == '__main__':
     import sys
-    project_file = sys.argv[1]
-    project = tbdatamodel.Project(project_file)
+    args = tbprofile.configure(sys.argv[1:])
+    tbprofile.instrument_ui(MainUI)
+    project_file = args[0]
+    project = tbdatamodel.Project(project_file, use_cache=True,
+                                  scan_videos=False)
     gtk.gdk.threads_init()
     MainUI(project)
     gtk.main()